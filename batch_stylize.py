@@ -0,0 +1,447 @@
+import argparse
+import glob
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from neural_style import pipeline
+from neural_style.batching import BatchScheduler
+from neural_style.image_io import to_nchw
+from neural_style.incremental import PATCH_MULTIPLE, IncrementalStylizer, check_patch_size
+from neural_style.registry import load_manifest
+from neural_style.session_pool import MODEL_VARIANTS, SessionPool, model_name
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv', '.webm')
+OUTPUT_FORMATS = {'jpg': 'JPEG', 'png': 'PNG'}
+MAX_MEMORY_MB = 2048
+REPORT_INTERVAL = 5   # seconds between progress lines
+
+
+class MemoryBudget:
+    """Counting semaphore over bytes: bounds the images decoded but not yet written.
+
+    An item larger than the whole budget is still let through once nothing
+    else is in flight, so a single huge image can't deadlock the run.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self._cond:
+            self._cond.wait_for(lambda: self.used == 0 or self.used + nbytes <= self.limit)
+            self.used += nbytes
+
+    def release(self, nbytes):
+        with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+
+class Item:
+    """One input image on its way through decode -> run -> encode, for `styles`."""
+
+    def __init__(self, name, load, size, styles, nbytes, video=None):
+        self.name = name
+        self.video = video   # name of the video a frame belongs to
+        self.load = load
+        self.size = size
+        self.styles = styles
+        self.nbytes = nbytes
+        self.content = None
+        self.resized = None
+        self.tensor = None
+        self.remaining = len(styles)
+
+
+def estimate_bytes(size, target, styles):
+    """Rough peak memory of one item: the decoded and resized image, the input
+    tensor, and per style the model output plus the full-size result being encoded.
+    Model activations inside onnxruntime are not included."""
+    width, height = size
+    pixels, target_pixels = width * height, target[0] * target[1]
+    return pixels * 3 + target_pixels * (3 + 12) + styles * (target_pixels * 12 + pixels * 3 * 2)
+
+
+def output_path(output_dir, style, name, ext):
+    return os.path.join(output_dir, style, f"{name}.{ext}")
+
+
+def list_sources(inputs, recursive=False):
+    """Expands directories, globs and files into (name prefix, path) pairs."""
+    sources = []
+    for entry in inputs:
+        if os.path.isdir(entry):
+            pattern = os.path.join(entry, '**', '*') if recursive else os.path.join(entry, '*')
+            for path in sorted(glob.glob(pattern, recursive=recursive)):
+                if path.lower().endswith(IMAGE_EXTENSIONS + VIDEO_EXTENSIONS):
+                    sources.append((os.path.splitext(os.path.relpath(path, entry))[0], path))
+        elif os.path.isfile(entry):
+            sources.append((os.path.splitext(os.path.basename(entry))[0], entry))
+        else:
+            matches = sorted(glob.glob(entry, recursive=recursive))
+            if not matches:
+                print(f"⚠️ No input matches {entry}")
+            for path in matches:
+                if path.lower().endswith(IMAGE_EXTENSIONS + VIDEO_EXTENSIONS):
+                    sources.append((os.path.splitext(os.path.basename(path))[0], path))
+    return sources
+
+
+def iter_frames(name, path, pending_styles, every=1):
+    """Yields (frame name, RGB array) for the frames of a video that still need a
+    style; the others are skipped with grab(), without being decoded."""
+    try:
+        import cv2
+    except ImportError:
+        raise RuntimeError("Video input needs OpenCV: pip install opencv-python-headless")
+
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise RuntimeError(f"Could not open video: {path}")
+    index = 0
+    try:
+        while capture.grab():
+            frame_name = f"{name}_{index:06d}"
+            if index % every == 0 and pending_styles(frame_name):
+                ok, frame = capture.retrieve()
+                if ok:
+                    yield frame_name, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            index += 1
+    finally:
+        capture.release()
+
+
+class BatchStylizer:
+    """Streams inputs through a decode pool, batched onnxruntime runs and an encode pool.
+
+    A producer thread walks the inputs, skips outputs that already exist and
+    reserves each item's estimated memory from a MemoryBudget before handing it
+    to the decode pool, so prefetching never exceeds `max_memory_mb`. The calling
+    thread collects decoded items into batches of the same inference size and
+    runs every style on each batch, reusing the decoded image; results are
+    written by the encode pool through a temporary file, so an interrupted run
+    can be resumed. With `incremental` (IncrementalStylizer keyword arguments),
+    video frames are stylized in order, each restylizing only what changed
+    since the previous frame, instead of in batches.
+    """
+
+    def __init__(self, scheduler, models, output_dir, params, formats=('jpg',), batch_size=4,
+                 decode_workers=None, encode_workers=None, max_memory_mb=MAX_MEMORY_MB, jpeg_quality=90,
+                 frame_every=1, incremental=None):
+        self.scheduler = scheduler
+        self.models = models   # {style: session pool key}
+        self.output_dir = output_dir
+        self.params = params
+        self.formats = formats
+        self.batch_size = batch_size
+        self.jpeg_quality = jpeg_quality
+        self.frame_every = frame_every
+        self.incremental = incremental
+        self._stylizers = {}   # {style: IncrementalStylizer} of the current video
+        self._video = None
+        self.cells_reused = self.cells_rerun = 0
+        workers = os.cpu_count() or 4
+        self.decode_pool = ThreadPoolExecutor(decode_workers or workers, thread_name_prefix='decode')
+        self.encode_pool = ThreadPoolExecutor(encode_workers or workers, thread_name_prefix='encode')
+        self.budget = MemoryBudget(max_memory_mb * 1024 * 1024)
+
+        self._lock = threading.Lock()
+        self.done = 0
+        self.written = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def pending_styles(self, name):
+        """Styles with at least one output format missing for `name`."""
+        return [style for style in self.models
+                if not all(os.path.exists(output_path(self.output_dir, style, name, ext)) for ext in self.formats)]
+
+    def target_size(self, size):
+        return pipeline.inference_size(size, self.params['resize_mode'], self.params['image_size'],
+                                       self.params['max_pixels'])
+
+    def _submit(self, decoded, name, load, size, video=None):
+        styles = self.pending_styles(name)
+        if not styles:
+            with self._lock:
+                self.skipped += 1
+            return
+        item = Item(name, load, size, styles, estimate_bytes(size, self.target_size(size), len(styles)), video)
+        self.budget.acquire(item.nbytes)
+        decoded.put((item, self.decode_pool.submit(self._decode, item)))
+
+    def _produce(self, sources, decoded):
+        try:
+            for name, path in sources:
+                if path.lower().endswith(VIDEO_EXTENSIONS):
+                    try:
+                        for frame_name, frame in iter_frames(name, path, self.pending_styles, self.frame_every):
+                            self._submit(decoded, frame_name, lambda frame=frame: Image.fromarray(frame),
+                                         (frame.shape[1], frame.shape[0]), video=name)
+                    except RuntimeError as e:
+                        print(f"❌ {str(e)}")
+                        with self._lock:
+                            self.failed += 1
+                    continue
+                try:
+                    with Image.open(path) as img:
+                        size = img.size   # header only; pixels are decoded in the pool
+                except Exception as e:
+                    print(f"❌ Could not read {path}: {str(e)}")
+                    with self._lock:
+                        self.failed += 1
+                    continue
+                self._submit(decoded, name, lambda path=path: pipeline.load_content(path), size)
+        finally:
+            decoded.put(None)
+
+    def _decode(self, item):
+        item.content = item.load()
+        target = self.target_size(item.content.size)
+        item.resized = item.content if target == item.content.size else item.content.resize(target, Image.LANCZOS)
+        # Own buffer per item: it is batched after this thread has moved on
+        item.tensor = to_nchw(item.resized, out=np.empty((1, 3, target[1], target[0]), dtype=np.float32))
+        return item
+
+    def _encode(self, item, style, stylized):
+        try:
+            final_img = pipeline.finish_image(stylized, item.content, item.resized, self.params['sharpen'],
+                                              self.params['contrast'], self.params['blend_alpha'],
+                                              self.params['enhance_before_upscale'])
+            for ext in self.formats:
+                path = output_path(self.output_dir, style, item.name, ext)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.tmp"
+                options = {'quality': self.jpeg_quality} if ext == 'jpg' else {}
+                final_img.save(tmp_path, OUTPUT_FORMATS[ext], **options)
+                os.replace(tmp_path, path)
+            with self._lock:
+                self.written += 1
+        except Exception as e:
+            print(f"❌ Could not write {item.name} ({style}): {str(e)}")
+            with self._lock:
+                self.failed += 1
+        finally:
+            self._style_finished(item)
+
+    def _style_finished(self, item):
+        with self._lock:
+            item.remaining -= 1
+            finished = item.remaining == 0
+            if finished:
+                self.done += 1
+        if finished:
+            item.content = item.resized = item.tensor = None
+            self.budget.release(item.nbytes)
+
+    def _run_incremental(self, item):
+        if item.video != self._video:
+            self._video = item.video
+            self._stylizers = {}
+        pixels = np.asarray(item.resized)
+        for style in item.styles:
+            stylizer = self._stylizers.get(style)
+            if stylizer is None:
+                model = self.models[style]
+                stylizer = self._stylizers[style] = IncrementalStylizer(
+                    lambda tensor, model=model: self.scheduler.run(model, tensor),
+                    uint8_io=self.scheduler.session_pool.takes_uint8(model), **self.incremental)
+            reused, rerun = stylizer.reused, stylizer.rerun
+            try:
+                stylized = stylizer.stylize(pixels)
+            except Exception as e:
+                print(f"❌ {style} failed on {item.name}: {str(e)}")
+                with self._lock:
+                    self.failed += 1
+                self._style_finished(item)
+                continue
+            with self._lock:
+                self.cells_reused += stylizer.reused - reused
+                self.cells_rerun += stylizer.rerun - rerun
+            self.encode_pool.submit(self._encode, item, style, stylized[np.newaxis])
+
+    def _run_batch(self, batch):
+        if self.incremental:
+            for item in batch:
+                if item.video is not None:
+                    self._run_incremental(item)
+            batch = [item for item in batch if item.video is None]
+            if not batch:
+                return
+        tensor = np.concatenate([item.tensor for item in batch], axis=0) if len(batch) > 1 else batch[0].tensor
+        for style, model in self.models.items():
+            rows = [i for i, item in enumerate(batch) if style in item.styles]
+            if not rows:
+                continue
+            try:
+                outputs = self.scheduler.run(model, tensor if len(rows) == len(batch) else tensor[rows])
+            except Exception as e:
+                print(f"❌ {style} failed on a batch of {len(rows)}: {str(e)}")
+                with self._lock:
+                    self.failed += len(rows)
+                for i in rows:
+                    self._style_finished(batch[i])
+                continue
+            for output, i in zip(outputs, rows):
+                self.encode_pool.submit(self._encode, batch[i], style, output[np.newaxis])
+
+    def run(self, sources):
+        # Enough decoded items queued to always have the next batch ready
+        decoded = queue.Queue(maxsize=2 * self.batch_size)
+        producer = threading.Thread(target=self._produce, args=(sources, decoded), daemon=True)
+        start = last_report = time.perf_counter()
+        producer.start()
+
+        batch = []
+        while True:
+            try:
+                entry = decoded.get(timeout=0.1)
+            except queue.Empty:
+                # The producer is waiting for memory (or on slow input): don't hold a partial batch
+                if batch:
+                    self._run_batch(batch)
+                    batch = []
+                continue
+            if entry is None:
+                break
+            item, future = entry
+            try:
+                future.result()
+            except Exception as e:
+                print(f"❌ Could not decode {item.name}: {str(e)}")
+                with self._lock:
+                    self.failed += 1
+                item.remaining = 0
+                self.budget.release(item.nbytes)
+                continue
+            if batch and (len(batch) >= self.batch_size or batch[0].tensor.shape != item.tensor.shape):
+                self._run_batch(batch)
+                batch = []
+            batch.append(item)
+
+            now = time.perf_counter()
+            if now - last_report >= REPORT_INTERVAL:
+                last_report = now
+                self.report(now - start)
+        if batch:
+            self._run_batch(batch)
+
+        self.decode_pool.shutdown()
+        self.encode_pool.shutdown()
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed):
+        with self._lock:
+            stats = {
+                'images': self.done,
+                'outputs': self.written,
+                'skipped': self.skipped,
+                'failed': self.failed,
+                'seconds': round(elapsed, 1),
+                'images_per_second': round(self.done / elapsed, 2) if elapsed else 0.0,
+                'memory_mb': round(self.budget.used / 1024 / 1024)
+            }
+            cells = self.cells_reused + self.cells_rerun
+            if self.incremental:
+                stats['reuse_ratio'] = round(self.cells_reused / cells, 3) if cells else 0.0
+        print(f"⏱️ {stats['images']} images ({stats['outputs']} outputs) in {stats['seconds']} s: "
+              f"{stats['images_per_second']} images/s, {stats['skipped']} skipped, {stats['failed']} failed, "
+              f"~{stats['memory_mb']} MB in flight"
+              + (f", {stats['reuse_ratio']:.0%} of video tiles reused" if self.incremental else ""))
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stylize whole directories, globs or videos with one or more styles")
+    parser.add_argument('inputs', nargs='+', help="image files, directories, glob patterns or video files")
+    parser.add_argument('--styles', nargs='+', required=True, help="model names, e.g. mosaic candy")
+    parser.add_argument('--variant', default='fp32', choices=MODEL_VARIANTS)
+    parser.add_argument('--model-dir', default='.')
+    parser.add_argument('--manifest', help="take the model files from this manifest instead of --model-dir")
+    parser.add_argument('--output-dir', default='batch_outputs', help="results go to <output-dir>/<style>/")
+    parser.add_argument('--formats', nargs='+', default=['jpg'], choices=list(OUTPUT_FORMATS))
+    parser.add_argument('--jpeg-quality', type=int, default=90)
+    parser.add_argument('--recursive', action='store_true', help="descend into subdirectories")
+    parser.add_argument('--frame-every', type=int, default=1, help="only stylize every n-th video frame")
+    parser.add_argument('--incremental', action='store_true',
+                        help="restylize only the tiles of a video frame that changed (dynamic-shape models)")
+    parser.add_argument('--tile-size', type=int, default=64, help="incremental mode: cell size in pixels "
+                             f"(the cell plus twice the halo must be a multiple of {PATCH_MULTIPLE})")
+    parser.add_argument('--tile-halo', type=int, default=32, help="incremental mode: context around a cell")
+    parser.add_argument('--change-threshold', type=float, default=2.0,
+                        help="incremental mode: mean absolute change (0-255) that reruns a cell")
+    parser.add_argument('--image-size', type=int, default=pipeline.IMAGE_SIZE)
+    parser.add_argument('--resize-mode', default='square', choices=pipeline.RESIZE_MODES)
+    parser.add_argument('--max-pixels', type=int, default=pipeline.MAX_PIXELS)
+    parser.add_argument('--blend-alpha', type=float, help="blend with the content (0.0 = no style, 1.0 = full style)")
+    parser.add_argument('--no-enhance', action='store_true', help="skip sharpening and contrast")
+    parser.add_argument('--batch-size', type=int, default=4,
+                        help="images per onnxruntime run (needs models exported with --dynamic-batch)")
+    parser.add_argument('--decode-workers', type=int, help="default: one per core")
+    parser.add_argument('--encode-workers', type=int, help="default: one per core")
+    parser.add_argument('--threads', type=int, default=0, help="onnxruntime intra-op threads (0 = all cores)")
+    parser.add_argument('--max-memory-mb', type=int, default=MAX_MEMORY_MB,
+                        help="ceiling for images decoded but not yet written")
+    args = parser.parse_args()
+    try:
+        check_patch_size(args.tile_size, args.tile_halo)
+    except ValueError as e:
+        parser.error(f"--tile-size/--tile-halo: {str(e)}")
+
+    pool = SessionPool([], model_dir=args.model_dir, intra_op_threads=args.threads,
+                       manifest=load_manifest(args.manifest) if args.manifest else None)
+    models = {}
+    for style in args.styles:
+        model = model_name(style, args.variant)
+        if not pool.has_model(model):
+            print(f"❌ Model not found: {pool.model_path(model)}")
+            continue
+        models[style] = model
+    if not models:
+        return
+
+    # Every style runs on the same decoded tensor, so fixed-shape models dictate the size
+    fixed_sizes = {pool.image_shape(model) for model in models.values() if not pool.has_dynamic_shape(model)}
+    if len(fixed_sizes) > 1:
+        print(f"❌ The models have different fixed input sizes {sorted(fixed_sizes)}; run them separately")
+        return
+    if fixed_sizes:
+        height, width = fixed_sizes.pop()
+        if height != width:
+            print(f"❌ Non-square fixed input shapes are not supported: {width}x{height}")
+            return
+        if args.resize_mode != 'square' or args.image_size != height:
+            print(f"⚠️ Fixed-shape models: using square resize at {height}x{height}")
+        args.resize_mode, args.image_size = 'square', height
+        if args.incremental:
+            print("⚠️ Incremental mode needs dynamic-shape models, stylizing whole frames")
+            args.incremental = False
+
+    params = dict(pipeline.DEFAULT_PARAMS, image_size=args.image_size, resize_mode=args.resize_mode,
+                  max_pixels=args.max_pixels, blend_alpha=args.blend_alpha)
+    if args.no_enhance:
+        params.update(sharpen=False, contrast=1.0)
+
+    sources = list_sources(args.inputs, args.recursive)
+    print(f"🎨 {len(sources)} inputs x {len(models)} styles -> {args.output_dir}")
+    stylizer = BatchStylizer(BatchScheduler(pool, max_batch=1), models, args.output_dir, params,
+                             formats=args.formats, batch_size=args.batch_size,
+                             decode_workers=args.decode_workers, encode_workers=args.encode_workers,
+                             max_memory_mb=args.max_memory_mb, jpeg_quality=args.jpeg_quality,
+                             frame_every=args.frame_every,
+                             incremental={'tile_size': args.tile_size, 'halo': args.tile_halo,
+                                          'threshold': args.change_threshold} if args.incremental else None)
+    stylizer.run(sources)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import tempfile
+import time
+
+import numpy as np
+import onnxruntime as ort
+from PIL import Image
+
+from neural_style import pipeline
+from neural_style.image_io import from_model_output, to_model_input
+from neural_style.postprocess import fused_postprocess, pil_postprocess
+from neural_style.session_pool import make_session_options
+
+STAGES = ['decode', 'resize', 'preprocess', 'session_create', 'run', 'postprocess',
+          'upscale', 'enhance', 'jpeg_encode', 'png_encode']
+
+# Post-processing methods compared by --compare-postprocess: upscale + PIL chain,
+# upscale + fused pass, and fused pass at inference resolution before the upscale
+POSTPROCESS_METHODS = ['pil', 'fused', 'fused_before_upscale']
+
+
+def export_random_model(folder):
+    """Exports a randomly initialized TransformerNet through convert_all_styles.convert_model."""
+    import torch
+    from convert_all_styles import convert_model
+    from neural_style.transformer_net import TransformerNet
+
+    torch.manual_seed(0)
+    checkpoint = os.path.join(folder, 'random.pth')
+    onnx_path = os.path.join(folder, 'random.onnx')
+    torch.save(TransformerNet().state_dict(), checkpoint)
+    if not convert_model(checkpoint, onnx_path, dynamic_shape=True):
+        raise RuntimeError("Could not export the random model")
+    return onnx_path
+
+
+def make_input(size, source=None):
+    """JPEG bytes of a size x size test image (the source photo, or a synthetic gradient)."""
+    if source and os.path.exists(source):
+        img = Image.open(source).convert("RGB").resize((size, size), Image.LANCZOS)
+    else:
+        y, x = np.mgrid[0:size, 0:size]
+        rng = np.random.default_rng(0)
+        pixels = np.stack([x * 255 // size, y * 255 // size, (x + y) * 127 // size], axis=-1)
+        pixels = np.clip(pixels + rng.normal(0, 12, pixels.shape), 0, 255).astype(np.uint8)
+        img = Image.fromarray(pixels)
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=90)
+    return buf.getvalue()
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+    return {
+        'mean_ms': round(statistics.mean(ordered), 3),
+        'min_ms': round(ordered[0], 3),
+        'p50_ms': round(percentile(50), 3),
+        'p90_ms': round(percentile(90), 3),
+        'p99_ms': round(percentile(99), 3)
+    }
+
+
+def benchmark_config(model_path, jpeg, threads, batch_size, inference_size, warmup, iterations,
+                     optimization_level, uint8_io=False):
+    """Times every stage of the upload pipeline for one configuration; `uint8_io`
+    models are fed NxHxWx3 uint8 images instead of Nx3xHxW float32 tensors."""
+    timings = {stage: [] for stage in STAGES}
+
+    for i in range(warmup + iterations):
+        record = i >= warmup
+        t = time.perf_counter()
+
+        def lap(stage):
+            nonlocal t
+            now = time.perf_counter()
+            if record:
+                timings[stage].append((now - t) * 1000)
+            t = now
+
+        img = pipeline.load_content(io.BytesIO(jpeg))
+        lap('decode')
+        original_size = img.size
+        resized = img.resize((inference_size, inference_size), Image.LANCZOS)
+        lap('resize')
+        tensor = to_model_input(resized, uint8_io)
+        if batch_size > 1:
+            tensor = np.repeat(tensor, batch_size, axis=0)
+        lap('preprocess')
+        options = make_session_options(intra_op_threads=threads, optimization_level=optimization_level)
+        session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        input_name = session.get_inputs()[0].name
+        lap('session_create')
+        stylized = session.run(None, {input_name: tensor})[0]
+        lap('run')
+        output_image = Image.fromarray(from_model_output(stylized[:1]))
+        lap('postprocess')
+        output_image = output_image.resize(original_size, Image.LANCZOS)
+        lap('upscale')
+        final_img = pipeline.enhance(output_image)
+        lap('enhance')
+        final_img.save(io.BytesIO(), 'JPEG')
+        lap('jpeg_encode')
+        final_img.save(io.BytesIO(), 'PNG')
+        lap('png_encode')
+
+    stages = {stage: summarize(samples) for stage, samples in timings.items()}
+    stages['run_per_image'] = {k: round(v / batch_size, 3) for k, v in stages['run'].items()}
+    totals = [sum(timings[stage][i] for stage in STAGES) for i in range(iterations)]
+    stages['total'] = summarize(totals)
+    return stages
+
+
+def _postprocess_worker(method, size, inference_size, iterations, queue):
+    """Runs one post-processing method in a fresh process and reports timings and peak RSS."""
+    width, height = size
+    rng = np.random.default_rng(0)
+    small = (inference_size, inference_size)
+    stylized = Image.fromarray(rng.integers(0, 256, (inference_size, inference_size, 3), dtype=np.uint8))
+    content = Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+    content_small = content.resize(small, Image.LANCZOS)
+    content_pixels = np.asarray(content)
+
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        if method == 'pil':
+            upscaled = stylized.resize(size, Image.LANCZOS)
+            pil_postprocess(upscaled, blend_alpha=0.8, content=content)
+        elif method == 'fused':
+            upscaled = np.asarray(stylized.resize(size, Image.LANCZOS))
+            fused_postprocess(upscaled, blend_alpha=0.8, content=content_pixels)
+        else:
+            pixels = fused_postprocess(np.asarray(stylized), blend_alpha=0.8, content=np.asarray(content_small))
+            Image.fromarray(pixels).resize(size, Image.LANCZOS)
+        samples.append((time.perf_counter() - start) * 1000)
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({'stats': summarize(samples), 'peak_mb': round((peak_kb - baseline_kb) / 1024, 1)})
+
+
+def compare_postprocess(size, inference_size, iterations):
+    """Upscale + sharpen + contrast + blend at `size`, PIL chain vs the fused pass.
+
+    Each method runs in its own spawned process so the peak RSS growth is its own.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    print(f"\n🧪 Post-processing {inference_size}px -> {size[0]}x{size[1]} (upscale, sharpen, contrast, blend)")
+    for method in POSTPROCESS_METHODS:
+        queue = context.Queue()
+        process = context.Process(target=_postprocess_worker, args=(method, size, inference_size, iterations, queue))
+        process.start()
+        results[method] = queue.get()
+        process.join()
+        stats = results[method]['stats']
+        print(f"  {method:<22}p50 {stats['p50_ms']:>9.2f} ms   p90 {stats['p90_ms']:>9.2f} ms"
+              f"   peak +{results[method]['peak_mb']:>7.1f} MB")
+    return results
+
+
+def compare(results, baseline_path):
+    """Prints the p50 change of every stage against a previous JSON report."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    def config_key(r):
+        return (r['model'], r['image_size'], r['inference_size'], r['threads'], r['batch_size'])
+
+    previous = {config_key(r): r for r in baseline['results']}
+    print(f"\n📊 Comparison against {baseline_path} (p50, negative is faster)")
+    for result in results:
+        old = previous.get(config_key(result))
+        if old is None:
+            continue
+        print(f"\n{result['model']} {result['image_size']}px threads={result['threads']} batch={result['batch_size']}")
+        for stage, stats in result['stages'].items():
+            if stage not in old['stages']:
+                continue
+            before, after = old['stages'][stage]['p50_ms'], stats['p50_ms']
+            change = (after - before) / before * 100 if before else 0.0
+            print(f"  {stage:<16}{before:>10.2f} ms ->{after:>10.2f} ms  {change:+6.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the stylization pipeline")
+    parser.add_argument('--styles', nargs='*', default=[],
+                        help="ONNX models to benchmark (default: a randomly initialized TransformerNet)")
+    parser.add_argument('--sizes', nargs='+', type=int, default=[512, 1024, 2048], help="input image sizes")
+    parser.add_argument('--inference-size', type=int, default=pipeline.IMAGE_SIZE)
+    parser.add_argument('--threads', nargs='+', type=int, default=[0], help="intra-op thread counts (0 = all cores)")
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1])
+    parser.add_argument('--optimization-level', default='all')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--image', default='test_image.jpg', help="photo used as input (synthetic if missing)")
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="previous JSON results to compare against")
+    parser.add_argument('--compare-postprocess', nargs=2, type=int, metavar=('WIDTH', 'HEIGHT'),
+                        help="only compare the PIL post-processing chain with the fused pass at this size "
+                             "(e.g. 3840 2160)")
+    args = parser.parse_args()
+
+    if args.compare_postprocess:
+        results = compare_postprocess(tuple(args.compare_postprocess), args.inference_size, args.iterations)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'postprocess': results}, f, indent=2)
+            print(f"\n📄 Results saved as {args.output}")
+        return
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        models = [f"{style}.onnx" if not style.endswith('.onnx') else style for style in args.styles]
+        if not models:
+            print("🎲 No models given, exporting a randomly initialized TransformerNet")
+            models = [export_random_model(work_dir)]
+
+        results = []
+        for model_path in models:
+            if not os.path.exists(model_path):
+                print(f"❌ Model not found: {model_path}")
+                continue
+            model_input = ort.InferenceSession(model_path, providers=['CPUExecutionProvider']).get_inputs()[0]
+            shape = model_input.shape
+            uint8_io = model_input.type == 'tensor(uint8)'
+            height = shape[1] if uint8_io else shape[2]
+            fixed_batch = isinstance(shape[0], int)
+            fixed_size = height if isinstance(height, int) else None
+            inference_size = fixed_size or args.inference_size
+
+            for size in args.sizes:
+                jpeg = make_input(size, args.image)
+                for threads in args.threads:
+                    for batch_size in args.batch_sizes:
+                        if fixed_batch and batch_size != shape[0]:
+                            print(f"⚠️ {model_path} has a fixed batch size, skipping batch={batch_size}")
+                            continue
+                        print(f"⏱️ {os.path.basename(model_path)} {size}px threads={threads} batch={batch_size}")
+                        stages = benchmark_config(model_path, jpeg, threads, batch_size, inference_size,
+                                                  args.warmup, args.iterations, args.optimization_level,
+                                                  uint8_io)
+                        for stage, stats in stages.items():
+                            print(f"  {stage:<16}p50 {stats['p50_ms']:>10.2f} ms   p90 {stats['p90_ms']:>10.2f} ms")
+                        results.append({
+                            'model': os.path.basename(model_path),
+                            'image_size': size,
+                            'inference_size': inference_size,
+                            'threads': threads,
+                            'batch_size': batch_size,
+                            'stages': stages
+                        })
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'onnxruntime': ort.__version__,
+            'warmup': args.warmup,
+            'iterations': args.iterations
+        },
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n📄 Results saved as {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
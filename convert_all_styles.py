@@ -1,34 +1,34 @@
+import argparse
 import torch
-from neural_style.transformer_net import TransformerNet
+import onnxruntime as ort
+from neural_style.registry import MANIFEST_FILE, load_manifest, register_model, save_external_data
+from neural_style.session_pool import make_session_options
+from neural_style.transformer_net import TransformerNet, Uint8ImageIO
 import os
 
-# Configuration for all styles
-STYLES = [
-    {'name': 'Mosaic', 'model': 'mosaic.pth', 'output': 'mosaic.onnx'},
-    {'name': 'udnie', 'model': 'udnie.pth', 'output': 'udnie.onnx'},  # You'll need this file
-    {'name': 'Rain Princess', 'model': 'rain_princess.pth', 'output': 'rain_princess.onnx'},  # You'll need this file
-    {'name': 'Candy', 'model': 'candy.pth', 'output': 'candy.onnx'}  # You'll need this file
-]
-
 IMAGE_SIZE = 1024
 
-def convert_model(model_file, output_file):
-    print(f"\n🔄 Converting {model_file} to {output_file}...")
-    
-    # Load model architecture
-    model = TransformerNet()
-    
-    # Load checkpoint
+def load_model(model_file, model_kwargs=None):
+    """Loads a TransformerNet checkpoint for export or as a distillation teacher.
+
+    The architecture comes from `model_kwargs`, else from the 'model_kwargs'
+    saved in the checkpoint (distill.py writes them), else it is the original
+    one. Returns the model in eval mode, or None if the file is missing.
+    """
     if not os.path.exists(model_file):
         print(f"❌ Model file not found: {model_file}")
-        return False
+        return None
     
     loaded = torch.load(model_file, map_location='cpu')
     if isinstance(loaded, dict) and 'state_dict' in loaded:
         state_dict = loaded['state_dict']
+        model_kwargs = model_kwargs or loaded.get('model_kwargs')
     else:
         state_dict = loaded
     
+    # Load model architecture
+    model = TransformerNet(**(model_kwargs or {}))
+    
     # Clean checkpoint (remove unsupported buffers)
     keys_to_remove = [k for k in state_dict.keys() if "running_mean" in k or "running_var" in k]
     for k in keys_to_remove:
@@ -55,9 +55,64 @@ def convert_model(model_file, output_file):
     
     # Set model to evaluation mode
     model.eval()
+    return model
+
+def optimize_offline(onnx_file, optimization_level='extended'):
+    """Rewrites `onnx_file` with onnxruntime's optimized graph (constant folding,
+    Conv+activation fusion, ...), so sessions start from the fused graph.
+
+    'extended' keeps the file portable across CPUs; 'all' adds layout changes
+    tied to the CPU that ran the optimizer.
+    """
+    tmp_file = f"{onnx_file}.optimized.tmp"
+    options = make_session_options(optimization_level=optimization_level, optimized_model_path=tmp_file)
+    try:
+        ort.InferenceSession(onnx_file, options, providers=['CPUExecutionProvider'])
+        os.replace(tmp_file, onnx_file)
+        print(f"⚡ Optimized graph ({optimization_level}) saved as {onnx_file}")
+        return True
+    except Exception as e:
+        print(f"❌ Error optimizing {onnx_file}: {str(e)}")
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        return False
+
+def convert_model(model_file, output_file, dynamic_batch=False, dynamic_shape=False, image_size=IMAGE_SIZE,
+                  model_kwargs=None, uint8_io=False, optimize=None, external_data=False):
+    """Exports a checkpoint to ONNX. With `uint8_io`, the graph takes and returns
+    NxHxWx3 uint8 images; with `optimize` (a graph optimization level), the
+    export is replaced by onnxruntime's optimized graph; with `external_data`,
+    the weights go to a memory-mappable <output_file>.data. A multi-style
+    network gets a second int64 input, 'style' (one index per image), and lists
+    its style names in the 'styles' metadata entry."""
+    print(f"\n🔄 Converting {model_file} to {output_file}...")
     
-    # Dummy input with fixed batch size
-    dummy_input = torch.randn(1, 3, IMAGE_SIZE, IMAGE_SIZE)
+    model = load_model(model_file, model_kwargs)
+    if model is None:
+        return False
+    styles = model.styles
+    
+    # Dummy input; axes can optionally be left dynamic for micro-batching and
+    # aspect-ratio-preserving inference (GroupNorm exports cleanly with dynamic H/W)
+    if uint8_io:
+        model = Uint8ImageIO(model)
+        dummy_input = torch.randint(0, 256, (1, image_size, image_size, 3), dtype=torch.uint8)
+        batch_axis, height_axis, width_axis = 0, 1, 2
+    else:
+        dummy_input = torch.randn(1, 3, image_size, image_size)
+        batch_axis, height_axis, width_axis = 0, 2, 3
+    dynamic_axes = None
+    if dynamic_shape:
+        axes = {batch_axis: 'batch', height_axis: 'height', width_axis: 'width'}
+        dynamic_axes = {'input': axes, 'output': axes}
+    elif dynamic_batch:
+        dynamic_axes = {'input': {0: 'batch'}, 'output': {0: 'batch'}}
+    input_names = ['input']
+    if styles:
+        dummy_input = (dummy_input, torch.zeros(1, dtype=torch.long))
+        input_names.append('style')
+        if dynamic_axes:
+            dynamic_axes['style'] = {0: 'batch'}
     
     # Export ONNX
     try:
@@ -68,28 +123,77 @@ def convert_model(model_file, output_file):
             export_params=True,
             opset_version=11,
             do_constant_folding=True,
-            input_names=['input'],
+            input_names=input_names,
             output_names=['output'],
-            dynamic_axes=None   # Fixed shape to avoid InstanceNorm errors
+            dynamic_axes=dynamic_axes
         )
+        if styles:
+            import onnx
+            onnx_model = onnx.load(output_file)
+            onnx.helper.set_model_props(onnx_model, {'styles': ','.join(styles)})
+            onnx.save(onnx_model, output_file)
         print(f"✅ ONNX model saved as {output_file}")
-        return True
     except Exception as e:
         print(f"❌ Error converting {model_file}: {str(e)}")
         return False
+    if optimize and not optimize_offline(output_file, optimize):
+        return False
+    if external_data:
+        print(f"🗺️ Weights saved as {save_external_data(output_file)}")
+    elif os.path.exists(f"{output_file}.data"):
+        # A stale weights file would mark the model as external
+        os.remove(f"{output_file}.data")
+    return True
 
 def main():
+    parser = argparse.ArgumentParser(description="Convert all style checkpoints to ONNX")
+    parser.add_argument('--dynamic-batch', action='store_true',
+                        help="export with a dynamic batch axis (needed for micro-batching)")
+    parser.add_argument('--dynamic-shape', action='store_true',
+                        help="export with dynamic batch, height and width axes")
+    parser.add_argument('--preview-size', type=int,
+                        help="also export a small fixed-size <style>.preview.onnx graph for fast previews")
+    parser.add_argument('--uint8-io', action='store_true',
+                        help="take and return HxWx3 uint8 images: pre/postprocessing runs inside the graph")
+    parser.add_argument('--optimize', nargs='?', const='extended', choices=['basic', 'extended', 'all'],
+                        help="save onnxruntime's optimized graph instead of the raw export (default level: extended; "
+                             "servers with a higher ORT_OPTIMIZATION_LEVEL optimize it again at load)")
+    parser.add_argument('--external-data', action='store_true',
+                        help="store the weights in a page-aligned <model>.onnx.data that servers memory-map")
+    parser.add_argument('--manifest', default=MANIFEST_FILE,
+                        help="model manifest listing the styles (and their checkpoints) to convert")
+    parser.add_argument('--register', action='store_true',
+                        help="record the converted models, with shape and checksum, in the manifest")
+    args = parser.parse_args()
+    # Not verified: the models it lists may be missing or stale, which is what this rebuilds
+    manifest = load_manifest(args.manifest, verify=False)
+    # Servers only re-optimize these at load above this level, which keeps the external weights memory-mapped
+    optimized = args.optimize if args.external_data else None
+
     print("="*60)
     print("NEURAL STYLE TRANSFER - BATCH MODEL CONVERSION")
     print("="*60)
     
     success_count = 0
-    total_count = len(STYLES)
+    total_count = len(manifest.styles)
     
-    for style in STYLES:
-        print(f"\n🎨 Processing style: {style['name']}")
-        if convert_model(style['model'], style['output']):
+    for style, name in manifest.styles.items():
+        print(f"\n🎨 Processing style: {name}")
+        checkpoint = manifest.checkpoint(style)
+        output_file = os.path.join(manifest.model_dir, f"{style}.onnx")
+        if convert_model(checkpoint, output_file, dynamic_batch=args.dynamic_batch,
+                         dynamic_shape=args.dynamic_shape, uint8_io=args.uint8_io, optimize=args.optimize,
+                         external_data=args.external_data):
             success_count += 1
+            if args.register:
+                register_model(args.manifest, style, 'fp32', output_file, name=name, checkpoint=checkpoint,
+                               optimized=optimized)
+        if args.preview_size:
+            preview_file = os.path.join(manifest.model_dir, f"{style}.preview.onnx")
+            if convert_model(checkpoint, preview_file, dynamic_batch=args.dynamic_batch,
+                             image_size=args.preview_size, uint8_io=args.uint8_io, optimize=args.optimize,
+                             external_data=args.external_data) and args.register:
+                register_model(args.manifest, style, 'preview', preview_file, optimized=optimized)
     
     print("\n" + "="*60)
     print(f"CONVERSION COMPLETE: {success_count}/{total_count} models converted successfully")
@@ -0,0 +1,194 @@
+import argparse
+import glob
+import os
+import time
+
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+from torchvision import transforms
+
+from convert_all_styles import convert_model, load_model
+from neural_style.session_pool import MULTI_STYLE_MODEL, model_name
+from neural_style.transformer_net import TransformerNet
+from neural_style.utils import gram_matrix, normalize_batch
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+class ImageFiles(Dataset):
+    """Every image under `root`, resized and center-cropped to `size`, as a 3xHxW tensor in 0-255."""
+
+    def __init__(self, root, size, limit=None):
+        self.paths = sorted(path for path in glob.glob(os.path.join(root, '**', '*'), recursive=True)
+                            if path.lower().endswith(IMAGE_EXTENSIONS))[:limit]
+        self.transform = transforms.Compose([
+            transforms.Resize(size),
+            transforms.CenterCrop(size),
+            transforms.PILToTensor()
+        ])
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        return self.transform(Image.open(self.paths[index]).convert('RGB')).float()
+
+
+def distillation_loss(student_out, teacher_out, vgg, args):
+    """Pixel loss against the teacher's output, plus (with a VGG) feature and Gram losses.
+
+    Returns (total, {name: value}) for logging.
+    """
+    losses = {'pixel': args.pixel_weight * torch.nn.functional.mse_loss(student_out / 255.0, teacher_out / 255.0)}
+    if vgg is not None:
+        # normalize_batch divides in place, so give it copies
+        student_features = vgg(normalize_batch(student_out.clone()))
+        with torch.no_grad():
+            teacher_features = vgg(normalize_batch(teacher_out.clone()))
+        losses['content'] = args.content_weight * torch.nn.functional.mse_loss(
+            student_features.relu2_2, teacher_features.relu2_2)
+        losses['style'] = args.style_weight * sum(
+            torch.nn.functional.mse_loss(gram_matrix(s), gram_matrix(t))
+            for s, t in zip(student_features, teacher_features))
+    total = sum(losses.values())
+    return total, {name: value.item() for name, value in losses.items()}
+
+
+def style_of(checkpoint):
+    """Style name of a checkpoint path, e.g. 'mosaic' for models/mosaic.pth."""
+    return os.path.splitext(os.path.basename(checkpoint))[0]
+
+
+def teach(teachers, batch, style):
+    """Teacher output for every image of `batch`; with several teachers, image i
+    goes to teachers[style[i]]."""
+    if style is None:
+        return teachers[0](batch)
+    out = torch.empty_like(batch)
+    for index in style.unique().tolist():
+        mask = style == index
+        out[mask] = teachers[index](batch[mask])
+    return out
+
+
+def distill(args):
+    """Trains a student on the teachers' outputs and saves its checkpoint.
+
+    With one teacher the student is a (slimmer) single-style TransformerNet.
+    With several, it is one multi-style network for all of them, trained on a
+    random style per image; when it has the teachers' architecture it starts
+    from their weights (see TransformerNet.init_from_models).
+    """
+    torch.manual_seed(args.seed)
+    teachers = [load_model(path) for path in args.teacher]
+    if any(teacher is None for teacher in teachers):
+        return None
+    for teacher in teachers:
+        for param in teacher.parameters():
+            param.requires_grad = False
+
+    model_kwargs = {'width_mult': args.width_mult, 'num_residual': args.num_residual, 'depthwise': args.depthwise}
+    multi_style = len(teachers) > 1
+    if multi_style:
+        model_kwargs['styles'] = [style_of(path) for path in args.teacher]
+    student = TransformerNet(**model_kwargs)
+    if multi_style:
+        try:
+            student.init_from_models(teachers)
+            print("🧬 Initialized from the teachers' weights")
+        except ValueError:
+            print("🎲 Student architecture differs from the teachers', starting from random weights")
+    teacher_params = sum(p.numel() for p in teachers[0].parameters())
+    student_params = sum(p.numel() for p in student.parameters())
+    print(f"👩‍🏫 Teacher: {teacher_params:,} parameters, student {model_kwargs}: {student_params:,} "
+          f"({student_params / teacher_params:.1%})")
+
+    vgg = None
+    if not args.no_vgg:
+        from neural_style.vgg import Vgg16
+        vgg = Vgg16(args.vgg_weights).eval()
+
+    dataset = ImageFiles(args.dataset, args.image_size, args.limit)
+    if not len(dataset):
+        print(f"❌ No images found under {args.dataset}")
+        return None
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.workers,
+                        drop_last=len(dataset) >= args.batch_size)
+    optimizer = torch.optim.Adam(student.parameters(), lr=args.lr)
+
+    print(f"📚 Distilling on {len(dataset)} images at {args.image_size}px for {args.epochs} epochs")
+    step = 0
+    started = time.time()
+    for epoch in range(args.epochs):
+        student.train()
+        for batch in loader:
+            style = torch.randint(len(teachers), (batch.shape[0],)) if multi_style else None
+            with torch.no_grad():
+                teacher_out = teach(teachers, batch, style)
+            loss, parts = distillation_loss(student(batch, style), teacher_out, vgg, args)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            step += 1
+            if step % args.log_interval == 0:
+                detail = ', '.join(f"{name} {value:.4g}" for name, value in parts.items())
+                print(f"  epoch {epoch + 1} step {step}: loss {loss.item():.4g} ({detail}), "
+                      f"{step * args.batch_size / (time.time() - started):.1f} images/s")
+
+    student.eval()
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    torch.save({'state_dict': student.state_dict(), 'model_kwargs': model_kwargs,
+                'teacher': args.teacher if multi_style else args.teacher[0]}, args.output)
+    print(f"✅ Student checkpoint saved as {args.output}")
+    return args.output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distill a style model into a slimmer TransformerNet")
+    parser.add_argument('--teacher', required=True, nargs='+',
+                        help="checkpoint of the style model to imitate, e.g. mosaic.pth; several train "
+                             "one multi-style network")
+    parser.add_argument('--dataset', required=True, help="directory of training photos (searched recursively)")
+    parser.add_argument('--output', help="student checkpoint (default: <teacher>.slim.pth, or "
+                                         f"{MULTI_STYLE_MODEL}.pth for several teachers)")
+    parser.add_argument('--width-mult', type=float, default=0.5, help="scale of every channel count")
+    parser.add_argument('--num-residual', type=int, default=2, help="residual blocks (the teacher has 5)")
+    parser.add_argument('--depthwise', action='store_true', help="use depthwise-separable convolutions")
+    parser.add_argument('--image-size', type=int, default=256, help="training crop size")
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--limit', type=int, help="use at most this many images")
+    parser.add_argument('--workers', type=int, default=2, help="data loading processes")
+    parser.add_argument('--pixel-weight', type=float, default=1.0)
+    parser.add_argument('--content-weight', type=float, default=1.0, help="relu2_2 feature loss weight")
+    parser.add_argument('--style-weight', type=float, default=1e5, help="Gram matrix loss weight")
+    parser.add_argument('--no-vgg', action='store_true', help="pixel loss only (no VGG-16 download needed)")
+    parser.add_argument('--vgg-weights', help="local torchvision vgg16 state dict instead of the download")
+    parser.add_argument('--log-interval', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--export', action='store_true',
+                        help="also export the student next to its checkpoint (<output> with .onnx) "
+                             "through convert_all_styles.convert_model")
+    parser.add_argument('--dynamic-shape', action='store_true', help="export with dynamic batch, height and width")
+    parser.add_argument('--uint8-io', action='store_true', help="export with uint8 image input and output")
+    parser.add_argument('--optimize', nargs='?', const='extended', choices=['basic', 'extended', 'all'],
+                        help="export onnxruntime's optimized graph")
+    args = parser.parse_args()
+
+    if len(args.teacher) > 1:
+        stem = MULTI_STYLE_MODEL
+    else:
+        stem = model_name(style_of(args.teacher[0]), 'slim')
+    folder = os.path.dirname(args.teacher[0])
+    args.output = args.output or os.path.join(folder, f"{stem}.pth")
+    checkpoint = distill(args)
+    if checkpoint and args.export:
+        onnx_file = f"{os.path.splitext(checkpoint)[0]}.onnx"
+        convert_model(checkpoint, onnx_file, dynamic_shape=args.dynamic_shape, uint8_io=args.uint8_io,
+                      optimize=args.optimize)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+# gunicorn settings for the web app (picked up automatically from the working directory)
+import os
+
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Import the app (and read the model files, see PRELOAD_MODELS) once in the master;
+# forked workers share those pages copy-on-write
+preload_app = True
+
+# Warming every model at every WARMUP_SIZES size can take a while on small machines
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+
+def post_worker_init(worker):
+    # onnxruntime sessions are not fork-safe, so each worker builds and warms its own
+    # here, before it accepts its first connection
+    from web_interface import warm_up
+    warm_up()
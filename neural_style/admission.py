@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from neural_style import metrics
+
+# Peak onnxruntime memory per inference pixel, measured on the exported TransformerNet
+# models (onnxruntime 1.20, CPU). The quantized graphs keep far larger intermediates.
+ACTIVATION_BYTES_PER_PIXEL = {
+    'fp32': 750,
+    'fp16': 800,
+    'int8-dynamic': 3800,
+    'int8-static': 3500,
+    'slim': 370,   # 0.5x width, 2 residual blocks (distill.py defaults)
+    'multi': 750   # full-size multi-style network: fp32 activations, the style tables are tiny
+}
+
+
+class Overloaded(Exception):
+    """Raised when a request cannot be admitted: the wait queue is full or the wait timed out."""
+
+
+def activation_bytes_per_pixel(model):
+    """Activation estimate for a session pool key such as 'mosaic' or 'mosaic.int8-static'."""
+    variant = model.rsplit('.', 1)[-1]
+    return ACTIVATION_BYTES_PER_PIXEL.get(variant, ACTIVATION_BYTES_PER_PIXEL['fp32'])
+
+
+def estimate_bytes(decoded_size, target, models, output_size=None, formats=1, upload_bytes=0, tile_pixels=None):
+    """Rough peak memory of stylizing one image with each of `models`.
+
+    Counts the upload, the decoded image at `decoded_size`, its resized copy and
+    input tensor at `target`, and per model onnxruntime's activations, the
+    output tensor, the result at `output_size` with its postprocess buffers and
+    `formats` encoded copies. With `tile_pixels` (pixels per tiled run), the
+    model runs on tiles while the tensors cover the whole image.
+    """
+    pixels = decoded_size[0] * decoded_size[1]
+    target_pixels = target[0] * target[1]
+    output_pixels = output_size[0] * output_size[1] if output_size else pixels
+    run_pixels = tile_pixels or target_pixels
+    total = upload_bytes + pixels * 3 + target_pixels * (3 + 12)
+    for model in models:
+        total += run_pixels * (activation_bytes_per_pixel(model) + 12)
+        if tile_pixels:
+            total += target_pixels * (12 + 4)   # blended output and weight sum
+        total += output_pixels * 3 * (3 + formats)
+    return total
+
+
+class AdmissionController:
+    """Admits work while the sum of its estimated peak memory fits in `budget_bytes`.
+
+    Requests that don't fit wait in FIFO order, at most `max_queue` of them and
+    for at most `timeout` seconds; beyond that admit() raises Overloaded. A
+    request larger than the whole budget still runs once nothing else does, so
+    it can't wait forever. resolution_scale() tells callers how much to shrink
+    the inference pixel count while the queue is deep.
+    """
+
+    def __init__(self, budget_bytes, max_queue=8, timeout=10.0, degrade_depth=2, min_scale=0.25):
+        self.budget_bytes = budget_bytes
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.degrade_depth = degrade_depth
+        self.min_scale = min_scale
+        self.in_use = 0
+        self._cond = threading.Condition()
+        self._waiting = deque()
+
+    @property
+    def queue_depth(self):
+        return len(self._waiting)
+
+    def resolution_scale(self):
+        """Factor for the inference pixel count: halved for every `degrade_depth`
+        waiting requests, down to `min_scale`; 1.0 when the queue is short."""
+        if not self.degrade_depth:
+            return 1.0
+        return max(self.min_scale, 0.5 ** (len(self._waiting) // self.degrade_depth))
+
+    def _fits(self, nbytes):
+        return self.in_use == 0 or self.in_use + nbytes <= self.budget_bytes
+
+    @contextmanager
+    def admit(self, nbytes):
+        """Reserves `nbytes` for the duration of the block, waiting for room if needed."""
+        with self._cond:
+            if not self._waiting and self._fits(nbytes):
+                metrics.ADMISSIONS.inc(result='admitted')
+            elif len(self._waiting) >= self.max_queue:
+                metrics.ADMISSIONS.inc(result='rejected')
+                raise Overloaded(f"{len(self._waiting)} requests already waiting for memory")
+            else:
+                ticket = object()
+                self._waiting.append(ticket)
+                deadline = time.monotonic() + self.timeout
+                try:
+                    admitted = self._cond.wait_for(
+                        lambda: self._waiting[0] is ticket and self._fits(nbytes),
+                        max(0.0, deadline - time.monotonic()))
+                finally:
+                    self._waiting.remove(ticket)
+                    self._cond.notify_all()
+                if not admitted:
+                    metrics.ADMISSIONS.inc(result='timeout')
+                    raise Overloaded(f"No memory for {nbytes // (1024 * 1024)} MB within {self.timeout}s")
+                metrics.ADMISSIONS.inc(result='queued')
+            self.in_use += nbytes
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_use -= nbytes
+                self._cond.notify_all()
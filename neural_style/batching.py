@@ -0,0 +1,98 @@
+import threading
+
+import numpy as np
+
+from neural_style import metrics
+from neural_style.session_pool import run_session
+
+
+class _Batch:
+    def __init__(self):
+        self.inputs = []
+        self.style_indices = []
+        self.outputs = None
+        self.error = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class BatchScheduler:
+    """Coalesces concurrent single-image runs of the same style into one batched run.
+
+    The first caller for a (style, shape) opens a batch and waits up to `window_ms`
+    for more callers to join; the batch is closed early once it holds `max_batch`
+    inputs. The leader then runs the stacked NCHW tensor on a pooled session and
+    every caller gets its own slice of the output back. Models exported without a
+    dynamic batch axis are still served, one input at a time. Models exported
+    with uint8 image I/O take either their own NxHxWx3 uint8 input or a float
+    NCHW tensor (e.g. tiles), and answer in the layout they were given. The
+    styles served by the multi-style network share one batch, each image
+    carrying its own style index.
+    """
+
+    def __init__(self, session_pool, window_ms=10, max_batch=4):
+        self.session_pool = session_pool
+        self.window = window_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+        self._lock = threading.Lock()
+        self._open = {}
+
+    def run(self, style, tensor):
+        """Runs an NxCxHxW float32 tensor (or a uint8 model's NxHxWx3 images) through
+        `style` and returns the output.
+
+        Only single-image inputs are coalesced; inputs that are already batched
+        (e.g. tiles) are run directly.
+        """
+        model, style_index = self.session_pool.route(style)
+        if self.max_batch == 1 or self.window <= 0 or tensor.shape[0] != 1:
+            return self._run_session(model, tensor, style_index)
+
+        key = (model, tensor.shape, tensor.dtype)
+        with self._lock:
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = _Batch()
+                self._open[key] = batch
+            index = len(batch.inputs)
+            batch.inputs.append(tensor)
+            batch.style_indices.append(style_index)
+            if len(batch.inputs) >= self.max_batch:
+                del self._open[key]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._open.get(key) is batch:
+                    del self._open[key]
+            self._execute(model, batch)
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.outputs[index:index + 1]
+
+    def _execute(self, model, batch):
+        try:
+            if len(batch.inputs) == 1:
+                batch.outputs = self._run_session(model, batch.inputs[0], batch.style_indices[0])
+            else:
+                style_indices = None if batch.style_indices[0] is None else batch.style_indices
+                batch.outputs = self._run_session(model, np.concatenate(batch.inputs, axis=0), style_indices)
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+    def _run_session(self, model, tensor, style_index=None):
+        with self.session_pool.session(model) as ort_session:
+            metrics.BATCH_SIZE.observe(tensor.shape[0], style=model)
+            metrics.INFLIGHT_INFERENCES.inc(style=model)
+            try:
+                with metrics.span('inference', style=model):
+                    return run_session(ort_session, tensor, style_index)
+            finally:
+                metrics.INFLIGHT_INFERENCES.dec(style=model)
@@ -0,0 +1,120 @@
+import io
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from neural_style import metrics
+
+# Formats results can be encoded to on request
+ENCODE_FORMATS = {'jpg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP'}
+
+# The one artifact stored per result, and the PNG download: lossless, and at zlib level 1
+# about a third of the raw pixels (a 4K result takes ~0.5 s and ~9 MB instead of 25 MB)
+CANONICAL_EXT = 'png'
+CANONICAL_OPTIONS = {'compress_level': 1}
+
+# Options of the formats encoded from the canonical artifact on request
+DEFAULT_ENCODE_OPTIONS = {
+    'jpg': {'quality': 75, 'progressive': False, 'optimize': False},
+    'webp': {'quality': 80, 'method': 4}
+}
+
+
+def to_canonical(img):
+    """PIL image -> bytes of the canonical PNG."""
+    return encode_image(img, CANONICAL_EXT, CANONICAL_OPTIONS)
+
+
+def from_canonical(data):
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img
+
+
+def encode_image(img, ext, options=None):
+    """Encodes a PIL image as `ext` with the given PIL save options."""
+    buf = io.BytesIO()
+    img.save(buf, ENCODE_FORMATS[ext], **(options or {}))
+    return buf.getvalue()
+
+
+class OutputEncoder:
+    """Serves result files, encoding them from the canonical artifact on first request.
+
+    A result is stored once as `<prefix><key>.png` in the ResultCache, which is
+    also its PNG download. Asking for `<prefix><key>.jpg` (or `.webp`, or
+    `.q<quality>.jpg` for another JPEG quality) encodes it on a pool of
+    `max_workers` threads and stores the file in the cache, where it is served
+    from afterwards. Concurrent requests for the same file share one encode.
+    """
+
+    def __init__(self, cache, max_workers=2, options=None):
+        self.cache = cache
+        self.options = {ext: dict(defaults, **(options or {}).get(ext, {}))
+                        for ext, defaults in DEFAULT_ENCODE_OPTIONS.items()}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='encode')
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._name = re.compile(re.escape(cache.prefix) + r'([0-9a-f]{32})\.(?:q(\d{1,3})\.)?(\w+)')
+
+    def path(self, filename):
+        """Path of a result file in the cache folder, encoding it first if needed;
+        None if there is no such result."""
+        match = self._name.fullmatch(filename)
+        if match is None:
+            return None
+        path = os.path.join(self.cache.folder, filename)
+        if os.path.exists(path):
+            metrics.CACHE_LOOKUPS.inc(cache='encoded', result='disk')
+            return path
+        key, quality, ext = match.groups()
+        suffix = filename[len(self.cache.filename(key, '')):]
+        data = self.cache.read(filename)
+        if data is not None:
+            # Swept from disk while still hot in memory: write it back
+            metrics.CACHE_LOOKUPS.inc(cache='encoded', result='memory')
+            self.cache.put(key, {suffix: data})
+            return path
+
+        if ext not in self.options or (quality is not None and ext != 'jpg'):
+            return None
+        canonical = os.path.join(self.cache.folder, self.cache.filename(key, CANONICAL_EXT))
+        if not os.path.exists(canonical):
+            return None
+        metrics.CACHE_LOOKUPS.inc(cache='encoded', result='miss')
+
+        with self._lock:
+            future = self._pending.get(filename)
+            started = future is None
+            if started:
+                options = dict(self.options[ext])
+                if quality is not None:
+                    options['quality'] = max(1, min(95, int(quality)))
+                future = self._executor.submit(self._encode, canonical, key, suffix, ext, options)
+                self._pending[filename] = future
+        if started:
+            # Outside the lock: the callback runs right here if the encode already finished
+            future.add_done_callback(lambda f: self._forget(filename))
+        try:
+            future.result()
+        except FileNotFoundError:
+            return None   # the canonical artifact was swept in the meantime
+        return path
+
+    def _forget(self, filename):
+        with self._lock:
+            self._pending.pop(filename, None)
+
+    def _encode(self, canonical, key, suffix, ext, options):
+        with open(canonical, 'rb') as f:
+            img = from_canonical(f.read())
+        with metrics.span(f'encode_{ext}'):
+            data = encode_image(img, ext, options)
+        self.cache.put(key, {suffix: data})
+        return data
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
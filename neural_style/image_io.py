@@ -0,0 +1,76 @@
+import threading
+
+import numpy as np
+from PIL import Image
+
+# Input buffers up to this many pixels are kept per thread and reused between calls
+MAX_REUSED_PIXELS = 1024 * 1024
+
+_local = threading.local()
+
+
+def _input_buffer(height, width):
+    shape = (1, 3, height, width)
+    if height * width > MAX_REUSED_PIXELS:
+        return np.empty(shape, dtype=np.float32)
+    buf = getattr(_local, 'input_buffer', None)
+    if buf is None or buf.shape != shape:
+        buf = np.empty(shape, dtype=np.float32)
+        _local.input_buffer = buf
+    return buf
+
+
+def to_nchw(img, out=None):
+    """uint8 HxWx3 image (PIL or array) -> 1x3xHxW float32 in 0-255, in one pass.
+
+    Without `out`, the result is written into a buffer owned by the calling thread
+    and reused by its next call, so don't hold on to it across calls.
+    """
+    pixels = np.asarray(img)
+    height, width = pixels.shape[:2]
+    if out is None:
+        out = _input_buffer(height, width)
+    np.copyto(out[0], pixels.transpose(2, 0, 1), casting='unsafe')
+    return out
+
+
+def from_nchw(output, out=None):
+    """1x3xHxW (or 3xHxW) model output -> clamped uint8 HxWx3 array, in one pass."""
+    chw = output[0] if output.ndim == 4 else output
+    hwc = chw.transpose(1, 2, 0)
+    if out is None:
+        out = np.empty(hwc.shape, dtype=np.uint8)
+    np.clip(hwc, 0, 255, out=out, casting='unsafe')
+    return out
+
+
+def to_pil(output):
+    """1x3xHxW model output -> PIL image."""
+    return Image.fromarray(from_nchw(output))
+
+
+def to_model_input(img, uint8=False, out=None):
+    """Model input for an image: for models exported with uint8 image I/O, the
+    1xHxWx3 uint8 pixels themselves (no copy), else to_nchw(img, out)."""
+    if uint8:
+        return np.asarray(img)[np.newaxis]
+    return to_nchw(img, out)
+
+
+def from_model_output(output, out=None):
+    """Model output -> uint8 HxWx3: uint8 outputs are used as they are, float ones go through from_nchw."""
+    if output.dtype == np.uint8:
+        return output[0] if output.ndim == 4 else output
+    return from_nchw(output, out)
+
+
+def nchw_to_nhwc_uint8(tensor):
+    """Nx3xHxW float32 batch -> clamped NxHxWx3 uint8, for feeding float tensors to a uint8 model."""
+    out = np.empty((tensor.shape[0],) + tensor.shape[2:] + (3,), dtype=np.uint8)
+    np.clip(tensor.transpose(0, 2, 3, 1), 0, 255, out=out, casting='unsafe')
+    return out
+
+
+def nhwc_uint8_to_nchw(tensor):
+    """NxHxWx3 uint8 batch -> Nx3xHxW float32, the layout float models return."""
+    return np.ascontiguousarray(tensor.transpose(0, 3, 1, 2), dtype=np.float32)
@@ -0,0 +1,36 @@
+import numpy as np
+
+
+def psnr(reference, test, data_range=255.0):
+    """Peak signal-to-noise ratio in dB between two images of the same shape."""
+    mse = np.mean((reference.astype(np.float64) - test.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float('inf')
+    return float(10 * np.log10(data_range ** 2 / mse))
+
+
+def _box_mean(x, window):
+    # Mean over every window x window patch using a summed-area table
+    s = np.cumsum(np.cumsum(x, axis=0), axis=1)
+    s = np.pad(s, ((1, 0), (1, 0)))
+    total = s[window:, window:] - s[:-window, window:] - s[window:, :-window] + s[:-window, :-window]
+    return total / (window * window)
+
+
+def ssim(reference, test, data_range=255.0, window=7):
+    """Mean structural similarity of two HxW or HxWxC images (uniform window)."""
+    reference = reference.astype(np.float64)
+    test = test.astype(np.float64)
+    if reference.ndim == 3:
+        return float(np.mean([ssim(reference[..., c], test[..., c], data_range, window)
+                              for c in range(reference.shape[2])]))
+
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+    mu_x = _box_mean(reference, window)
+    mu_y = _box_mean(test, window)
+    var_x = _box_mean(reference * reference, window) - mu_x ** 2
+    var_y = _box_mean(test * test, window) - mu_y ** 2
+    cov = _box_mean(reference * test, window) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (var_x + var_y + c2))
+    return float(ssim_map.mean())
@@ -0,0 +1,134 @@
+import numpy as np
+
+from neural_style import metrics
+from neural_style.image_io import from_model_output, to_model_input
+
+# Patches (tile_size + 2 * halo pixels a side) go through two stride-2 stages,
+# so their side must be a multiple of this for the output to match the input
+PATCH_MULTIPLE = 4
+
+
+def check_patch_size(tile_size, halo):
+    """Raises ValueError unless cells of `tile_size` with `halo` pixels of context make valid patches."""
+    if tile_size < 1 or halo < 0 or (tile_size + 2 * halo) % PATCH_MULTIPLE:
+        raise ValueError(f"tile size + 2 * halo must be a positive multiple of {PATCH_MULTIPLE}, "
+                         f"got {tile_size} + 2 * {halo}")
+
+
+def _ramp(start, stop, core_start, core_stop, blend):
+    """1D blend weights over [start, stop): 1 on the core, falling linearly to 0 over `blend` pixels."""
+    positions = np.arange(start, stop)
+    distance = np.maximum(core_start - positions, positions - (core_stop - 1)).clip(min=0)
+    return (1 - distance / (blend + 1)).astype(np.float32)
+
+
+class IncrementalStylizer:
+    """Restylizes only the parts of a frame that changed since the previous one.
+
+    Frames are split into a grid of `tile_size` cells and compared, per cell,
+    with the input the cached output was made from. Cells whose mean absolute
+    difference exceeds `threshold` (0-255 per channel) run through `run_model`
+    in batches of `batch_size`, each with `halo` pixels of context on every
+    side. Their output is written onto the cached frame together with a `blend`
+    pixel margin, feather-blended into the neighbours whose output the change
+    also affects. When the changed cells would cost more than the whole frame,
+    the whole frame is run instead.
+
+    `run_model` takes an Nx3xHxW float32 array (or, with `uint8_io`, NxHxWx3
+    uint8 pixels) of any size, so the model needs a dynamic shape. Like tiled
+    inference, patches normalize over their own pixels, so a restylized cell can
+    differ slightly in tone from a full-frame run; the blend hides the seam.
+    tile_size + 2 * halo must be a multiple of PATCH_MULTIPLE (see check_patch_size).
+    """
+
+    def __init__(self, run_model, tile_size=64, halo=32, threshold=2.0, blend=16, batch_size=8, uint8_io=False):
+        check_patch_size(tile_size, halo)
+        self.run_model = run_model
+        self.tile_size = tile_size
+        self.halo = halo
+        self.threshold = threshold
+        self.blend = min(blend, halo)
+        self.batch_size = batch_size
+        self.uint8_io = uint8_io
+        self.reused = 0
+        self.rerun = 0
+        self._reference = None   # input pixels each cell of the cached output was made from
+        self._output = None
+
+    @property
+    def reuse_ratio(self):
+        """Fraction of all cells so far whose output was reused."""
+        total = self.reused + self.rerun
+        return self.reused / total if total else 0.0
+
+    def reset(self):
+        self._reference = self._output = None
+
+    def stylize(self, pixels):
+        """HxWx3 uint8 frame -> stylized HxWx3 uint8 pixels (a new array every call)."""
+        pixels = np.asarray(pixels)
+        height, width = pixels.shape[:2]
+        rows, cols = -(-height // self.tile_size), -(-width // self.tile_size)
+        patch = self.tile_size + 2 * self.halo
+        if self._reference is None or self._reference.shape != pixels.shape or height < patch or width < patch:
+            return self._full(pixels, rows * cols)
+
+        changed = self._changed_cells(pixels, rows, cols)
+        if len(changed) * patch * patch >= height * width:
+            return self._full(pixels, rows * cols)
+
+        output = self._output.copy()
+        for start in range(0, len(changed), self.batch_size):
+            self._rerun(pixels, output, changed[start:start + self.batch_size], patch)
+        self._output = output
+        self._count(rows * cols - len(changed), len(changed))
+        return output
+
+    def _full(self, pixels, cells):
+        with metrics.span('incremental_full'):
+            output = from_model_output(self.run_model(to_model_input(pixels, self.uint8_io)))
+        self._reference = pixels.copy()
+        self._output = output
+        self._count(0, cells)
+        return output
+
+    def _changed_cells(self, pixels, rows, cols):
+        """(y, x) origins of the cells to rerun, in row-major order."""
+        diff = np.abs(pixels.astype(np.int16) - self._reference).sum(axis=2, dtype=np.int32)
+        ys = np.arange(rows) * self.tile_size
+        xs = np.arange(cols) * self.tile_size
+        sums = np.add.reduceat(np.add.reduceat(diff, ys, axis=0), xs, axis=1)
+        areas = np.outer(np.diff(np.append(ys, pixels.shape[0])), np.diff(np.append(xs, pixels.shape[1])))
+        changed = sums > self.threshold * 3 * areas
+        return [(ys[i], xs[j]) for i, j in zip(*np.nonzero(changed))]
+
+    def _rerun(self, pixels, output, cells, patch):
+        height, width = pixels.shape[:2]
+        origins = [(min(max(0, y - self.halo), height - patch), min(max(0, x - self.halo), width - patch))
+                   for y, x in cells]
+        patches = np.stack([pixels[py:py + patch, px:px + patch] for py, px in origins])
+        with metrics.span('incremental_tiles'):
+            if self.uint8_io:
+                stylized = self.run_model(patches).astype(np.float32)
+            else:
+                model_input = np.ascontiguousarray(patches.transpose(0, 3, 1, 2), dtype=np.float32)
+                stylized = self.run_model(model_input).transpose(0, 2, 3, 1)
+
+        for (y, x), (py, px), tile in zip(cells, origins, stylized):
+            core_h = min(self.tile_size, height - y)
+            core_w = min(self.tile_size, width - x)
+            # Core plus the blend margin, kept inside the patch (and so the frame)
+            y0, y1 = max(y - self.blend, py), min(y + core_h + self.blend, py + patch)
+            x0, x1 = max(x - self.blend, px), min(x + core_w + self.blend, px + patch)
+            weights = np.outer(_ramp(y0, y1, y, y + core_h, self.blend),
+                               _ramp(x0, x1, x, x + core_w, self.blend))[:, :, np.newaxis]
+            new = tile[y0 - py:y1 - py, x0 - px:x1 - px]
+            old = output[y0:y1, x0:x1]
+            np.clip(new * weights + old * (1 - weights), 0, 255, out=old, casting='unsafe')
+            self._reference[y:y + core_h, x:x + core_w] = pixels[y:y + core_h, x:x + core_w]
+
+    def _count(self, reused, rerun):
+        self.reused += reused
+        self.rerun += rerun
+        metrics.INCREMENTAL_TILES.inc(reused, result='reused')
+        metrics.INCREMENTAL_TILES.inc(rerun, result='rerun')
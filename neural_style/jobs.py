@@ -0,0 +1,161 @@
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from neural_style import metrics
+
+FINISHED_STATES = ('done', 'error')
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the worker pool is saturated."""
+
+
+def _write_status(job_folder, job_id, status):
+    # Write then rename, so readers in other gunicorn workers never see a partial file
+    path = os.path.join(job_folder, f"{job_id}.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, path)
+
+
+def _run_job(job_folder, job_id, fn, args):
+    """Runs in the worker process and records the job's progress on disk.
+
+    Returns (status, spans): the timing spans recorded while running, for the
+    submitting process to add to its own metrics.
+    """
+    started = time.time()
+    _write_status(job_folder, job_id, {'job_id': job_id, 'status': 'running', 'started': started})
+    with metrics.recording() as spans:
+        try:
+            result = fn(*args)
+        except Exception as e:
+            _write_status(job_folder, job_id, {'job_id': job_id, 'status': 'error', 'error': str(e)})
+            return 'error', spans
+    _write_status(job_folder, job_id, {
+        'job_id': job_id,
+        'status': 'done',
+        'result': result,
+        'seconds': round(time.time() - started, 3)
+    })
+    return 'done', spans
+
+
+class JobManager:
+    """Bounded process pool for long-running stylization jobs.
+
+    Job status lives in JSON files under `job_folder`, so any gunicorn worker can
+    answer a status poll. At most `max_pending` jobs may be queued or running per
+    manager; submit() raises QueueFull beyond that. The process pool is started on
+    first use, with the spawn start method: the web worker that starts it runs
+    threads and holds onnxruntime sessions, which a forked child would inherit
+    in whatever state (locks held, thread pools gone) they were at the fork.
+    """
+
+    def __init__(self, job_folder, max_workers=2, max_pending=8, initializer=None, initargs=(),
+                 ttl=3600):
+        self.job_folder = job_folder
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.initializer = initializer
+        self.initargs = initargs
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._executor = None
+        self._last_sweep = 0
+        os.makedirs(job_folder, exist_ok=True)
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=self.initializer,
+                                                 initargs=self.initargs)
+        return self._executor
+
+    def submit(self, fn, *args, on_finished=None):
+        """Queues fn(*args) on the pool and returns the new job id. `on_finished`,
+        if given, is called once the job is over, however it ended; not when
+        QueueFull is raised."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFull(f"{self._pending} jobs already pending")
+            self._pending += 1
+            executor = self._get_executor()
+
+        self._sweep()
+        job_id = uuid.uuid4().hex
+        _write_status(self.job_folder, job_id, {'job_id': job_id, 'status': 'queued'})
+        try:
+            future = executor.submit(_run_job, self.job_folder, job_id, fn, args)
+        except Exception:
+            self._job_finished(None, on_finished)
+            raise
+
+        def on_done(f):
+            self._job_finished(f, on_finished)
+            if f.exception() is not None:
+                # The worker process died before it could record the failure
+                _write_status(self.job_folder, job_id,
+                              {'job_id': job_id, 'status': 'error', 'error': str(f.exception())})
+                metrics.JOBS.inc(status='crashed')
+                return
+            status, spans = f.result()
+            metrics.JOBS.inc(status=status)
+            metrics.replay(spans)
+
+        future.add_done_callback(on_done)
+        return job_id
+
+    def complete(self, result):
+        """Records an already finished job (e.g. a cache hit) and returns its id."""
+        job_id = uuid.uuid4().hex
+        _write_status(self.job_folder, job_id,
+                      {'job_id': job_id, 'status': 'done', 'result': result, 'seconds': 0})
+        return job_id
+
+    def _job_finished(self, future, on_finished=None):
+        with self._lock:
+            self._pending -= 1
+        if on_finished is not None:
+            on_finished()
+
+    def _sweep(self):
+        """Deletes status files older than the TTL, at most once a minute."""
+        now = time.time()
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        for entry in os.scandir(self.job_folder):
+            try:
+                if now - entry.stat().st_mtime > self.ttl:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def status(self, job_id):
+        """Returns the job's status dict, or None for an unknown id."""
+        if not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        path = os.path.join(self.job_folder, f"{job_id}.json")
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,211 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a fast resize up to a slow high-resolution run
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names, values, extra=()):
+    # Unset labels are left off (e.g. no style on the decode of a multi-style request)
+    pairs = [(name, value) for name, value in list(zip(names, values)) + list(extra) if value != '']
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    """Base of the metric types: a value per combination of label values."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        """[(suffix, label values, extra labels, value)] in exposition order."""
+        with self._lock:
+            return [('', key, (), value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down; with `function`, it is read when rendered."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.function is not None:
+            return [('', (), (), self.function())]
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append(('_bucket', key, (('le', le),), cumulative))
+                samples.append(('_sum', key, (), total))
+                samples.append(('_count', key, (), count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric already registered: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'nst_stage_seconds', 'Time spent in each stage of the stylization pipeline', ('stage', 'style')))
+INFLIGHT_INFERENCES = REGISTRY.register(Gauge(
+    'nst_inflight_inferences', 'onnxruntime runs in progress', ('style',)))
+BATCH_SIZE = REGISTRY.register(Histogram(
+    'nst_batch_size', 'Images per onnxruntime run', ('style',), buckets=(1, 2, 4, 8, 16, 32)))
+REQUESTS = REGISTRY.register(Counter(
+    'nst_requests_total', 'HTTP requests by endpoint and status code', ('endpoint', 'status')))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'nst_request_seconds', 'HTTP request latency by endpoint', ('endpoint',)))
+ERRORS = REGISTRY.register(Counter(
+    'nst_errors_total', 'Errors by where they happened and exception type', ('where', 'type')))
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    'nst_cache_lookups_total', 'Result cache lookups by outcome', ('cache', 'result')))
+ADMISSIONS = REGISTRY.register(Counter(
+    'nst_admissions_total', 'Admission control decisions', ('result',)))
+JOBS = REGISTRY.register(Counter(
+    'nst_jobs_total', 'Background jobs by final status', ('status',)))
+INCREMENTAL_TILES = REGISTRY.register(Counter(
+    'nst_incremental_tiles_total', 'Frame cells of incremental stylization, reused or rerun', ('result',)))
+
+_context = threading.local()
+
+
+@contextmanager
+def labels(**values):
+    """Default labels (e.g. style) for the spans recorded by this thread inside the block."""
+    previous = getattr(_context, 'labels', {})
+    _context.labels = dict(previous, **values)
+    try:
+        yield
+    finally:
+        _context.labels = previous
+
+
+def current_labels():
+    return dict(getattr(_context, 'labels', {}))
+
+
+@contextmanager
+def recording():
+    """Also collects the spans this thread records in the block, as a list of
+    (stage, labels, seconds), so a worker process can hand them to replay()."""
+    previous = getattr(_context, 'recorded', None)
+    spans = _context.recorded = []
+    try:
+        yield spans
+    finally:
+        _context.recorded = previous
+
+
+def replay(spans):
+    for stage, values, seconds in spans:
+        STAGE_SECONDS.observe(seconds, stage=stage, **values)
+
+
+@contextmanager
+def span(stage, **values):
+    """Times the block into nst_stage_seconds{stage, style}."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        values = dict(current_labels(), **values)
+        STAGE_SECONDS.observe(seconds, stage=stage, **values)
+        recorded = getattr(_context, 'recorded', None)
+        if recorded is not None:
+            recorded.append((stage, values, seconds))
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,286 @@
+import io
+import math
+
+import numpy as np
+from PIL import Image
+
+from neural_style import metrics
+from neural_style.batching import BatchScheduler
+from neural_style.encoding import CANONICAL_EXT, to_canonical
+from neural_style.image_io import from_model_output, to_model_input, to_nchw
+from neural_style.postprocess import fused_postprocess
+from neural_style.registry import ModelRegistry
+from neural_style.result_cache import ResultCache
+from neural_style.session_pool import SessionPool
+from neural_style.tiling import stylize_tiled
+
+IMAGE_SIZE = 1024
+MAX_PIXELS = IMAGE_SIZE * IMAGE_SIZE
+RESIZE_MODES = ('square', 'aspect')
+OUTPUT_FORMATS = {'jpg': 'JPEG', 'png': 'PNG'}
+
+# Everything that changes the output for a given input and style (part of the cache key)
+DEFAULT_PARAMS = {
+    'image_size': IMAGE_SIZE,
+    'resize_mode': 'square',
+    'max_pixels': MAX_PIXELS,
+    'sharpen': True,
+    'contrast': 1.2,
+    'blend_alpha': None,
+    'tiled': False,
+    'tile_size': IMAGE_SIZE,
+    'tile_overlap': 64,
+    'enhance_before_upscale': False
+}
+
+def load_content(path):
+    """Decodes an image from a path or file-like object."""
+    return Image.open(path).convert("RGB")
+
+
+def decode_upload(source, image_size=IMAGE_SIZE, resize_mode='square', max_pixels=MAX_PIXELS, tiled=False,
+                  **params):
+    """Decodes an upload for stylize_image; returns (img, original_size).
+
+    When the model runs at a smaller size than the upload, JPEGs are decoded
+    with DCT scaling (Image.draft) at 1/2, 1/4 or 1/8 of their size, but never
+    below the inference size, so large phone photos skip most of the decode.
+    Tiled inference needs every pixel and always decodes in full.
+    """
+    with metrics.span('decode'):
+        img = Image.open(source)
+        original_size = img.size
+        _draft(img, resize_mode, image_size, max_pixels, tiled)
+        return img.convert("RGB"), original_size
+
+
+def probe_upload(source, image_size=IMAGE_SIZE, resize_mode='square', max_pixels=MAX_PIXELS, tiled=False,
+                 **params):
+    """(original size, size decode_upload will decode at) from the image header alone."""
+    img = Image.open(source)
+    original_size = img.size
+    _draft(img, resize_mode, image_size, max_pixels, tiled)
+    return original_size, img.size
+
+
+def _draft(img, resize_mode, image_size, max_pixels, tiled):
+    if not tiled:
+        target = inference_size(img.size, resize_mode, image_size, max_pixels)
+        if target[0] < img.size[0] and target[1] < img.size[1]:
+            img.draft('RGB', target)
+
+
+def enhance(img, sharpen=True, contrast=1.2, blend_alpha=None, content=None):
+    """Applies sharpening, contrast enhancement and optional blending with `content`."""
+    if not sharpen and contrast == 1.0 and blend_alpha is None:
+        return img
+    pixels = fused_postprocess(np.asarray(img), sharpen, contrast, blend_alpha,
+                               None if content is None else np.asarray(content))
+    return Image.fromarray(pixels)
+
+
+def fit_to_budget(size, max_pixels=MAX_PIXELS, multiple=4):
+    """Largest (width, height) with the same aspect ratio as `size` that fits in
+    `max_pixels`, rounded down to a multiple of `multiple`. Never upscales."""
+    width, height = size
+    scale = min(1.0, math.sqrt(max_pixels / float(width * height)))
+    return (max(multiple, int(width * scale) // multiple * multiple),
+            max(multiple, int(height * scale) // multiple * multiple))
+
+
+def inference_size(size, resize_mode='square', image_size=IMAGE_SIZE, max_pixels=MAX_PIXELS):
+    """Size the model runs at for an image of `size`."""
+    if resize_mode == 'aspect':
+        return fit_to_budget(size, max_pixels)
+    return (image_size, image_size)
+
+
+def stylize_image(img, run_model, image_size=IMAGE_SIZE, resize_mode='square', max_pixels=MAX_PIXELS,
+                  sharpen=True, contrast=1.2, blend_alpha=None, tiled=False, tile_size=IMAGE_SIZE,
+                  tile_overlap=64, enhance_before_upscale=False, output_size=None, uint8_io=False):
+    """Resizes, stylizes, restores the original size and enhances a PIL image.
+
+    `run_model` takes an Nx3xHxW float32 array in 0-255 and returns the model output;
+    with `uint8_io` (a model exported with uint8 image I/O), it gets the 1xHxWx3
+    uint8 pixels instead, and tiles still go in as float tensors.
+    In 'square' mode the image is squashed to `image_size`; in 'aspect' mode it keeps
+    its aspect ratio within `max_pixels` (this needs a dynamic-shape model). With
+    `tiled` set, the image is stylized at its own resolution in overlapping
+    `tile_size` tiles instead. With `blend_alpha` set, the result is blended with
+    the content image (0.0 = no style, 1.0 = full style). Sharpening, contrast and
+    blending run as one fused pass, at full resolution or, with
+    `enhance_before_upscale`, at inference resolution before the upscale. The
+    result has the size of `img`, or `output_size` (e.g. for a draft-decoded upload).
+    """
+    img_original = img
+    original_size = img.size
+
+    if tiled:
+        with metrics.span('preprocess'):
+            content_tensor = to_nchw(img)
+        stylized = stylize_tiled(content_tensor, run_model, tile_size, overlap=tile_overlap)
+    else:
+        target_size = inference_size(original_size, resize_mode, image_size, max_pixels)
+        if target_size != original_size:
+            with metrics.span('resize'):
+                img = img.resize(target_size, Image.LANCZOS)
+        with metrics.span('preprocess'):
+            content_tensor = to_model_input(img, uint8_io)
+
+        stylized = run_model(content_tensor)
+
+    return finish_image(stylized, img_original, img, sharpen, contrast, blend_alpha, enhance_before_upscale,
+                        output_size)
+
+
+def stylize_many(img, run_models, executor=None, preview=False, image_size=IMAGE_SIZE, resize_mode='square',
+                 max_pixels=MAX_PIXELS, sharpen=True, contrast=1.2, blend_alpha=None, tiled=False,
+                 tile_size=IMAGE_SIZE, tile_overlap=64, enhance_before_upscale=False, output_size=None,
+                 uint8_io=False):
+    """Stylizes one PIL image with several models; returns {name: PIL image}.
+
+    `run_models` maps a name to a run_model callable as taken by stylize_image.
+    The image is resized and converted to a tensor once, and every model runs on
+    that same tensor, concurrently when an `executor` is given (onnxruntime
+    releases the GIL). With `preview`, results stay at about the inference
+    pixel count instead of being upscaled (and tiling is skipped). Other parameters are
+    as for stylize_image; `uint8_io` must hold for every model.
+    """
+    tiled = tiled and not preview
+    with metrics.span('resize'):
+        if tiled:
+            resized = img
+        else:
+            target_size = inference_size(img.size, resize_mode, image_size, max_pixels)
+            resized = img.resize(target_size, Image.LANCZOS) if target_size != img.size else img
+        content = img
+        width, height = resized.size
+        if preview:
+            # Same pixel count as the inference, but in the image's own aspect ratio
+            preview_size = resized.size if resize_mode == 'aspect' else fit_to_budget(img.size, width * height)
+            content = resized if preview_size == resized.size else img.resize(preview_size, Image.LANCZOS)
+    with metrics.span('preprocess'):
+        # Own buffer: the calling thread's reused one could change while the runs read it
+        if uint8_io and not tiled:
+            content_tensor = to_model_input(resized, uint8=True)
+        else:
+            content_tensor = to_nchw(resized, out=np.empty((1, 3, height, width), dtype=np.float32))
+    # Spans recorded on executor threads carry the caller's labels plus the style
+    context = metrics.current_labels()
+
+    def run(name, run_model):
+        with metrics.labels(**dict(context, style=name)):
+            if tiled:
+                stylized = stylize_tiled(content_tensor, run_model, tile_size, overlap=tile_overlap)
+            else:
+                stylized = run_model(content_tensor)
+            return finish_image(stylized, content, resized, sharpen, contrast, blend_alpha, enhance_before_upscale,
+                                None if preview else output_size)
+
+    if executor is None:
+        return {name: run(name, run_model) for name, run_model in run_models.items()}
+    futures = {name: executor.submit(run, name, run_model) for name, run_model in run_models.items()}
+    return {name: future.result() for name, future in futures.items()}
+
+
+def finish_image(stylized, content, resized_content, sharpen=True, contrast=1.2, blend_alpha=None,
+                 enhance_before_upscale=False, output_size=None):
+    """Model output -> enhanced PIL image at the size of `content` (or `output_size`).
+
+    `resized_content` is the content at the resolution the model ran at; it is
+    what the result is blended with when enhancing before the upscale.
+    """
+    original_size = output_size or content.size
+    with metrics.span('postprocess'):
+        pixels = from_model_output(stylized)
+    upscale = pixels.shape[1::-1] != original_size
+    if enhance_before_upscale or not upscale:
+        blend_with = resized_content if upscale else content
+        with metrics.span('enhance'):
+            pixels = fused_postprocess(pixels, sharpen, contrast, blend_alpha,
+                                       np.asarray(blend_with) if blend_alpha is not None else None)
+        final_img = Image.fromarray(pixels)
+        if upscale:
+            with metrics.span('upscale'):
+                final_img = final_img.resize(original_size, Image.LANCZOS)
+        return final_img
+
+    with metrics.span('upscale'):
+        output_image = Image.fromarray(pixels).resize(original_size, Image.LANCZOS)
+        if blend_alpha is not None and content.size != original_size:
+            content = content.resize(original_size, Image.LANCZOS)
+    with metrics.span('enhance'):
+        return enhance(output_image, sharpen, contrast, blend_alpha, content)
+
+
+def store_result(cache, key, final_img):
+    """Stores the result's canonical artifact; returns the {ext: filename} it is served
+    under. The files themselves are encoded on first request (see OutputEncoder)."""
+    with metrics.span('store'):
+        cache.put(key, {CANONICAL_EXT: to_canonical(final_img)}, remember=False)
+    return {ext: cache.filename(key, ext) for ext in OUTPUT_FORMATS}
+
+
+def cached_result(cache, key):
+    """Like store_result's return value if the result is cached, else None."""
+    if cache.get(key, [CANONICAL_EXT]) is None:
+        return None
+    return {ext: cache.filename(key, ext) for ext in OUTPUT_FORMATS}
+
+
+def encode_outputs(final_img, formats=OUTPUT_FORMATS):
+    """Encodes the result in every format; returns {ext: bytes}."""
+    encoded = {}
+    for ext, format_name in formats.items():
+        with metrics.span(f'encode_{ext}'):
+            buf = io.BytesIO()
+            final_img.save(buf, format_name)
+            encoded[ext] = buf.getvalue()
+    return encoded
+
+
+# -----------------------------
+# Background job worker processes
+# -----------------------------
+_worker_scheduler = None
+_worker_cache = None
+_worker_registry = None
+
+
+def init_worker(styles, pool_kwargs, cache_kwargs, manifest=None):
+    """Process pool initializer: every worker process gets its own session pool.
+
+    The worker's result cache only writes the shared disk tier; its memory tier
+    is disabled because the web process serves the files. With a `manifest`
+    path, models come from that registry, re-checked before every job.
+    """
+    global _worker_scheduler, _worker_cache, _worker_registry
+    _worker_registry = ModelRegistry(manifest) if manifest else None
+    session_pool = SessionPool(styles, manifest=_worker_registry.current if _worker_registry else None,
+                               **pool_kwargs)
+    if _worker_registry:
+        _worker_registry.subscribe(session_pool.apply)
+    _worker_scheduler = BatchScheduler(session_pool, max_batch=1)
+    _worker_cache = ResultCache(**dict(cache_kwargs, memory_bytes=0))
+
+
+def stylize_job(data, input_filename, style, model, key, params):
+    """Full upload pipeline, run inside a job worker process.
+
+    `data` is the encoded upload and `model` the session pool key of the style
+    variant to run; `input_filename` is passed through to the result.
+    """
+    if _worker_registry:
+        _worker_registry.refresh()
+    with metrics.labels(style=model):
+        img, original_size = decode_upload(io.BytesIO(data), **params)
+        final_img = stylize_image(img, lambda tensor: _worker_scheduler.run(model, tensor),
+                                  output_size=original_size,
+                                  uint8_io=_worker_scheduler.session_pool.takes_uint8(model), **params)
+        outputs = store_result(_worker_cache, key, final_img)
+    return {
+        'style': style,
+        'input_image': input_filename,
+        'output_jpg': outputs['jpg'],
+        'output_png': outputs['png'],
+    }
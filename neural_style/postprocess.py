@@ -0,0 +1,118 @@
+import numpy as np
+from PIL import Image, ImageEnhance, ImageFilter
+
+# Rows processed per band; bounds the float32 scratch memory independently of image height
+BAND_ROWS = 128
+
+# ITU-R 601-2 luma weights, as used by PIL's "L" conversion
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114])
+
+
+def _sharpen_band(pixels, out, y0, y1, scratch):
+    """PIL's SHARPEN kernel ([-2]*8 around 32, divided by 16) for output rows y0..y1.
+
+    Border rows and columns are copied unchanged, like PIL does.
+    """
+    height, width = pixels.shape[:2]
+    top, bottom = max(y0, 1), min(y1, height - 1)
+    for y in (y0, y1 - 1):
+        if y == 0 or y == height - 1:
+            out[y] = pixels[y]
+    if bottom <= top:
+        return
+    rows = bottom - top
+    out[top:bottom, 0] = pixels[top:bottom, 0]
+    out[top:bottom, -1] = pixels[top:bottom, -1]
+
+    # 3x3 box sum of the band (plus its one-row halo) via separable sums
+    src = scratch['src'][:rows + 2]
+    np.copyto(src, pixels[top - 1:bottom + 1], casting='unsafe')
+    vsum = scratch['vsum'][:rows]
+    np.add(src[:-2], src[1:-1], out=vsum)
+    vsum += src[2:]
+    box = scratch['box'][:rows]
+    np.add(vsum[:, :-2], vsum[:, 1:-1], out=box)
+    box += vsum[:, 2:]
+
+    # 32*center - 2*(box - center), over 16  ==  2.125*center - 0.125*box
+    box *= -0.125
+    center = vsum[:, 1:-1]   # vsum is no longer needed; reuse it for the scaled center
+    np.multiply(src[1:-1, 1:-1], 2.125, out=center)
+    box += center
+    box += 0.5
+    np.clip(box, 0, 255, out=out[top:bottom, 1:-1], casting='unsafe')
+
+
+def fused_postprocess(pixels, sharpen=True, contrast=1.2, blend_alpha=None, content=None, out=None,
+                      band_rows=BAND_ROWS):
+    """Sharpen, contrast and alpha-blend a uint8 HxWx3 array in two banded passes.
+
+    Matches the PIL chain of ImageFilter.SHARPEN, ImageEnhance.Contrast and
+    Image.blend(content, result, blend_alpha) to within one level, without
+    allocating a full-size intermediate per step: the first pass sharpens into
+    `out` while the second applies contrast and blending in place, both through a
+    float32 scratch of `band_rows` rows.
+    """
+    height, width, channels = pixels.shape
+    if out is None:
+        out = np.empty_like(pixels)
+    if blend_alpha is not None and (content is None or content.shape != pixels.shape):
+        raise ValueError("blending needs a content image of the same size")
+
+    # Pass 1: sharpen into out
+    if sharpen and height >= 3 and width >= 3:
+        scratch = {
+            'src': np.empty((band_rows + 2, width, channels), dtype=np.float32),
+            'vsum': np.empty((band_rows, width, channels), dtype=np.float32),
+            'box': np.empty((band_rows, width - 2, channels), dtype=np.float32)
+        }
+        for y0 in range(0, height, band_rows):
+            _sharpen_band(pixels, out, y0, min(height, y0 + band_rows), scratch)
+    elif out is not pixels:
+        np.copyto(out, pixels)
+
+    if contrast == 1.0 and blend_alpha is None:
+        return out
+
+    # Contrast pivots around the mean luminance of the sharpened image
+    mean = 0.0
+    if contrast != 1.0:
+        channel_means = out.reshape(-1, channels).mean(axis=0)
+        mean = float(int(channel_means[:3] @ LUMA_WEIGHTS + 0.5))
+
+    # Pass 2: contrast and blend in place, band by band. Both are PIL blends,
+    # in1 + alpha * (in2 - in1) in float32 truncated to uint8, and are computed
+    # the same way: rounding instead would add up to one level per step
+    band = np.empty((band_rows, width, channels), dtype=np.float32)
+    content_band = np.empty_like(band) if blend_alpha is not None else None
+    for y0 in range(0, height, band_rows):
+        y1 = min(height, y0 + band_rows)
+        f = band[:y1 - y0]
+        np.copyto(f, out[y0:y1], casting='unsafe')
+        if contrast != 1.0:
+            # Blend of a flat grey image at the mean luminance with the sharpened one
+            f -= mean
+            f *= np.float32(contrast)
+            f += mean
+            np.clip(f, 0, 255, out=f)
+            if blend_alpha is not None:
+                np.trunc(f, out=f)
+        if blend_alpha is not None:
+            c = content_band[:y1 - y0]
+            np.copyto(c, content[y0:y1], casting='unsafe')
+            f -= c
+            f *= np.float32(blend_alpha)
+            f += c
+        np.clip(f, 0, 255, out=out[y0:y1], casting='unsafe')
+    return out
+
+
+def pil_postprocess(img, sharpen=True, contrast=1.2, blend_alpha=None, content=None):
+    """The original PIL chain, kept as the reference for fused_postprocess."""
+    if sharpen:
+        img = img.filter(ImageFilter.SHARPEN)
+    if contrast != 1.0:
+        img = ImageEnhance.Contrast(img).enhance(contrast)
+    if blend_alpha is not None:
+        img = Image.blend(content, img, alpha=blend_alpha)
+    return img
@@ -0,0 +1,304 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+from neural_style.session_pool import GRAPH_OPTIMIZATION_LEVELS, MODEL_VARIANTS, model_name
+
+logger = logging.getLogger(__name__)
+
+# Styles served when there is no manifest; their models are <model_dir>/<style>[.<variant>].onnx
+DEFAULT_STYLES = {
+    'mosaic': 'Mosaic',
+    'rain_princess': 'Rain Princess',
+    'candy': 'Candy'
+}
+
+MANIFEST_FILE = 'models.json'
+
+# Variants a manifest may list: the served ones plus the small fixed-size preview graphs
+MANIFEST_VARIANTS = MODEL_VARIANTS + ('preview',)
+
+# Offsets of external weights are aligned to this, so onnxruntime can mmap them
+# (64 KiB covers the page size on Linux and the allocation granularity on Windows)
+EXTERNAL_DATA_ALIGNMENT = 65536
+
+ModelEntry = namedtuple('ModelEntry', ['key', 'style', 'variant', 'path', 'input_shape', 'sha256',
+                                       'external_data', 'optimized'])
+
+
+def model_key(style, variant):
+    """Session pool key of a manifest entry, e.g. 'mosaic.int8-static' or 'mosaic.preview'."""
+    return f"{style}.preview" if variant == 'preview' else model_name(style, variant)
+
+
+def file_digest(*paths):
+    """sha256 over the contents of `paths`, in order."""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_external_data(onnx_file, size_threshold=1024, alignment=EXTERNAL_DATA_ALIGNMENT):
+    """Moves the weights of an ONNX file into <onnx_file>.data, each at an
+    `alignment`-aligned offset. onnxruntime memory-maps aligned external data,
+    so every session and every process that opens the model shares the same
+    page-cache pages instead of holding its own copy of the weights."""
+    import onnx
+    from onnx.external_data_helper import set_external_data
+
+    model = onnx.load(onnx_file)
+    location = f"{os.path.basename(onnx_file)}.data"
+    data_file = os.path.join(os.path.dirname(os.path.abspath(onnx_file)), location)
+    with open(f"{data_file}.tmp", 'wb') as f:
+        for tensor in model.graph.initializer:
+            if not tensor.HasField('raw_data') or len(tensor.raw_data) < size_threshold:
+                continue
+            offset = -(-f.tell() // alignment) * alignment
+            f.seek(offset)
+            f.write(tensor.raw_data)
+            set_external_data(tensor, location, offset, len(tensor.raw_data))
+            tensor.ClearField('raw_data')
+            tensor.data_location = onnx.TensorProto.EXTERNAL
+    # New files instead of rewriting in place: running sessions keep their mapping of the old ones
+    os.replace(f"{data_file}.tmp", data_file)
+    onnx.save(model, f"{onnx_file}.tmp")
+    os.replace(f"{onnx_file}.tmp", onnx_file)
+    return data_file
+
+
+def describe_model(onnx_file):
+    """(input shape, whether the weights are external) of an ONNX file, read
+    without loading its weights; dynamic axes are names."""
+    import onnx
+
+    model = onnx.load(onnx_file, load_external_data=False)
+    dims = model.graph.input[0].type.tensor_type.shape.dim
+    shape = [dim.dim_value if dim.HasField('dim_value') else dim.dim_param for dim in dims]
+    external = any(tensor.data_location == onnx.TensorProto.EXTERNAL for tensor in model.graph.initializer)
+    return shape, external
+
+
+class Manifest:
+    """One version of the model manifest (left unchanged once in use).
+
+    `styles` maps style ids to display names, in display order; `models` maps
+    session pool keys to ModelEntry. Keys without an entry fall back to
+    <model_dir>/<key>.onnx, so a missing manifest means the DEFAULT_STYLES
+    with models found by file name.
+    """
+
+    def __init__(self, styles, models=None, checkpoints=None, model_dir='.', path=None, mtime=None):
+        self.styles = dict(styles)
+        self.models = dict(models or {})
+        self.checkpoints = dict(checkpoints or {})
+        self.model_dir = model_dir
+        self.path = path
+        self.mtime = mtime
+
+    def model_path(self, key):
+        entry = self.models.get(key)
+        return entry.path if entry else os.path.join(self.model_dir, f"{key}.onnx")
+
+    def checkpoint(self, style):
+        """The style's PyTorch checkpoint (for conversion), <model_dir>/<style>.pth unless listed."""
+        return self.checkpoints.get(style) or os.path.join(self.model_dir, f"{style}.pth")
+
+    def external_data(self, key):
+        """Path of the key's external weights file, or None when they are inline."""
+        entry = self.models.get(key)
+        if entry:
+            return entry.external_data
+        data_file = f"{self.model_path(key)}.data"
+        return data_file if os.path.exists(data_file) else None
+
+    def verify(self):
+        """Checks that every listed model exists and matches its checksum; raises ValueError."""
+        for entry in self.models.values():
+            files = [entry.path] + ([entry.external_data] if entry.external_data else [])
+            missing = [path for path in files if not os.path.exists(path)]
+            if missing:
+                raise ValueError(f"{entry.key}: missing {', '.join(missing)}")
+            if entry.sha256 and file_digest(*files) != entry.sha256:
+                raise ValueError(f"{entry.key}: checksum mismatch for {entry.path}")
+
+    def to_json(self):
+        """The manifest document; paths are written relative to `model_dir`."""
+        def relative(path):
+            return os.path.relpath(path, self.model_dir) if path else None
+
+        models = []
+        for entry in self.models.values():
+            model = {'style': entry.style, 'variant': entry.variant, 'path': relative(entry.path),
+                     'input_shape': entry.input_shape, 'sha256': entry.sha256}
+            if entry.external_data:
+                model['external_data'] = relative(entry.external_data)
+            if entry.optimized:
+                model['optimized'] = entry.optimized
+            models.append(model)
+        styles = [dict({'id': style, 'name': name},
+                       **({'checkpoint': relative(self.checkpoints[style])} if style in self.checkpoints else {}))
+                  for style, name in self.styles.items()]
+        return {'styles': styles, 'models': models}
+
+
+def parse_manifest(document, model_dir, path=None, mtime=None):
+    """Builds a Manifest from the parsed JSON document; raises ValueError when it is malformed."""
+    try:
+        styles, checkpoints = {}, {}
+        for style in document['styles']:
+            if style['id'] in styles:
+                raise ValueError(f"duplicate style: {style['id']}")
+            styles[style['id']] = style.get('name', style['id'])
+            if style.get('checkpoint'):
+                checkpoints[style['id']] = os.path.join(model_dir, style['checkpoint'])
+        models = {}
+        for model in document.get('models', []):
+            variant = model.get('variant', 'fp32')
+            if variant not in MANIFEST_VARIANTS:
+                raise ValueError(f"unknown variant for {model['style']}: {variant}")
+            key = model_key(model['style'], variant)
+            if key in models:
+                raise ValueError(f"duplicate model: {key}")
+            external_data = model.get('external_data')
+            optimized = model.get('optimized') or None
+            if optimized is True:
+                optimized = 'extended'   # Manifests written before the level was recorded
+            if optimized is not None and optimized not in GRAPH_OPTIMIZATION_LEVELS:
+                raise ValueError(f"unknown optimization level for {key}: {optimized}")
+            models[key] = ModelEntry(key, model['style'], variant, os.path.join(model_dir, model['path']),
+                                     model.get('input_shape'), model.get('sha256'),
+                                     os.path.join(model_dir, external_data) if external_data else None,
+                                     optimized)
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"malformed manifest: {e!r}")
+    # Every style's 'multi' variant runs on the one multi-style network
+    if len({(entry.path, entry.sha256) for entry in models.values() if entry.variant == 'multi'}) > 1:
+        raise ValueError("the 'multi' models of all styles must be the same multi-style network")
+    return Manifest(styles, models, checkpoints, model_dir, path, mtime)
+
+
+def load_manifest(path=MANIFEST_FILE, verify=True):
+    """Reads (and verifies) a manifest file; without one, the DEFAULT_STYLES next to it."""
+    model_dir = os.path.dirname(os.path.abspath(path)) if path else '.'
+    if not path or not os.path.exists(path):
+        return Manifest(DEFAULT_STYLES, model_dir=model_dir if path else '.', path=path)
+    mtime = os.path.getmtime(path)
+    with open(path) as f:
+        try:
+            document = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{path}: {str(e)}")
+    manifest = parse_manifest(document, model_dir, path, mtime)
+    if verify:
+        manifest.verify()
+    return manifest
+
+
+def save_manifest(manifest, path):
+    """Writes a manifest through a temporary file, so a watching server never reads half of it."""
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(manifest.to_json(), f, indent=2)
+        f.write('\n')
+    os.replace(f"{path}.tmp", path)
+
+
+def register_model(path, style, variant, onnx_file, name=None, checkpoint=None, optimized=None):
+    """Adds or replaces the manifest entry of one model (and its style), with
+    the file's input shape and checksum; creates the manifest if needed.
+    `optimized` is the graph optimization level the file was saved at, if any.
+    Registering a 'multi' model points the other styles' 'multi' entries at it too."""
+    # Not verified: the entry being replaced may describe a file that was just overwritten
+    manifest = load_manifest(path, verify=False) if os.path.exists(path) else Manifest(
+        {}, model_dir=os.path.dirname(os.path.abspath(path)), path=path)
+    input_shape, external = describe_model(onnx_file)
+    external_data = f"{onnx_file}.data" if external else None
+    key = model_key(style, variant)
+    manifest.models[key] = ModelEntry(key, style, variant, os.path.abspath(onnx_file), input_shape,
+                                      file_digest(*[onnx_file] + ([external_data] if external_data else [])),
+                                      os.path.abspath(external_data) if external_data else None, optimized)
+    if variant == 'multi':
+        # One network serves every style's 'multi' variant: move them all to the new file
+        for entry in list(manifest.models.values()):
+            if entry.variant == 'multi':
+                manifest.models[entry.key] = manifest.models[key]._replace(key=entry.key, style=entry.style)
+    if variant in ('fp32', 'preview') and style not in manifest.styles and not name:
+        name = style.replace('_', ' ').title()
+    if name:
+        manifest.styles[style] = name
+    if checkpoint:
+        manifest.checkpoints[style] = os.path.abspath(checkpoint)
+    save_manifest(manifest, path)
+    return manifest.models[key]
+
+
+class ModelRegistry:
+    """The current Manifest of a manifest file, reloaded when the file changes.
+
+    refresh() checks the file's modification time and, when it changed, loads
+    and verifies the new version; a manifest that fails to load (malformed,
+    missing model, checksum mismatch) is reported and the previous version kept
+    until the file changes again.
+    Callbacks registered with subscribe() get every new version. watch() polls
+    on a daemon thread; start it after any fork.
+    """
+
+    def __init__(self, path=MANIFEST_FILE):
+        self.path = path
+        self.current = load_manifest(path)
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._failed_mtime = None
+        self._thread = None
+
+    @property
+    def styles(self):
+        return self.current.styles
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+
+    def _mtime(self):
+        try:
+            return os.path.getmtime(self.path)
+        except (OSError, TypeError):
+            return None
+
+    def refresh(self):
+        """Loads the manifest if it changed; returns True when a new version was applied."""
+        with self._lock:
+            mtime = self._mtime()
+            # A version that failed to load is not hashed again until the file changes
+            if mtime == self.current.mtime or mtime == self._failed_mtime:
+                return False
+            try:
+                manifest = load_manifest(self.path)
+            except (OSError, ValueError) as e:
+                self._failed_mtime = mtime
+                logger.error("Keeping the current models, could not load %s: %s", self.path, e)
+                return False
+            self.current = manifest
+            for callback in self._callbacks:
+                try:
+                    callback(manifest)
+                except Exception as e:
+                    logger.exception("Model reload failed: %s", e)
+            return True
+
+    def watch(self, interval=2.0):
+        """Starts polling the manifest every `interval` seconds (once per process)."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        def poll():
+            while True:
+                time.sleep(interval)
+                self.refresh()
+
+        self._thread = threading.Thread(target=poll, name='manifest-watch', daemon=True)
+        self._thread.start()
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from neural_style import metrics
+
+
+def image_digest(img):
+    """Hashes the decoded pixels, so re-encoded copies of an image share a digest."""
+    h = hashlib.sha256()
+    h.update(f"{img.mode}:{img.size[0]}x{img.size[1]}:".encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+def data_digest(data):
+    """Hashes the encoded bytes; much cheaper than image_digest on large photos."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_key(digest, style, params):
+    """Combines an image digest with the style and every processing parameter."""
+    h = hashlib.sha256()
+    h.update(digest.encode())
+    h.update(style.encode())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()[:32]
+
+
+class ResultCache:
+    """Content-addressed cache of encoded results.
+
+    Results are stored on disk as `<prefix><key>.<ext>` under `folder`, which is
+    what /outputs serves. Recently used files are also kept in an in-memory LRU of
+    at most `memory_bytes`. The disk tier is swept of files older than `max_age`
+    seconds and trimmed (least recently used first) to `disk_bytes`.
+    """
+
+    def __init__(self, folder, prefix='output_', memory_bytes=64 * 1024 * 1024,
+                 disk_bytes=1024 * 1024 * 1024, max_age=7 * 24 * 3600, sweep_interval=60):
+        self.folder = folder
+        self.prefix = prefix
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._last_sweep = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def filename(self, key, ext):
+        return f"{self.prefix}{key}.{ext}"
+
+    def _is_cache_file(self, name):
+        # Only touch files this cache wrote; other outputs in the folder are left alone
+        return re.fullmatch(re.escape(self.prefix) + r'[0-9a-f]{32}(\.q\d+)?\.\w+', name) is not None
+
+    def _remember(self, filename, data):
+        if len(data) > self.memory_bytes:
+            return
+        with self._lock:
+            if filename in self._memory:
+                self._memory_size -= len(self._memory.pop(filename))
+            self._memory[filename] = data
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def get(self, key, exts):
+        """Returns {ext: filename} if every requested format is cached, else None."""
+        filenames = {ext: self.filename(key, ext) for ext in exts}
+        for filename in filenames.values():
+            path = os.path.join(self.folder, filename)
+            with self._lock:
+                data = self._memory.get(filename)
+                if data is not None:
+                    self._memory.move_to_end(filename)
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                if data is None:
+                    metrics.CACHE_LOOKUPS.inc(cache='result', result='miss')
+                    return None
+                # Swept from disk while still hot in memory: write it back
+                with open(path, 'wb') as f:
+                    f.write(data)
+        metrics.CACHE_LOOKUPS.inc(cache='result', result='hit')
+        return filenames
+
+    def put(self, key, encoded, remember=True):
+        """Stores {ext: bytes} for a key and returns {ext: filename}.
+
+        With `remember` off, the files only go to disk (e.g. large raw artifacts
+        that would flush the memory tier).
+        """
+        filenames = {}
+        for ext, data in encoded.items():
+            filename = self.filename(key, ext)
+            path = os.path.join(self.folder, filename)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            if remember:
+                self._remember(filename, data)
+            filenames[ext] = filename
+        self.sweep()
+        return filenames
+
+    def read(self, filename):
+        """Returns a cached file's bytes from memory, or None if it isn't resident."""
+        with self._lock:
+            data = self._memory.get(filename)
+            if data is not None:
+                self._memory.move_to_end(filename)
+            return data
+
+    def sweep(self, force=False):
+        """Evicts expired files, then the least recently used ones over the size budget."""
+        now = time.time()
+        if not force and now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+
+        entries = []
+        for entry in os.scandir(self.folder):
+            if not entry.is_file() or not self._is_cache_file(entry.name):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.max_age:
+                self._evict(entry.path, entry.name)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path, entry.name))
+
+        total = sum(size for _, size, _, _ in entries)
+        for _, size, path, name in sorted(entries):
+            if total <= self.disk_bytes:
+                break
+            self._evict(path, name)
+            total -= size
+
+    def _evict(self, path, filename):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            data = self._memory.pop(filename, None)
+            if data is not None:
+                self._memory_size -= len(data)
@@ -0,0 +1,467 @@
+import hashlib
+import logging
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import onnxruntime as ort
+
+from neural_style import metrics
+from neural_style.image_io import nchw_to_nhwc_uint8, nhwc_uint8_to_nchw
+
+logger = logging.getLogger(__name__)
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+# Precisions built by quantize_models.py, plus 'slim': a smaller network distilled by distill.py,
+# and 'multi': the style's slot in the shared multi-style network
+MODEL_VARIANTS = ('fp32', 'int8-dynamic', 'int8-static', 'fp16', 'slim', 'multi')
+
+# File stem of the multi-style network distill.py trains from several style models
+MULTI_STYLE_MODEL = 'multi_style'
+
+
+def model_name(style, variant='fp32'):
+    """Model file stem of a style variant, e.g. 'mosaic' or 'mosaic.int8-static'."""
+    if variant not in MODEL_VARIANTS:
+        raise ValueError(f"Unknown model variant: {variant}")
+    return style if variant == 'fp32' else f"{style}.{variant}"
+
+
+def make_session_options(intra_op_threads=0, inter_op_threads=0, optimization_level='all',
+                         optimized_model_path=None):
+    """Builds SessionOptions; 0 threads lets onnxruntime pick from the core count."""
+    if optimization_level not in GRAPH_OPTIMIZATION_LEVELS:
+        raise ValueError(f"Unknown graph optimization level: {optimization_level}")
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    if inter_op_threads > 1:
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[optimization_level]
+    if optimized_model_path:
+        options.optimized_model_filepath = optimized_model_path
+    return options
+
+
+def load_time_level(saved_level, optimization_level):
+    """Level to open a graph saved pre-optimized at `saved_level` (None if it
+    wasn't) with: 'disable' when that already covers `optimization_level`."""
+    levels = list(GRAPH_OPTIMIZATION_LEVELS)
+    if saved_level and levels.index(saved_level) >= levels.index(optimization_level):
+        return 'disable'
+    return optimization_level
+
+
+def run_session(ort_session, tensor, style_index=None):
+    """Runs `tensor` through a session and returns the first output.
+
+    Fixed-batch graphs get one run per input. A uint8 image I/O model also
+    takes an Nx3xHxW float tensor (e.g. tiles), converted on the way in and out.
+    A multi-style network gets `style_index` as its second input: one index for
+    the whole batch, or a sequence with one per image.
+    """
+    inputs = ort_session.get_inputs()
+    model_input = inputs[0]
+    if model_input.type == 'tensor(uint8)' and tensor.dtype != np.uint8:
+        return nhwc_uint8_to_nchw(run_session(ort_session, nchw_to_nhwc_uint8(tensor), style_index))
+    feeds = {model_input.name: tensor}
+    if len(inputs) > 1:
+        indices = np.asarray(0 if style_index is None else style_index, dtype=np.int64)
+        feeds[inputs[1].name] = np.full(tensor.shape[0], indices) if indices.ndim == 0 else indices
+    batch_dim = model_input.shape[0]
+    if isinstance(batch_dim, int) and batch_dim != tensor.shape[0]:
+        # Fixed-batch graph: fall back to one run per input
+        outputs = [ort_session.run(None, {name: feed[i:i + 1] for name, feed in feeds.items()})[0]
+                   for i in range(tensor.shape[0])]
+        return np.concatenate(outputs, axis=0)
+    return ort_session.run(None, feeds)[0]
+
+
+class _Generation:
+    """The sessions of one version of a model. A model that changes gets a new
+    generation; sessions checked out of the old one go back to it and are freed
+    with it once the last of them is released."""
+
+    def __init__(self, path, external_data=None, optimized=None, expected_shape=None, sha256=None):
+        self.path = path
+        self.external_data = external_data
+        self.optimized = optimized
+        self.expected_shape = expected_shape
+        self.sha256 = sha256
+        self.source = None   # (preloaded bytes, level it was optimized at) from load_models()
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.input_shape = None
+        self.uint8 = None
+        self.style_names = None
+        self.warm_sizes = []
+
+
+class SessionPool:
+    """Process-wide pool of onnxruntime sessions, keyed by style.
+
+    A key is a model name as returned by model_name(), so each variant of a style
+    gets its own sessions; `styles` lists the ones preload() builds. Sessions are
+    built lazily on first use (or eagerly with preload()) and up to
+    `sessions_per_style` of them can be checked out concurrently per key. When
+    `cache_dir` is set, the optimized graph is serialized there on first build and
+    later sessions load it with graph optimization disabled. Models saved
+    pre-optimized are only optimized again at load when `optimization_level` is
+    above the level they were saved at. load_models() reads
+    the model files up front, e.g. in a gunicorn master so forked workers share
+    them, and warmup() builds and exercises the sessions before traffic arrives.
+
+    Model files are <model_dir>/<key>.onnx, or those of a registry `manifest`
+    (see neural_style/registry.py); apply() switches to a new manifest version
+    without interrupting requests. Models with external weights are opened from
+    their files, which onnxruntime memory-maps, instead of being read or cached.
+
+    The 'multi' variant of every style (e.g. 'mosaic.multi') maps to the one
+    `multi_style_model` network and its sessions; route() gives the style index
+    to run it with.
+    """
+
+    def __init__(self, styles, sessions_per_style=1, model_dir='.', cache_dir=None,
+                 intra_op_threads=0, inter_op_threads=0, optimization_level='all',
+                 multi_style_model=MULTI_STYLE_MODEL, manifest=None):
+        if sessions_per_style < 1:
+            raise ValueError("sessions_per_style must be at least 1")
+        self.styles = list(styles)
+        self.sessions_per_style = sessions_per_style
+        self.model_dir = model_dir
+        self.cache_dir = cache_dir
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.optimization_level = optimization_level
+        self.multi_style_model = multi_style_model
+        self.manifest = manifest
+
+        self._lock = threading.Lock()
+        self._generations = {}
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _manifest_entry(self, key, manifest):
+        """The manifest's ModelEntry for a pool key, or None. The shared multi-style
+        network is listed as the 'multi' variant of each style it serves."""
+        if key == self.multi_style_model:
+            return next((entry for entry in manifest.models.values() if entry.variant == 'multi'), None)
+        return manifest.models.get(key)
+
+    def _manifest_path(self, key, manifest):
+        entry = self._manifest_entry(key, manifest)
+        return entry.path if entry else manifest.model_path(key)
+
+    def model_path(self, style):
+        key = self._pool_key(style)
+        if self.manifest is not None:
+            return self._manifest_path(key, self.manifest)
+        return os.path.join(self.model_dir, f"{key}.onnx")
+
+    def revision(self, style):
+        """The model name plus its manifest checksum, if any: changes whenever the model does."""
+        entry = self._manifest_entry(self._pool_key(style), self.manifest) if self.manifest is not None else None
+        return f"{style}@{entry.sha256[:16]}" if entry and entry.sha256 else style
+
+    def _pool_key(self, style):
+        """Key the sessions of a model name live under: the shared network for 'multi' variants."""
+        return self.multi_style_model if style.endswith('.multi') else style
+
+    def _new_generation(self, key):
+        path = self.model_path(key)
+        if self.manifest is None:
+            external_data = f"{path}.data" if os.path.exists(f"{path}.data") else None
+            return _Generation(path, external_data)
+        entry = self._manifest_entry(key, self.manifest)
+        if entry is None:
+            return _Generation(path, self.manifest.external_data(key))
+        return _Generation(path, entry.external_data, entry.optimized, entry.input_shape, entry.sha256)
+
+    def _generation(self, key):
+        with self._lock:
+            generation = self._generations.get(key)
+            if generation is None:
+                generation = self._generations[key] = self._new_generation(key)
+            return generation
+
+    def style_names(self, style):
+        """Styles a multi-style network serves, in index order ([] for other models)."""
+        return self._built(self._pool_key(style)).style_names
+
+    def route(self, style):
+        """(pool key, style index) that a model name runs as; the index is None
+        except for a style's 'multi' variant. Raises ValueError if the shared
+        network doesn't serve that style."""
+        key = self._pool_key(style)
+        if key == style:
+            return style, None
+        return key, self.style_names(key).index(style[:-len('.multi')])
+
+    def _cached_model_path(self, style, generation):
+        """Optimized graph of the generation's model file in `cache_dir`, named after
+        the file's checksum (or path, size and mtime without a manifest), so a
+        rollback to an older file never picks up the graph of a newer one."""
+        if generation.sha256:
+            fingerprint = generation.sha256[:12]
+        else:
+            stat = os.stat(generation.path)
+            identity = f"{os.path.abspath(generation.path)}:{stat.st_size}:{stat.st_mtime_ns}"
+            fingerprint = hashlib.sha256(identity.encode()).hexdigest()[:12]
+        return os.path.join(self.cache_dir, f"{style}.{fingerprint}.opt.onnx")
+
+    def _model_source(self, style, generation):
+        """(path or preloaded bytes, level the graph was saved optimized at or None) of a style's model."""
+        if generation.source is not None:
+            return generation.source
+        model_path = generation.path
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"ONNX model not found: {model_path}")
+        if generation.external_data:
+            # Serializing an optimized copy would inline the weights it should share
+            return model_path, generation.optimized
+        if self.cache_dir:
+            cached_path = self._cached_model_path(style, generation)
+            if os.path.exists(cached_path):
+                return cached_path, self.optimization_level
+        return model_path, generation.optimized
+
+    def _create_session(self, style, generation):
+        source, optimized = self._model_source(style, generation)
+        level = load_time_level(optimized, self.optimization_level)
+        if level == 'disable' or not self.cache_dir or generation.external_data:
+            # Graphs already optimized at this level skip the transformers; re-running
+            # them on external weights copies the rewritten ones into private memory
+            options = make_session_options(self.intra_op_threads, self.inter_op_threads, level)
+            return ort.InferenceSession(source, options, providers=['CPUExecutionProvider'])
+
+        # Write to a per-process temp file so concurrent workers never read a partial graph
+        cached_path = self._cached_model_path(style, generation)
+        tmp_path = f"{cached_path}.{os.getpid()}.tmp"
+        options = make_session_options(self.intra_op_threads, self.inter_op_threads,
+                                       self.optimization_level, optimized_model_path=tmp_path)
+        session = ort.InferenceSession(source, options, providers=['CPUExecutionProvider'])
+        if os.path.exists(tmp_path):
+            os.replace(tmp_path, cached_path)
+        return session
+
+    def _read_model(self, key, generation):
+        """Reads a model into `generation` (unless its weights are memory-mapped);
+        False when the file is missing."""
+        if generation.external_data:
+            return os.path.exists(generation.path)
+        try:
+            source, optimized = self._model_source(key, generation)
+        except FileNotFoundError:
+            return False
+        if not isinstance(source, bytes):
+            with open(source, 'rb') as f:
+                source = f.read()
+        generation.source = (source, optimized)
+        return True
+
+    def load_models(self, styles=None):
+        """Reads the model files of `styles` (default: all) into memory; returns the
+        keys of the ones found ('multi' variants count as the shared network).
+
+        The optimized graph from `cache_dir` is read instead when it is current.
+        This is only file I/O, no onnxruntime state, so it is safe in a gunicorn
+        master before it forks: the workers then build their sessions from the
+        same bytes, shared copy-on-write instead of read once per worker. Models
+        with external weights are left to be memory-mapped, which shares them
+        between all processes without reading them here.
+        """
+        loaded = []
+        for style in dict.fromkeys(map(self._pool_key, self.styles if styles is None else styles)):
+            generation = self._generation(style)
+            if generation.source is not None or self._read_model(style, generation):
+                loaded.append(style)
+        return loaded
+
+    def has_model(self, style):
+        key = self._pool_key(style)
+        generation = self._generations.get(key)
+        if (generation is None or generation.source is None) and not os.path.exists(self.model_path(key)):
+            return False
+        return key == style or style[:-len('.multi')] in self.style_names(key)
+
+    def _record(self, generation, session):
+        """Notes a generation's model properties from its first session."""
+        model_input = session.get_inputs()[0]
+        if generation.expected_shape and list(model_input.shape) != list(generation.expected_shape):
+            raise ValueError(f"{generation.path}: input shape {model_input.shape} does not match the "
+                             f"manifest's {generation.expected_shape}")
+        generation.input_shape = model_input.shape
+        generation.uint8 = model_input.type == 'tensor(uint8)'
+        styles = session.get_modelmeta().custom_metadata_map.get('styles')
+        generation.style_names = styles.split(',') if styles else []
+
+    def _acquire(self, style):
+        """Checks out a session of the style's current generation: (generation, session)."""
+        generation = self._generation(style)
+        try:
+            return generation, generation.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = generation.created < self.sessions_per_style
+            if can_create:
+                generation.created += 1
+        if not can_create:
+            return generation, generation.idle.get()
+
+        try:
+            session = self._create_session(style, generation)
+            self._record(generation, session)
+        except Exception:
+            with self._lock:
+                generation.created -= 1
+            raise
+        return generation, session
+
+    def _release(self, generation, session):
+        generation.idle.put(session)
+
+    @contextmanager
+    def session(self, style):
+        """Checks out a session for `style`, blocking while all of them are busy."""
+        key = self._pool_key(style)
+        with metrics.span('session_acquire', style=style):
+            generation, session = self._acquire(key)
+        try:
+            yield session
+        finally:
+            self._release(generation, session)
+
+    def _built(self, key):
+        """The key's current generation, once it has built a session."""
+        generation = self._generation(key)
+        if generation.input_shape is None:
+            # Build (or wait for) a session once; afterwards this never blocks
+            generation, session = self._acquire(key)
+            self._release(generation, session)
+        return generation
+
+    def run_profiled(self, style, tensor, profile_dir):
+        """Runs `tensor` on a fresh session with onnxruntime profiling enabled.
+
+        Returns (output, path of the JSON trace). The session is not pooled, so
+        the trace holds this one run; meant for diagnosing single requests.
+        """
+        os.makedirs(profile_dir, exist_ok=True)
+        key, style_index = self.route(style)
+        options = make_session_options(self.intra_op_threads, self.inter_op_threads,
+                                       self.optimization_level)
+        options.enable_profiling = True
+        options.profile_file_prefix = os.path.join(profile_dir, style)
+        session = ort.InferenceSession(self.model_path(key), options, providers=['CPUExecutionProvider'])
+        with metrics.span('inference', style=style):
+            output = run_session(session, tensor, style_index)
+        return output, session.end_profiling()
+
+    def input_shape(self, style):
+        """The model's input shape; dynamic axes are names (str) instead of ints."""
+        return self._built(self._pool_key(style)).input_shape
+
+    def takes_uint8(self, style):
+        """True for models exported with uint8 image I/O (NxHxWx3 in and out)."""
+        return self._built(self._pool_key(style)).uint8
+
+    def image_shape(self, style):
+        """(height, width) of the model input, whatever its layout; dynamic axes are names."""
+        shape = self.input_shape(style)
+        return tuple(shape[1:3]) if self.takes_uint8(style) else tuple(shape[2:4])
+
+    def has_dynamic_shape(self, style):
+        """True when the style's model accepts any input height and width."""
+        return not all(isinstance(dim, int) for dim in self.image_shape(style))
+
+    def _warm_session(self, generation, session, sizes):
+        shape = generation.input_shape
+        height, width = shape[1:3] if generation.uint8 else shape[2:4]
+        if isinstance(height, int) and isinstance(width, int):
+            sizes = [(width, height)]
+        batch = shape[0] if isinstance(shape[0], int) else 1
+        for width, height in dict.fromkeys(sizes):
+            dummy = (np.zeros((batch, height, width, 3), dtype=np.uint8) if generation.uint8
+                     else np.zeros((batch, 3, height, width), dtype=np.float32))
+            run_session(session, dummy)
+
+    def warmup(self, style, sizes):
+        """Builds all of a style's sessions and runs each once per (width, height) in `sizes`.
+
+        The first run at a shape pays for onnxruntime's buffer allocation and
+        kernel selection; warming moves that cost out of the first requests.
+        Fixed-shape models only run at their own size.
+        """
+        style = self._pool_key(style)
+        generation = self._built(style)
+        generation.warm_sizes = list(sizes)
+        sessions = []
+        try:
+            # Check out every session at once, so each one gets built and warmed
+            while len(sessions) < self.sessions_per_style:
+                sessions.append(self._acquire(style))
+            for session_generation, session in sessions:
+                self._warm_session(session_generation, session, sizes)
+        finally:
+            for session_generation, session in sessions:
+                self._release(session_generation, session)
+
+    def apply(self, manifest):
+        """Switches to a new version of the registry manifest; returns the keys swapped.
+
+        Every model in use whose file or checksum changed gets a new generation,
+        read like the old one and with one session built and warmed at the old
+        one's sizes, before it replaces the old generation. Requests keep
+        running on the old sessions until they finish; models that are gone are
+        dropped. A model that fails to load keeps its old generation.
+        """
+        old, self.manifest = self.manifest, manifest
+        swapped = []
+        for key, current in list(self._generations.items()):
+            path = self._manifest_path(key, manifest)
+            if (old is not None and self._manifest_path(key, old) == path
+                    and self._manifest_entry(key, old) == self._manifest_entry(key, manifest)):
+                continue
+            if not os.path.exists(path):
+                with self._lock:
+                    self._generations.pop(key, None)
+                continue
+            generation = self._new_generation(key)
+            try:
+                if current.source is not None:
+                    self._read_model(key, generation)
+                session = self._create_session(key, generation)
+                self._record(generation, session)
+                self._warm_session(generation, session, current.warm_sizes)
+            except Exception as e:
+                logger.error("Keeping the previous %s model: %s", key, e)
+                continue
+            generation.warm_sizes = current.warm_sizes
+            generation.created = 1
+            generation.idle.put(session)
+            with self._lock:
+                self._generations[key] = generation
+            swapped.append(key)
+        return swapped
+
+    def preload(self):
+        """Builds one session per available style; returns the styles that loaded."""
+        loaded = []
+        for style in self.styles:
+            if not self.has_model(style):
+                logger.warning("Skipping preload, model not found: %s", self.model_path(style))
+                continue
+            with self.session(style):
+                loaded.append(style)
+        return loaded
@@ -0,0 +1,256 @@
+import io
+import logging
+import statistics
+import threading
+import time
+import uuid
+from collections import deque
+
+import numpy as np
+from PIL import Image
+
+from neural_style import metrics
+from neural_style.image_io import from_model_output, to_nchw
+from neural_style.postprocess import fused_postprocess
+
+logger = logging.getLogger(__name__)
+
+STREAM_STAGES = ('decode', 'infer', 'encode')
+
+
+class TooManyStreams(Exception):
+    """Raised when a stream is opened while every stream slot is taken."""
+
+
+class LatestSlot:
+    """Hand-off between two pipeline stages that only keeps the newest item.
+
+    put() replaces an item the consumer has not picked up yet (counted in
+    `dropped`), so a slow stage always works on the freshest frame instead of
+    a growing backlog.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._item = None
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self._cond:
+            if self._item is not None:
+                self.dropped += 1
+            self._item = item
+            self._cond.notify()
+
+    def get(self):
+        """Blocks for the next item; returns None once the slot is closed."""
+        with self._cond:
+            while self._item is None and not self._closed:
+                self._cond.wait()
+            item, self._item = self._item, None
+            return item
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class StreamSession:
+    """Stylizes a stream of JPEG frames in a decode -> infer -> encode pipeline.
+
+    Each stage runs on its own thread, so decoding frame n+2 and encoding frame n
+    overlap with inference on frame n+1. Stages hand over through LatestSlots:
+    when inference falls behind, stale frames are dropped rather than queued.
+    `target_size(size)` gives the (width, height) a frame of `size` runs at;
+    stylized frames are encoded at that size. With `uint8_io`, frames go to
+    `run_model` as 1xHxWx3 uint8 pixels. With `incremental` (an
+    IncrementalStylizer around the same model), only the parts of a frame that
+    changed since the previous one are restylized. Nothing is written to disk.
+    """
+
+    def __init__(self, run_model, target_size, quality=75, sharpen=False, contrast=1.2, window=30,
+                 uint8_io=False, incremental=None):
+        self.run_model = run_model
+        self.target_size = target_size
+        self.uint8_io = uint8_io
+        self.incremental = incremental
+        self.quality = quality
+        self.sharpen = sharpen
+        self.contrast = contrast
+
+        self._slots = {stage: LatestSlot() for stage in STREAM_STAGES}
+        self._output = threading.Condition()
+        self._frame = None   # (sequence, jpeg bytes) of the newest stylized frame
+        self._sequence = 0
+        self._closed = False
+        self._completed = deque(maxlen=window)
+        self._latencies = deque(maxlen=window)
+        self._stage_ms = {stage: deque(maxlen=window) for stage in STREAM_STAGES}
+        self.frames_in = 0
+        self.errors = 0
+        self.last_active = time.time()
+
+        handlers = {'decode': self._decode, 'infer': self._infer, 'encode': self._encode}
+        self._threads = []
+        for i, stage in enumerate(STREAM_STAGES):
+            following = self._slots[STREAM_STAGES[i + 1]] if i + 1 < len(STREAM_STAGES) else None
+            thread = threading.Thread(target=self._run_stage, args=(stage, handlers[stage], following),
+                                      name=f"stream-{stage}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def push(self, jpeg):
+        """Queues a frame; replaces the previous one if decoding hasn't started on it."""
+        self.frames_in += 1
+        self.last_active = time.time()
+        self._slots['decode'].put((time.perf_counter(), jpeg))
+
+    def _run_stage(self, stage, handler, following):
+        slot = self._slots[stage]
+        while True:
+            item = slot.get()
+            if item is None:
+                return
+            received, data = item
+            start = time.perf_counter()
+            try:
+                with metrics.span(f"stream_{stage}"):
+                    result = handler(data)
+            except Exception as e:
+                self.errors += 1
+                metrics.ERRORS.inc(where=f"stream_{stage}", type=type(e).__name__)
+                logger.warning("Stream %s error: %s", stage, e)
+                continue
+            self._stage_ms[stage].append((time.perf_counter() - start) * 1000)
+            if following is not None:
+                following.put((received, result))
+            else:
+                self._publish(received, result)
+
+    def _decode(self, jpeg):
+        img = Image.open(io.BytesIO(jpeg))
+        size = self.target_size(img.size)
+        img.draft('RGB', size)   # lets the JPEG decoder skip detail we are about to throw away
+        img = img.convert('RGB')
+        if img.size != size:
+            img = img.resize(size, Image.BILINEAR)
+        if self.incremental is not None:
+            return np.asarray(img)
+        if self.uint8_io:
+            return np.asarray(img)[np.newaxis]
+        # Own buffer: the thread-local one would be overwritten while inference still reads it
+        return to_nchw(img, out=np.empty((1, 3, size[1], size[0]), dtype=np.float32))
+
+    def _infer(self, tensor):
+        if self.incremental is not None:
+            return self.incremental.stylize(tensor)
+        return self.run_model(tensor)
+
+    def _encode(self, output):
+        pixels = from_model_output(output)
+        if self.sharpen or self.contrast != 1.0:
+            pixels = fused_postprocess(pixels, self.sharpen, self.contrast)
+        buf = io.BytesIO()
+        Image.fromarray(pixels).save(buf, 'JPEG', quality=self.quality)
+        return buf.getvalue()
+
+    def _publish(self, received, jpeg):
+        now = time.perf_counter()
+        with self._output:
+            self._sequence += 1
+            self._frame = (self._sequence, jpeg)
+            self._completed.append(now)
+            self._latencies.append((now - received) * 1000)
+            self._output.notify_all()
+
+    def frames(self, timeout=5.0):
+        """Yields every new stylized JPEG as it is published; skips frames a slow
+        reader missed. Stops when the session closes or no frame arrives in `timeout`."""
+        last = 0
+        while True:
+            with self._output:
+                if not self._output.wait_for(lambda: self._closed or self._sequence > last, timeout):
+                    return
+                if self._closed:
+                    return
+                last, jpeg = self._frame
+            self.last_active = time.time()
+            yield jpeg
+
+    def stats(self):
+        with self._output:
+            completed = list(self._completed)
+            latencies = sorted(self._latencies)
+            frames_out = self._sequence
+        span = completed[-1] - completed[0] if len(completed) > 1 else 0
+        stats = {
+            'frames_in': self.frames_in,
+            'frames_out': frames_out,
+            'dropped': sum(slot.dropped for slot in self._slots.values()),
+            'errors': self.errors,
+            'fps': round((len(completed) - 1) / span, 2) if span else 0.0,
+            'latency_ms_p50': round(statistics.median(latencies), 1) if latencies else None,
+            'latency_ms_max': round(latencies[-1], 1) if latencies else None,
+            'stage_ms': {stage: round(statistics.mean(samples), 1) if samples else None
+                         for stage, samples in self._stage_ms.items()}
+        }
+        if self.incremental is not None:
+            stats['reuse_ratio'] = round(self.incremental.reuse_ratio, 3)
+        return stats
+
+    def close(self):
+        with self._output:
+            self._closed = True
+            self._output.notify_all()
+        for slot in self._slots.values():
+            slot.close()
+
+
+class StreamRegistry:
+    """The open StreamSessions of one web worker, keyed by id.
+
+    At most `max_streams` are open at once; sessions without a pushed or read
+    frame for `idle_timeout` seconds are closed on the next open().
+    """
+
+    def __init__(self, max_streams=4, idle_timeout=30):
+        self.max_streams = max_streams
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._streams = {}
+
+    def open(self, factory):
+        """Creates a session with factory() and returns (stream_id, session)."""
+        self._sweep()
+        with self._lock:
+            if len(self._streams) >= self.max_streams:
+                raise TooManyStreams(f"{len(self._streams)} streams already open")
+            stream_id = uuid.uuid4().hex
+            session = self._streams[stream_id] = factory()
+        return stream_id, session
+
+    def get(self, stream_id):
+        with self._lock:
+            return self._streams.get(stream_id)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._streams)
+
+    def close(self, stream_id):
+        with self._lock:
+            session = self._streams.pop(stream_id, None)
+        if session is not None:
+            session.close()
+        return session is not None
+
+    def _sweep(self):
+        now = time.time()
+        with self._lock:
+            idle = [stream_id for stream_id, session in self._streams.items()
+                    if now - session.last_active > self.idle_timeout]
+        for stream_id in idle:
+            logger.info("Closing idle stream: %s", stream_id)
+            self.close(stream_id)
@@ -1,22 +1,23 @@
-import torch
-from torchvision import transforms
-from PIL import Image, ImageFilter, ImageEnhance
+from PIL import Image
 import onnxruntime as ort
 import numpy as np
 import os
 import sys
 
+# Allow running as `python neural_style/stylize_image.py` from the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from neural_style.image_io import from_model_output, to_model_input
+from neural_style.session_pool import run_session
+from neural_style.postprocess import fused_postprocess
+from neural_style.registry import MANIFEST_FILE, load_manifest
+from neural_style.tiling import stylize_tiled
+
 # -----------------------------
 # CONFIG
 # -----------------------------
-# Available styles with their corresponding ONNX model files
-STYLES = {
-    '1': {'name': 'Mosaic', 'model': 'mosaic.onnx'},
-    '2': {'name': 'Ghibli', 'model': 'ghibli_style.onnx'},
-    '3': {'name': 'udnie', 'model': 'udnie.onnx'},      # You'll need to add this file
-    '4': {'name': 'Rain Princess', 'model': 'rain_princess.onnx'},  # You'll need to add this file
-    '5': {'name': 'Candy', 'model': 'candy.onnx'}       # You'll need to add this file
-}
+# Available styles and their ONNX model files come from the model manifest
+# (the built-in styles' <style>.onnx when there is none)
+manifest_path = MANIFEST_FILE
 
 # Default paths
 content_image_path = "test_image.jpg"
@@ -25,6 +26,8 @@ final_output_path = "final_output.jpg"
 blended_output_path = "blended_output.jpg"
 imsize = 1024  # Increase to 2048 if your system can handle it
 style_alpha = 0.8  # Blend intensity (0.0 = no style, 1.0 = full style)
+use_tiles = False  # Stylize at the image's own resolution in imsize tiles
+tile_overlap = 64
 
 # -----------------------------
 # Style Selection Menu
@@ -34,13 +37,15 @@ def select_style():
     print("NEURAL STYLE TRANSFER - STYLE SELECTION")
     print("="*50)
     print("\nAvailable Styles:")
-    for key, style in STYLES.items():
-        print(f"{key}. {style['name']}")
+    manifest = load_manifest(manifest_path)
+    styles = {str(number): style for number, style in enumerate(manifest.styles, 1)}
+    for key, style in styles.items():
+        print(f"{key}. {manifest.styles[style]}")
     
     while True:
-        choice = input("\nSelect a style (1-5): ")
-        if choice in STYLES:
-            return STYLES[choice]['model']
+        choice = input(f"\nSelect a style (1-{len(styles)}): ")
+        if choice in styles:
+            return manifest.model_path(styles[choice])
         print("Invalid choice. Please try again.")
 
 # -----------------------------
@@ -57,15 +62,10 @@ def load_image(filename, size=None):
 # -----------------------------
 # Preprocessing & Postprocessing
 # -----------------------------
-preprocess = transforms.Compose([
-    transforms.ToTensor(),
-    transforms.Lambda(lambda x: x.mul(255))
-])
-
-postprocess = transforms.Compose([
-    transforms.Lambda(lambda x: x.mul(1.0 / 255)),
-    transforms.ToPILImage()
-])
+# uint8 HWC -> float32 NCHW (0-255) and back, without going through torch; models
+# exported with --uint8-io take the decoded pixels as they are
+preprocess = to_model_input
+postprocess = from_model_output
 
 # -----------------------------
 # Main function
@@ -84,36 +84,38 @@ def main():
     try:
         # Load content image
         print(f"\n📷 Loading content image: {content_image_path}")
-        content_image = load_image(content_image_path, imsize)
-        content_tensor = preprocess(content_image).unsqueeze(0).cpu().numpy()
+        content_image = load_image(content_image_path, None if use_tiles else imsize)
 
         # Load ONNX model
         print(f"🧠 Loading ONNX model: {onnx_model_path}")
         ort_session = ort.InferenceSession(onnx_model_path)
+        uint8_io = ort_session.get_inputs()[0].type == 'tensor(uint8)'
 
         # Perform inference
         print("🎨 Applying style transfer...")
-        stylized = ort_session.run(None, {"input": content_tensor})[0]
+        if use_tiles:
+            stylized = stylize_tiled(preprocess(content_image), lambda tiles: run_session(ort_session, tiles),
+                                     imsize, overlap=tile_overlap, batch_size=1)
+        else:
+            stylized = ort_session.run(None, {"input": preprocess(content_image, uint8_io)})[0]
 
-        # Convert output to PIL image
-        output_tensor = torch.from_numpy(stylized.squeeze())
-        output_image = postprocess(output_tensor)
-        output_image.save(output_image_path)
+        # Convert output to a uint8 HxWx3 array
+        output_pixels = postprocess(stylized)
+        Image.fromarray(output_pixels).save(output_image_path)
         print(f"✅ Saved raw stylized image to {output_image_path}")
 
         # Optional sharpening & contrast enhancement
         print("🔧 Applying sharpening and contrast enhancement...")
-        sharp_img = output_image.filter(ImageFilter.SHARPEN)
-        enhancer = ImageEnhance.Contrast(sharp_img)
-        final_img = enhancer.enhance(1.2)
-        final_img.save(final_output_path)
+        final_pixels = fused_postprocess(output_pixels, sharpen=True, contrast=1.2)
+        Image.fromarray(final_pixels).save(final_output_path)
         print(f"✨ Final enhanced image saved as {final_output_path}")
 
         # Optional blending with original for style intensity
         print("🎨 Creating blended image...")
-        content_img = load_image(content_image_path, imsize)
-        blended_img = Image.blend(content_img, final_img, alpha=style_alpha)
-        blended_img.save(blended_output_path)
+        # Reuses the content image already in memory; the result goes back into output_pixels
+        blended_pixels = fused_postprocess(final_pixels, sharpen=False, contrast=1.0, blend_alpha=style_alpha,
+                                           content=np.asarray(content_image), out=output_pixels)
+        Image.fromarray(blended_pixels).save(blended_output_path)
         print(f"🎭 Blended style output saved as {blended_output_path}")
         
         print("\n" + "="*50)
@@ -0,0 +1,58 @@
+import numpy as np
+
+
+def tile_origins(length, tile_size, overlap):
+    """Start offsets of tiles covering [0, length) with at least `overlap` pixels shared."""
+    if length <= tile_size:
+        return [0]
+    step = tile_size - overlap
+    if step <= 0:
+        raise ValueError("overlap must be smaller than the tile size")
+    count = -(-(length - overlap) // step)
+    # Spread the tiles evenly so the last one ends exactly at the border
+    return [round(i * (length - tile_size) / (count - 1)) for i in range(count)]
+
+
+def feather_weights(tile_size, overlap):
+    """2D blending weights that ramp up linearly over `overlap` pixels from each edge."""
+    ramp = np.ones(tile_size, dtype=np.float32)
+    if overlap > 0:
+        edge = (np.arange(overlap, dtype=np.float32) + 1) / (overlap + 1)
+        ramp[:overlap] = edge
+        ramp[-overlap:] = np.minimum(ramp[-overlap:], edge[::-1])
+    return np.outer(ramp, ramp)
+
+
+def stylize_tiled(content_tensor, run_model, tile_size, overlap=64, batch_size=4):
+    """Stylizes a 1x3xHxW tensor of any size in overlapping tiles.
+
+    Tiles are run `batch_size` at a time through `run_model` (which takes and
+    returns an Nx3xTxT float32 array) and feather-blended back together, so model
+    memory depends on the tile size and batch size, not on the image size. Images
+    smaller than a tile are reflection-padded up to the tile size.
+    """
+    _, channels, height, width = content_tensor.shape
+    pad_h = max(0, tile_size - height)
+    pad_w = max(0, tile_size - width)
+    if pad_h or pad_w:
+        content_tensor = np.pad(content_tensor, ((0, 0), (0, 0), (0, pad_h), (0, pad_w)), mode='reflect')
+    padded_h, padded_w = content_tensor.shape[2:]
+
+    overlap = min(overlap, tile_size // 2)
+    weights = feather_weights(tile_size, overlap)
+    output = np.zeros((channels, padded_h, padded_w), dtype=np.float32)
+    weight_sum = np.zeros((padded_h, padded_w), dtype=np.float32)
+
+    origins = [(y, x)
+               for y in tile_origins(padded_h, tile_size, overlap)
+               for x in tile_origins(padded_w, tile_size, overlap)]
+    for start in range(0, len(origins), batch_size):
+        batch_origins = origins[start:start + batch_size]
+        batch = np.stack([content_tensor[0, :, y:y + tile_size, x:x + tile_size] for y, x in batch_origins])
+        stylized = run_model(np.ascontiguousarray(batch))
+        for tile, (y, x) in zip(stylized, batch_origins):
+            output[:, y:y + tile_size, x:x + tile_size] += tile * weights
+            weight_sum[y:y + tile_size, x:x + tile_size] += weights
+
+    output /= weight_sum
+    return output[np.newaxis, :, :height, :width]
@@ -1,82 +1,154 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 class TransformerNet(nn.Module):
-    def __init__(self):
+    """Image transformation network.
+
+    The defaults are the original architecture (32/64/128 channels, five
+    residual blocks) whose checkpoints the style models ship as. Slimmer
+    variants for CPU serving scale every channel count by `width_mult`, keep
+    `num_residual` residual blocks and, with `depthwise`, replace the plain
+    convolutions by depthwise-separable ones; train them with distill.py.
+
+    With `styles` (a list of style names), one network serves all of them: the
+    convolutions are shared and every normalization layer keeps a scale/shift
+    per style (ConditionalGroupNorm). forward() then takes a style index per
+    image as well.
+    """
+
+    def __init__(self, width_mult=1.0, num_residual=5, depthwise=False, styles=None):
         super(TransformerNet, self).__init__()
+        self.config = {'width_mult': width_mult, 'num_residual': num_residual, 'depthwise': depthwise}
+        if styles:
+            self.config['styles'] = list(styles)
+        self.styles = list(styles) if styles else None
+        num_styles = len(styles) if styles else None
+        c1, c2, c3 = (max(4, int(round(channels * width_mult))) for channels in (32, 64, 128))
+
         # Initial convolution layers
-        self.conv1 = ConvLayer(3, 32, kernel_size=9, stride=1)
-        self.in1 = nn.GroupNorm(32, 32)   # ✅ ONNX friendly
+        self.conv1 = ConvLayer(3, c1, kernel_size=9, stride=1, depthwise=depthwise)
+        self.in1 = group_norm(c1, num_styles)   # ✅ ONNX friendly
 
-        self.conv2 = ConvLayer(32, 64, kernel_size=3, stride=2)
-        self.in2 = nn.GroupNorm(64, 64)
+        self.conv2 = ConvLayer(c1, c2, kernel_size=3, stride=2, depthwise=depthwise)
+        self.in2 = group_norm(c2, num_styles)
 
-        self.conv3 = ConvLayer(64, 128, kernel_size=3, stride=2)
-        self.in3 = nn.GroupNorm(128, 128)
+        self.conv3 = ConvLayer(c2, c3, kernel_size=3, stride=2, depthwise=depthwise)
+        self.in3 = group_norm(c3, num_styles)
 
-        # Residual layers
-        self.res1 = ResidualBlock(128)
-        self.res2 = ResidualBlock(128)
-        self.res3 = ResidualBlock(128)
-        self.res4 = ResidualBlock(128)
-        self.res5 = ResidualBlock(128)
+        # Residual layers (named res1, res2, ... as in the original checkpoints)
+        self.residual_names = [f"res{i + 1}" for i in range(num_residual)]
+        for name in self.residual_names:
+            setattr(self, name, ResidualBlock(c3, depthwise=depthwise, num_styles=num_styles))
 
         # Upsampling Layers
-        self.deconv1 = UpsampleConvLayer(128, 64, kernel_size=3, stride=1, upsample=2)
-        self.in4 = nn.GroupNorm(64, 64)
+        self.deconv1 = UpsampleConvLayer(c3, c2, kernel_size=3, stride=1, upsample=2)
+        self.in4 = group_norm(c2, num_styles)
 
-        self.deconv2 = UpsampleConvLayer(64, 32, kernel_size=3, stride=1, upsample=2)
-        self.in5 = nn.GroupNorm(32, 32)
+        self.deconv2 = UpsampleConvLayer(c2, c1, kernel_size=3, stride=1, upsample=2)
+        self.in5 = group_norm(c1, num_styles)
 
-        self.deconv3 = ConvLayer(32, 3, kernel_size=9, stride=1)
+        self.deconv3 = ConvLayer(c1, 3, kernel_size=9, stride=1, depthwise=depthwise)
 
         self.relu = nn.ReLU()
 
-    def forward(self, X):
-        y = self.relu(self.in1(self.conv1(X)))
-        y = self.relu(self.in2(self.conv2(y)))
-        y = self.relu(self.in3(self.conv3(y)))
+    def forward(self, X, style=None):
+        y = self.relu(normalize(self.in1, self.conv1(X), style))
+        y = self.relu(normalize(self.in2, self.conv2(y), style))
+        y = self.relu(normalize(self.in3, self.conv3(y), style))
 
         # Residual blocks
-        y = self.res1(y)
-        y = self.res2(y)
-        y = self.res3(y)
-        y = self.res4(y)
-        y = self.res5(y)
+        for name in self.residual_names:
+            y = getattr(self, name)(y, style)
 
         # Upsample
-        y = self.relu(self.in4(self.deconv1(y)))
-        y = self.relu(self.in5(self.deconv2(y)))
+        y = self.relu(normalize(self.in4, self.deconv1(y), style))
+        y = self.relu(normalize(self.in5, self.deconv2(y), style))
         y = self.deconv3(y)
         return y
 
+    def init_from_models(self, models):
+        """Starts a multi-style network from one single-style network per style
+        (same architecture): the convolutions come from the first one, and every
+        style's scale/shift rows from its own model's norm layers."""
+        state = self.state_dict()
+        sources = [model.state_dict() for model in models]
+        norms = {f"{name}.{param}" for name, module in self.named_modules()
+                 if isinstance(module, ConditionalGroupNorm) for param in ('weight', 'bias')}
+        for key, value in state.items():
+            if key in norms:
+                state[key] = torch.stack([source[key] for source in sources])
+            elif sources[0][key].shape != value.shape:
+                raise ValueError(f"{key}: {tuple(sources[0][key].shape)} != {tuple(value.shape)}")
+            else:
+                state[key] = sources[0][key]
+        self.load_state_dict(state)
+
+
+class ConditionalGroupNorm(nn.Module):
+    """GroupNorm whose affine scale and shift are rows of per-style tables,
+    picked by an int64 style index per image (a Gather in the exported graph)."""
+    def __init__(self, num_groups, num_channels, num_styles, eps=1e-5):
+        super(ConditionalGroupNorm, self).__init__()
+        self.num_groups = num_groups
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(num_styles, num_channels))
+        self.bias = nn.Parameter(torch.zeros(num_styles, num_channels))
+
+    def forward(self, x, style):
+        out = F.group_norm(x, self.num_groups, eps=self.eps)
+        weight = self.weight.index_select(0, style)[:, :, None, None]
+        bias = self.bias.index_select(0, style)[:, :, None, None]
+        return out * weight + bias
+
+
+def group_norm(channels, num_styles=None):
+    """The network's per-channel GroupNorm, conditional on the style when `num_styles` is set."""
+    if num_styles:
+        return ConditionalGroupNorm(channels, channels, num_styles)
+    return nn.GroupNorm(channels, channels)
+
+
+def normalize(norm, x, style):
+    if isinstance(norm, ConditionalGroupNorm):
+        return norm(x, style)
+    return norm(x)
+
 
 class ConvLayer(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel_size, stride):
+    def __init__(self, in_channels, out_channels, kernel_size, stride, depthwise=False):
         super(ConvLayer, self).__init__()
         reflection_padding = kernel_size // 2
         self.reflection_pad = nn.ReflectionPad2d(reflection_padding)
-        self.conv2d = nn.Conv2d(in_channels, out_channels, kernel_size, stride)
+        if depthwise:
+            # Depthwise-separable: a per-channel kxk conv, then a 1x1 conv that mixes channels
+            self.depthwise = nn.Conv2d(in_channels, in_channels, kernel_size, stride, groups=in_channels)
+            self.conv2d = nn.Conv2d(in_channels, out_channels, kernel_size=1)
+        else:
+            self.depthwise = None
+            self.conv2d = nn.Conv2d(in_channels, out_channels, kernel_size, stride)
 
     def forward(self, x):
         out = self.reflection_pad(x)
+        if self.depthwise is not None:
+            out = self.depthwise(out)
         out = self.conv2d(out)
         return out
 
 
 class ResidualBlock(nn.Module):
     """ResidualBlock"""
-    def __init__(self, channels):
+    def __init__(self, channels, depthwise=False, num_styles=None):
         super(ResidualBlock, self).__init__()
-        self.conv1 = ConvLayer(channels, channels, kernel_size=3, stride=1)
-        self.in1 = nn.GroupNorm(channels, channels)
-        self.conv2 = ConvLayer(channels, channels, kernel_size=3, stride=1)
-        self.in2 = nn.GroupNorm(channels, channels)
+        self.conv1 = ConvLayer(channels, channels, kernel_size=3, stride=1, depthwise=depthwise)
+        self.in1 = group_norm(channels, num_styles)
+        self.conv2 = ConvLayer(channels, channels, kernel_size=3, stride=1, depthwise=depthwise)
+        self.in2 = group_norm(channels, num_styles)
         self.relu = nn.ReLU()
 
-    def forward(self, x):
-        out = self.relu(self.in1(self.conv1(x)))
-        out = self.in2(self.conv2(out))
+    def forward(self, x, style=None):
+        out = self.relu(normalize(self.in1, self.conv1(x), style))
+        out = normalize(self.in2, self.conv2(out), style)
         out = out + x
         return out
 
@@ -100,3 +172,19 @@ class UpsampleConvLayer(nn.Module):
     def forward(self, x):
         out = self.conv2d(x)
         return out
+
+
+class Uint8ImageIO(nn.Module):
+    """Wraps a model so it takes and returns NxHxWx3 uint8 images.
+
+    The cast and transpose to Nx3xHxW float, and the clamp, cast and transpose
+    back, become part of the exported graph, so callers hand decoded pixels
+    straight to onnxruntime.
+    """
+    def __init__(self, model):
+        super(Uint8ImageIO, self).__init__()
+        self.model = model
+
+    def forward(self, x, *args):
+        out = self.model(x.permute(0, 3, 1, 2).float(), *args)
+        return out.clamp(0, 255).to(torch.uint8).permute(0, 2, 3, 1)
@@ -0,0 +1,86 @@
+import os
+import re
+import threading
+import time
+
+
+class UploadStore:
+    """Bounded retention store for the original uploads that were asked to be kept.
+
+    Files are named `<digest>.<ext>`, so re-uploads of the same bytes share one
+    file. The store is swept (at most every `sweep_interval` seconds, on save) of
+    files older than `ttl` seconds, then trimmed oldest first to `max_bytes`.
+    Other files in the folder are never touched. watch() also sweeps on a daemon
+    thread, so uploads expire when nothing new is saved; start it after any fork.
+    """
+
+    def __init__(self, folder, ttl=24 * 3600, max_bytes=512 * 1024 * 1024, sweep_interval=60):
+        self.folder = folder
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0
+        self._thread = None
+        os.makedirs(folder, exist_ok=True)
+
+    def _is_stored_file(self, name):
+        return re.fullmatch(r'[0-9a-f]{32}\.\w+', name) is not None
+
+    def save(self, digest, ext, data):
+        """Keeps `data` as <digest[:32]>.<ext> and returns that filename."""
+        filename = f"{digest[:32]}.{ext}"
+        path = os.path.join(self.folder, filename)
+        try:
+            os.utime(path)   # already stored: just extend its retention
+        except FileNotFoundError:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        self.sweep()
+        return filename
+
+    def sweep(self, force=False):
+        """Deletes expired uploads, then the oldest ones over the size budget."""
+        now = time.time()
+        if not force and now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+
+        entries = []
+        for entry in os.scandir(self.folder):
+            if not entry.is_file() or not self._is_stored_file(entry.name):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.ttl:
+                self._remove(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def watch(self):
+        """Starts sweeping every `sweep_interval` seconds (once per process)."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        def poll():
+            while True:
+                time.sleep(self.sweep_interval)
+                self.sweep()
+
+        self._thread = threading.Thread(target=poll, name='upload-sweep', daemon=True)
+        self._thread.start()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
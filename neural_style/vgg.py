@@ -0,0 +1,38 @@
+from collections import namedtuple
+
+import torch
+from torchvision import models
+
+VggOutputs = namedtuple("VggOutputs", ['relu1_2', 'relu2_2', 'relu3_3', 'relu4_3'])
+
+
+class Vgg16(torch.nn.Module):
+    """Frozen VGG-16 feature extractor for perceptual and Gram-matrix losses.
+
+    Takes a batch normalized with utils.normalize_batch. The ImageNet weights
+    come from torchvision (downloaded once), or from a saved state dict of
+    torchvision's vgg16 at `weights_path`.
+    """
+
+    def __init__(self, weights_path=None, requires_grad=False):
+        super(Vgg16, self).__init__()
+        if weights_path:
+            vgg = models.vgg16(weights=None)
+            vgg.load_state_dict(torch.load(weights_path, map_location='cpu'))
+        else:
+            vgg = models.vgg16(weights=models.VGG16_Weights.IMAGENET1K_V1)
+        features = vgg.features
+        self.slice1 = features[:4]
+        self.slice2 = features[4:9]
+        self.slice3 = features[9:16]
+        self.slice4 = features[16:23]
+        if not requires_grad:
+            for param in self.parameters():
+                param.requires_grad = False
+
+    def forward(self, X):
+        h_relu1_2 = self.slice1(X)
+        h_relu2_2 = self.slice2(h_relu1_2)
+        h_relu3_3 = self.slice3(h_relu2_2)
+        h_relu4_3 = self.slice4(h_relu3_3)
+        return VggOutputs(h_relu1_2, h_relu2_2, h_relu3_3, h_relu4_3)
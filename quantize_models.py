@@ -0,0 +1,266 @@
+import argparse
+import glob
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import numpy as np
+import onnx
+import onnxruntime as ort
+from onnx import numpy_helper, version_converter
+from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType,
+                                      quantize_dynamic, quantize_static)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+from PIL import Image
+
+from neural_style.image_io import from_model_output
+from neural_style.image_quality import psnr, ssim
+from neural_style.registry import MANIFEST_FILE, load_manifest, register_model
+from neural_style.session_pool import model_name
+
+CALIBRATION_FOLDER = 'uploads'
+CALIBRATION_IMAGES = 16
+DYNAMIC_SHAPE_SIZE = 512   # Calibration/benchmark size for models without a fixed input shape
+CALIBRATION_MAX_SIZE = 512  # Fixed-shape models are calibrated on a copy scaled down to this
+QDQ_OPSET = 13             # Per-channel QuantizeLinear/DequantizeLinear need opset 13
+
+
+def list_images(folder, limit):
+    paths = []
+    for ext in ('jpg', 'jpeg', 'png'):
+        paths.extend(glob.glob(os.path.join(folder, f"*.{ext}")))
+    return sorted(paths)[:limit]
+
+
+def takes_uint8(onnx_path):
+    """True for models exported with uint8 image I/O (NxHxWx3 in and out)."""
+    session = ort.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+    return session.get_inputs()[0].type == 'tensor(uint8)'
+
+
+def model_input_size(onnx_path):
+    """(width, height) of a fixed-shape model, or a square default for dynamic ones."""
+    session = ort.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+    model_input = session.get_inputs()[0]
+    height, width = model_input.shape[1:3] if model_input.type == 'tensor(uint8)' else model_input.shape[2:4]
+    if isinstance(height, int) and isinstance(width, int):
+        return width, height
+    return DYNAMIC_SHAPE_SIZE, DYNAMIC_SHAPE_SIZE
+
+
+def calibration_size(size, limit=CALIBRATION_MAX_SIZE):
+    """`size` divided by the smallest integer factor that fits it in `limit` and
+    keeps both sides multiples of 4 (the two stride-2 stages); `size` itself
+    when there is no such factor."""
+    width, height = size
+    for factor in range(max(1, -(-max(size) // limit)), min(size) // 4 + 1):
+        if width % (4 * factor) == 0 and height % (4 * factor) == 0:
+            return width // factor, height // factor
+    return size
+
+
+def load_tensor(path, size, uint8=False):
+    """Model input for an image file: 1x3xHxW float32, or 1xHxWx3 uint8 for uint8 I/O models."""
+    img = Image.open(path).convert("RGB").resize(size, Image.LANCZOS)
+    if uint8:
+        return np.asarray(img)[np.newaxis]
+    return np.ascontiguousarray(np.asarray(img, dtype=np.float32).transpose(2, 0, 1)[np.newaxis])
+
+
+class ImageCalibrationReader(CalibrationDataReader):
+    """Feeds calibration images to quantize_static, one image at a time."""
+
+    def __init__(self, paths, size, uint8=False, input_name='input'):
+        self.paths = iter(paths)
+        self.size = size
+        self.uint8 = uint8
+        self.input_name = input_name
+
+    def get_next(self):
+        path = next(self.paths, None)
+        if path is None:
+            return None
+        return {self.input_name: load_tensor(path, self.size, self.uint8)}
+
+
+def prepare_model(onnx_path, work_dir):
+    """Runs the quantization pre-processing (shape inference + fusions) and moves to QDQ_OPSET."""
+    prepared_path = os.path.join(work_dir, 'prepared.onnx')
+    quant_pre_process(onnx_path, prepared_path, skip_symbolic_shape=True)
+    model = onnx.load(prepared_path)
+    if model.opset_import[0].version < QDQ_OPSET:
+        model = version_converter.convert_version(model, QDQ_OPSET)
+        onnx.save(model, prepared_path)
+    return prepared_path
+
+
+def resize_fixed_model(onnx_path, size):
+    """Rewrites a fixed-shape model in place to take (width, height) `size` images.
+
+    Only the input/output dims and the constant 4-D Reshape targets (the
+    exported instance norms) depend on the image size; they are scaled by the
+    ratio of the sizes, so tensor names stay the same and calibration ranges
+    from the resized model apply to the original one.
+    """
+    model = onnx.load(onnx_path)
+    uint8 = model.graph.input[0].type.tensor_type.elem_type == onnx.TensorProto.UINT8
+    image_axis = 1 if uint8 else 2   # Height axis of the image input and output (NxHxWx3 for uint8)
+    dims = model.graph.input[0].type.tensor_type.shape.dim
+    old_height, old_width = dims[image_axis].dim_value, dims[image_axis + 1].dim_value
+    width, height = size
+
+    def scaled(shape, axis=2):
+        shape = list(shape)
+        shape[axis] = shape[axis] * height // old_height
+        shape[axis + 1] = shape[axis + 1] * width // old_width
+        return shape
+
+    for value in (model.graph.input[0], model.graph.output[0]):
+        value_dims = value.type.tensor_type.shape.dim
+        for dim, new_value in zip(value_dims, scaled([dim.dim_value for dim in value_dims], image_axis)):
+            dim.dim_value = new_value
+    reshape_targets = {node.input[1] for node in model.graph.node if node.op_type == 'Reshape'}
+    constants = [(tensor, tensor.name) for tensor in model.graph.initializer]
+    constants += [(node.attribute[0].t, node.output[0]) for node in model.graph.node
+                  if node.op_type == 'Constant' and node.attribute[0].name == 'value']
+    for tensor, name in constants:
+        if name in reshape_targets and tensor.data_type == onnx.TensorProto.INT64 and list(tensor.dims) == [4]:
+            tensor.CopyFrom(numpy_helper.from_array(
+                np.array(scaled(numpy_helper.to_array(tensor).tolist()), dtype=np.int64), tensor.name))
+    del model.graph.value_info[:]   # Inferred for the old size; onnxruntime infers them again
+    onnx.save(model, onnx_path)
+
+
+def quantize_variant(onnx_path, variant, output_path, calibration_paths):
+    print(f"\n🔄 Building {variant} variant: {output_path}")
+    with tempfile.TemporaryDirectory() as work_dir:
+        if variant == 'fp16':
+            from onnxruntime.transformers.float16 import convert_float_to_float16
+            model = convert_float_to_float16(onnx.load(onnx_path), keep_io_types=True)
+            onnx.save(model, output_path)
+        elif variant == 'int8-dynamic':
+            quantize_dynamic(prepare_model(onnx_path, work_dir), output_path, weight_type=QuantType.QUInt8)
+        elif variant == 'int8-static':
+            if not calibration_paths:
+                print(f"⚠️ No calibration images found, skipping {variant}")
+                return False
+            # Calibration makes every intermediate tensor a model output, kept until the end of
+            # each run: at 1024x1024 that alone takes several GB, so large fixed-shape models
+            # are calibrated on a scaled-down copy (instance norm keeps the ranges comparable)
+            prepared_path = prepare_model(onnx_path, work_dir)
+            size = model_input_size(onnx_path)
+            calibration = calibration_size(size)
+            if calibration != size:
+                resize_fixed_model(prepared_path, calibration)
+            reader = ImageCalibrationReader(calibration_paths, calibration, takes_uint8(onnx_path))
+            quantize_static(prepared_path, output_path, reader,
+                            quant_format=QuantFormat.QDQ, per_channel=True,
+                            activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+            if calibration != size:
+                resize_fixed_model(output_path, size)
+        else:
+            raise ValueError(f"Unknown variant: {variant}")
+    print(f"✅ Saved {output_path} ({os.path.getsize(output_path) / 1e6:.1f} MB)")
+    return True
+
+
+def benchmark_variants(style, variants, image_paths, runs):
+    """Latency, size and fidelity against fp32 for every built variant of a style."""
+    base_path = f"{style}.onnx"
+    size = model_input_size(base_path)
+    inputs = {uint8: [load_tensor(path, size, uint8) for path in image_paths] for uint8 in (False, True)}
+
+    results = []
+    references = None
+    for variant in ['fp32'] + variants:
+        path = f"{model_name(style, variant)}.onnx"
+        if not os.path.exists(path):
+            continue
+        session = ort.InferenceSession(path, providers=['CPUExecutionProvider'])
+        model_input = session.get_inputs()[0]
+        input_name = model_input.name
+        tensors = inputs[model_input.type == 'tensor(uint8)']
+        session.run(None, {input_name: tensors[0]})   # warmup
+
+        latencies = []
+        outputs = []
+        for tensor in tensors:
+            for _ in range(runs):
+                start = time.perf_counter()
+                output = session.run(None, {input_name: tensor})[0]
+                latencies.append((time.perf_counter() - start) * 1000)
+            outputs.append(from_model_output(output))
+        if references is None:
+            references = outputs
+
+        results.append({
+            'style': style,
+            'variant': variant,
+            'size_mb': round(os.path.getsize(path) / 1e6, 2),
+            'latency_ms_p50': round(statistics.median(latencies), 1),
+            'latency_ms_min': round(min(latencies), 1),
+            'psnr_db': round(statistics.mean(psnr(r, o) for r, o in zip(references, outputs)), 2),
+            'ssim': round(statistics.mean(ssim(r, o) for r, o in zip(references, outputs)), 4)
+        })
+    return results
+
+
+def print_report(results):
+    print(f"\n{'style':<16}{'variant':<14}{'size MB':>9}{'p50 ms':>10}{'speedup':>9}{'PSNR dB':>10}{'SSIM':>8}")
+    baseline = {}
+    for row in results:
+        if row['variant'] == 'fp32':
+            baseline[row['style']] = row['latency_ms_p50']
+        speedup = baseline.get(row['style'], row['latency_ms_p50']) / row['latency_ms_p50']
+        print(f"{row['style']:<16}{row['variant']:<14}{row['size_mb']:>9.2f}{row['latency_ms_p50']:>10.1f}"
+              f"{speedup:>8.2f}x{row['psnr_db']:>10.2f}{row['ssim']:>8.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build quantized variants of the style models and benchmark them")
+    parser.add_argument('--variants', nargs='+', default=['int8-dynamic', 'int8-static'],
+                        choices=['int8-dynamic', 'int8-static', 'fp16'],
+                        help="variants to build (fp16 is opt-in: it is rarely faster on CPU)")
+    parser.add_argument('--calibration-folder', default=CALIBRATION_FOLDER)
+    parser.add_argument('--calibration-images', type=int, default=CALIBRATION_IMAGES)
+    parser.add_argument('--skip-build', action='store_true', help="only benchmark existing variants")
+    parser.add_argument('--benchmark', action='store_true', help="report latency, size and SSIM/PSNR vs fp32")
+    parser.add_argument('--benchmark-images', nargs='+', default=['test_image.jpg'])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--report', help="write the benchmark results to this JSON file")
+    parser.add_argument('--manifest', default=MANIFEST_FILE, help="model manifest listing the styles")
+    parser.add_argument('--register', action='store_true',
+                        help="record the built variants in the manifest, rolling them out to running servers")
+    args = parser.parse_args()
+    # Not verified: the models it lists may be missing or stale, which is what this rebuilds
+    manifest = load_manifest(args.manifest, verify=False)
+
+    calibration_paths = list_images(args.calibration_folder, args.calibration_images)
+    results = []
+    for style, display_name in manifest.styles.items():
+        onnx_path = manifest.model_path(style)
+        if not os.path.exists(onnx_path):
+            print(f"❌ Model file not found: {onnx_path}")
+            continue
+        name = os.path.relpath(onnx_path)[:-len('.onnx')]
+        print(f"\n🎨 Processing style: {display_name}")
+        if not args.skip_build:
+            for variant in args.variants:
+                output_path = f"{model_name(name, variant)}.onnx"
+                if quantize_variant(onnx_path, variant, output_path, calibration_paths) and args.register:
+                    register_model(args.manifest, style, variant, output_path)
+        if args.benchmark:
+            results.extend(benchmark_variants(name, args.variants, args.benchmark_images, args.runs))
+
+    if results:
+        print_report(results)
+        if args.report:
+            with open(args.report, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f"\n📄 Benchmark report saved as {args.report}")
+
+
+if __name__ == "__main__":
+    main()
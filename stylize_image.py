@@ -1,9 +1,11 @@
-import torch
-from torchvision import transforms
-from PIL import Image, ImageFilter, ImageEnhance
+from PIL import Image
 import onnxruntime as ort
 import numpy as np
 import os
+from neural_style.image_io import from_model_output, to_model_input
+from neural_style.session_pool import run_session
+from neural_style.postprocess import fused_postprocess
+from neural_style.tiling import stylize_tiled
 
 # -----------------------------
 # CONFIG
@@ -21,6 +23,10 @@ imsize = 1024  # Increase to 2048 if your system can handle it
 # Blend intensity (0.0 = no style, 1.0 = full style)
 style_alpha = 0.8
 
+# Tiled inference: stylize at the image's own resolution in imsize tiles
+use_tiles = False
+tile_overlap = 64
+
 # -----------------------------
 # Load content image
 # -----------------------------
@@ -35,51 +41,47 @@ def load_image(filename, size=None):
 # -----------------------------
 # Preprocessing & Postprocessing
 # -----------------------------
-preprocess = transforms.Compose([
-    transforms.ToTensor(),
-    transforms.Lambda(lambda x: x.mul(255))
-])
-
-postprocess = transforms.Compose([
-    transforms.Lambda(lambda x: x.mul(1.0 / 255)),
-    transforms.ToPILImage()
-])
+# uint8 HWC -> float32 NCHW (0-255) and back, without going through torch; models
+# exported with --uint8-io take the decoded pixels as they are
+preprocess = to_model_input
+postprocess = from_model_output
 
 # -----------------------------
 # Run style transfer
 # -----------------------------
-content_image = load_image(content_image_path, imsize)
-content_tensor = preprocess(content_image).unsqueeze(0).cpu().numpy()
+content_image = load_image(content_image_path, None if use_tiles else imsize)
 
 # Load ONNX model
 if not os.path.exists(onnx_model_path):
     raise FileNotFoundError(f"❌ ONNX model not found: {onnx_model_path}")
 ort_session = ort.InferenceSession(onnx_model_path)
+uint8_io = ort_session.get_inputs()[0].type == 'tensor(uint8)'
 
 # Perform inference
-stylized = ort_session.run(None, {"input": content_tensor})[0]
+if use_tiles:
+    stylized = stylize_tiled(preprocess(content_image), lambda tiles: run_session(ort_session, tiles),
+                             imsize, overlap=tile_overlap, batch_size=1)
+else:
+    stylized = ort_session.run(None, {"input": preprocess(content_image, uint8_io)})[0]
 
-# Convert output to PIL image
-output_tensor = torch.from_numpy(stylized.squeeze())
-output_image = postprocess(output_tensor)
-output_image.save(output_image_path)
+# Convert output to a uint8 HxWx3 array
+output_pixels = postprocess(stylized)
+Image.fromarray(output_pixels).save(output_image_path)
 print(f"✅ Saved raw stylized image to {output_image_path}")
 
 # -----------------------------
 # Optional sharpening & contrast enhancement
 # -----------------------------
-# Sharpen
-sharp_img = output_image.filter(ImageFilter.SHARPEN)
-# Enhance contrast
-enhancer = ImageEnhance.Contrast(sharp_img)
-final_img = enhancer.enhance(1.2)
-final_img.save(final_output_path)
+# Sharpen and enhance contrast in one pass
+final_pixels = fused_postprocess(output_pixels, sharpen=True, contrast=1.2)
+Image.fromarray(final_pixels).save(final_output_path)
 print(f"✨ Final sharpened and enhanced image saved as {final_output_path}")
 
 # -----------------------------
 # Optional blending with original for style intensity
 # -----------------------------
-content_img = load_image(content_image_path, imsize)
-blended_img = Image.blend(content_img, final_img, alpha=style_alpha)
-blended_img.save(blended_output_path)
+# Reuses the content image already in memory; the result goes back into output_pixels
+blended_pixels = fused_postprocess(final_pixels, sharpen=False, contrast=1.0, blend_alpha=style_alpha,
+                                   content=np.asarray(content_image), out=output_pixels)
+Image.fromarray(blended_pixels).save(blended_output_path)
 print(f"🎨 Blended Mosaic style output saved as {blended_output_path}")
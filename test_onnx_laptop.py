@@ -1,21 +1,29 @@
 import cv2
 import numpy as np
 import onnxruntime as ort
+from neural_style.session_pool import run_session
+from neural_style.tiling import stylize_tiled
 
 # --- Configuration ---
 ONNX_MODEL_PATH = "ghibli_style.onnx"
 IMAGE_TO_TEST_PATH = "test_image.jpg"
 OUTPUT_IMAGE_PATH = "stylized_output.jpg"
 IMAGE_SIZE = 1024
+USE_TILES = False  # Stylize at the image's own resolution in IMAGE_SIZE tiles
+TILE_OVERLAP = 64
 
-def preprocess(image):
+def preprocess(image, uint8_io=False):
     """Prepares the image for the ONNX model."""
-    # Resize the image to the size the model expects
-    img = cv2.resize(image, (IMAGE_SIZE, IMAGE_SIZE))
+    # Resize the image to the size the model expects (tiles are cut later)
+    img = image if USE_TILES else cv2.resize(image, (IMAGE_SIZE, IMAGE_SIZE))
     
     # Convert from BGR (OpenCV's default) to RGB
     img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
     
+    # Models exported with --uint8-io take the pixels as they are
+    if uint8_io:
+        return img[np.newaxis]
+    
     # Reshape from (Height, Width, Channels) to (Channels, Height, Width)
     img = img.transpose(2, 0, 1)
     
@@ -29,6 +37,10 @@ def postprocess(model_output):
     # Remove the batch dimension
     result = np.squeeze(model_output, axis=0)
     
+    # uint8 I/O models already return clamped HxWx3 pixels
+    if result.dtype == np.uint8:
+        return cv2.cvtColor(result, cv2.COLOR_RGB2BGR)
+    
     # Clip values to the valid range [0, 255]
     result = np.clip(result, 0, 255)
     
@@ -46,6 +58,7 @@ print("🤖 Loading the ONNX model...")
 session = ort.InferenceSession(ONNX_MODEL_PATH)
 input_name = session.get_inputs()[0].name
 output_name = session.get_outputs()[0].name
+uint8_io = session.get_inputs()[0].type == 'tensor(uint8)'
 
 print(f"🎨 Loading and processing '{IMAGE_TO_TEST_PATH}'...")
 image = cv2.imread(IMAGE_TO_TEST_PATH)
@@ -54,10 +67,14 @@ if image is None:
     print(f"❌ Error: Could not load the image. Make sure 'test_image.jpg' is in the folder.")
 else:
     # 1. Prepare the image
-    input_tensor = preprocess(image)
+    input_tensor = preprocess(image, uint8_io and not USE_TILES)
     
     # 2. Run the model
-    result_tensor = session.run([output_name], {input_name: input_tensor})[0]
+    if USE_TILES:
+        result_tensor = stylize_tiled(input_tensor, lambda tiles: run_session(session, tiles),
+                                      IMAGE_SIZE, overlap=TILE_OVERLAP, batch_size=1)
+    else:
+        result_tensor = session.run([output_name], {input_name: input_tensor})[0]
     
     # 3. Convert the output back to an image
     final_image = postprocess(result_tensor)
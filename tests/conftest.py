@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def scale_model(tmp_path):
+    """Writes stand-in style models: ONNX graphs that multiply their Nx3xHxW input by a factor."""
+    import onnx
+    from onnx import TensorProto, helper
+
+    def write(name, factor):
+        graph = helper.make_graph(
+            [helper.make_node('Mul', ['input', 'factor'], ['output'])], 'scale',
+            [helper.make_tensor_value_info('input', TensorProto.FLOAT, ['batch', 3, 'height', 'width'])],
+            [helper.make_tensor_value_info('output', TensorProto.FLOAT, ['batch', 3, 'height', 'width'])],
+            [helper.make_tensor('factor', TensorProto.FLOAT, [], [factor])])
+        model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 17)], ir_version=8)
+        path = str(tmp_path / name)
+        onnx.save(model, path)
+        return path
+
+    return write
@@ -0,0 +1,83 @@
+import threading
+
+import numpy as np
+import pytest
+
+from neural_style.batching import BatchScheduler
+from neural_style.session_pool import SessionPool
+
+
+class RecordingScheduler(BatchScheduler):
+    """Notes the (model, batch size) of every session run."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.runs = []
+
+    def _run_session(self, model, tensor, style_index=None):
+        self.runs.append((model, tensor.shape[0]))
+        return super()._run_session(model, tensor, style_index)
+
+
+@pytest.fixture
+def pool(tmp_path, scale_model):
+    scale_model('mosaic.onnx', 2.0)
+    scale_model('candy.onnx', 3.0)
+    return SessionPool(['mosaic', 'candy'], sessions_per_style=2, model_dir=str(tmp_path))
+
+
+def run_concurrently(scheduler, calls):
+    """Runs every (style, tensor) call on its own thread, all released at once."""
+    barrier = threading.Barrier(len(calls))
+    results = [None] * len(calls)
+
+    def call(i, style, tensor):
+        barrier.wait()
+        results[i] = scheduler.run(style, tensor)
+
+    threads = [threading.Thread(target=call, args=(i, style, tensor)) for i, (style, tensor) in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def image(value, size=8):
+    return np.full((1, 3, size, size), value, dtype=np.float32)
+
+
+def test_concurrent_requests_share_one_run(pool):
+    scheduler = RecordingScheduler(pool, window_ms=500, max_batch=4)
+    inputs = [image(i) for i in range(4)]
+    results = run_concurrently(scheduler, [('mosaic', tensor) for tensor in inputs])
+
+    assert scheduler.runs == [('mosaic', 4)]
+    for tensor, result in zip(inputs, results):
+        np.testing.assert_allclose(result, tensor * 2)
+
+
+def test_batches_are_grouped_by_style_and_shape(pool):
+    scheduler = RecordingScheduler(pool, window_ms=500, max_batch=4)
+    calls = [('mosaic', image(1)), ('mosaic', image(2)), ('mosaic', image(3, size=16)),
+             ('mosaic', image(4, size=16)), ('candy', image(5)), ('candy', image(6))]
+    results = run_concurrently(scheduler, calls)
+
+    assert sorted(scheduler.runs) == [('candy', 2), ('mosaic', 2), ('mosaic', 2)]
+    for (style, tensor), result in zip(calls, results):
+        np.testing.assert_allclose(result, tensor * (2 if style == 'mosaic' else 3))
+
+
+def test_full_batches_close_early(pool):
+    scheduler = RecordingScheduler(pool, window_ms=500, max_batch=4)
+    run_concurrently(scheduler, [('mosaic', image(i)) for i in range(5)])
+
+    assert sorted(size for _, size in scheduler.runs) == [1, 4]
+
+
+def test_batched_inputs_run_directly(pool):
+    scheduler = RecordingScheduler(pool, window_ms=500, max_batch=4)
+    tiles = np.ones((3, 3, 8, 8), dtype=np.float32)
+
+    np.testing.assert_allclose(scheduler.run('mosaic', tiles), tiles * 2)
+    assert scheduler.runs == [('mosaic', 3)]
@@ -0,0 +1,38 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from neural_style.encoding import OutputEncoder
+from neural_style.pipeline import store_result
+from neural_style.result_cache import ResultCache
+
+KEY = '0123456789abcdef0123456789abcdef'
+
+
+def stored_result(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    pixels = np.random.default_rng(0).integers(0, 256, (24, 32, 3), dtype=np.uint8)
+    filenames = store_result(cache, KEY, Image.fromarray(pixels))
+    return cache, pixels, filenames
+
+
+def test_canonical_png_is_the_lossless_png_download(tmp_path):
+    cache, pixels, filenames = stored_result(tmp_path)
+    encoder = OutputEncoder(cache)
+    path = encoder.path(filenames['png'])
+    np.testing.assert_array_equal(np.asarray(Image.open(path)), pixels)
+    assert sorted(os.listdir(tmp_path)) == [filenames['png']]
+
+
+def test_other_formats_are_encoded_to_files_on_first_request(tmp_path):
+    cache, pixels, filenames = stored_result(tmp_path)
+    encoder = OutputEncoder(cache)
+    path = encoder.path(filenames['jpg'])
+    assert path == os.path.join(str(tmp_path), filenames['jpg'])
+    assert Image.open(path).format == 'JPEG'
+    assert Image.open(encoder.path(f"output_{KEY}.q30.jpg")).size == (32, 24)
+    assert encoder.path(f"output_{KEY}.q30.png") is None
+    assert encoder.path('output_ffffffffffffffffffffffffffffffff.jpg') is None
+    assert encoder.path('../secret.jpg') is None
+    encoder.shutdown()
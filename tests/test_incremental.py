@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from neural_style.incremental import IncrementalStylizer, check_patch_size
+
+
+def halve(batch):
+    return batch * 0.5
+
+
+def frame(rng, height=96, width=128):
+    return rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+def test_incremental_reuses_unchanged_cells():
+    rng = np.random.default_rng(1)
+    stylizer = IncrementalStylizer(halve, tile_size=32, halo=16, blend=8)
+    first = frame(rng)
+    stylizer.stylize(first)
+    assert stylizer.rerun == 12 and stylizer.reused == 0
+
+    stylizer.stylize(first)
+    assert stylizer.reused == 12
+
+
+def test_incremental_reruns_only_changed_cells():
+    rng = np.random.default_rng(2)
+    stylizer = IncrementalStylizer(halve, tile_size=32, halo=16, blend=8)
+    first = frame(rng)
+    stylizer.stylize(first)
+
+    second = first.copy()
+    second[40:50, 70:80] = 255 - second[40:50, 70:80]
+    output = stylizer.stylize(second)
+    assert stylizer.rerun == 12 + 1
+    # A pixel-wise model gives the full-frame result wherever the cells are stitched
+    np.testing.assert_allclose(output, (second * 0.5).astype(np.uint8), atol=1)
+
+
+def test_patch_size_must_survive_two_stride_2_stages():
+    check_patch_size(64, 32)
+    with pytest.raises(ValueError):
+        check_patch_size(62, 32)
+    with pytest.raises(ValueError):
+        IncrementalStylizer(halve, tile_size=64, halo=31)
@@ -0,0 +1,41 @@
+import operator
+import threading
+
+import pytest
+
+from neural_style.jobs import JobManager, QueueFull
+
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = JobManager(str(tmp_path), max_workers=1, max_pending=2)
+    yield manager
+    manager.shutdown()
+
+
+def submit(manager, fn, *args):
+    """Submits a job; returns (job id, event set once on_finished ran)."""
+    finished = threading.Event()
+    job_id = manager.submit(fn, *args, on_finished=finished.set)
+    return job_id, finished
+
+
+def test_on_finished_runs_once_the_job_is_done(manager):
+    job_id, finished = submit(manager, operator.add, 2, 3)
+    assert finished.wait(60)
+    assert manager.status(job_id) == dict(manager.status(job_id), status='done', result=5)
+    assert manager.pending == 0
+
+
+def test_on_finished_runs_when_the_job_fails(manager):
+    job_id, finished = submit(manager, operator.truediv, 1, 0)
+    assert finished.wait(60)
+    assert manager.status(job_id)['status'] == 'error'
+
+
+def test_on_finished_is_not_called_for_rejected_jobs(manager):
+    calls = []
+    manager._pending = manager.max_pending
+    with pytest.raises(QueueFull):
+        manager.submit(operator.add, 1, 2, on_finished=lambda: calls.append(1))
+    assert calls == []
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from neural_style.postprocess import BAND_ROWS, fused_postprocess, pil_postprocess
+
+# Odd sizes, single rows and columns, and heights on either side of a band boundary
+SIZES = [(1, 17), (2, 9), (3, 3), (17, 1), (31, 45), (BAND_ROWS - 1, 20), (BAND_ROWS, 21),
+         (BAND_ROWS + 1, 19), (2 * BAND_ROWS + 2, 7)]
+
+SETTINGS = [
+    dict(sharpen=True, contrast=1.0),
+    dict(sharpen=False, contrast=1.2),
+    dict(sharpen=True, contrast=1.2),
+    dict(sharpen=False, contrast=1.0, blend_alpha=0.7),
+    dict(sharpen=True, contrast=1.2, blend_alpha=0.7),
+    dict(sharpen=True, contrast=0.8, blend_alpha=0.3),
+]
+
+
+def max_difference(a, b):
+    return int(np.abs(a.astype(np.int16) - np.asarray(b).astype(np.int16)).max())
+
+
+@pytest.mark.parametrize('height, width', SIZES)
+@pytest.mark.parametrize('settings', SETTINGS)
+def test_fused_stage_matches_the_pil_chain(height, width, settings):
+    rng = np.random.default_rng(height * 1000 + width)
+    pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    content = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    blending = 'blend_alpha' in settings
+
+    fused = fused_postprocess(pixels, content=content if blending else None, **settings)
+    reference = pil_postprocess(Image.fromarray(pixels), content=Image.fromarray(content) if blending else None,
+                                **settings)
+    assert max_difference(fused, reference) <= 1
+
+
+def test_smaller_bands_give_the_same_result():
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (50, 40, 3), dtype=np.uint8)
+    content = rng.integers(0, 256, (50, 40, 3), dtype=np.uint8)
+
+    whole = fused_postprocess(pixels, blend_alpha=0.6, content=content)
+    banded = fused_postprocess(pixels, blend_alpha=0.6, content=content, band_rows=7)
+    np.testing.assert_array_equal(whole, banded)
+
+
+def test_blending_needs_a_content_image_of_the_same_size():
+    pixels = np.zeros((8, 8, 3), dtype=np.uint8)
+    with pytest.raises(ValueError):
+        fused_postprocess(pixels, blend_alpha=0.5)
+    with pytest.raises(ValueError):
+        fused_postprocess(pixels, blend_alpha=0.5, content=np.zeros((8, 9, 3), dtype=np.uint8))
@@ -0,0 +1,157 @@
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pytest
+
+from neural_style import registry
+from neural_style.registry import ModelRegistry, load_manifest, register_model
+from neural_style.session_pool import SessionPool, load_time_level, run_session
+
+
+def test_rollback_to_an_older_file_skips_the_newer_cached_graph(tmp_path, scale_model):
+    v1 = scale_model('v1.onnx', 1.0)
+    v2 = scale_model('v2.onnx', 2.0)
+    os.utime(v1, (0, 0))   # Older than any optimized graph cached from v2
+    served = str(tmp_path / 'mosaic.onnx')
+    manifest_path = str(tmp_path / 'models.json')
+
+    def roll_out(source):
+        shutil.copy2(source, served)
+        register_model(manifest_path, 'mosaic', 'fp32', served)
+        return load_manifest(manifest_path)
+
+    pool = SessionPool(['mosaic'], cache_dir=str(tmp_path / 'cache'), manifest=roll_out(v1))
+    tensor = np.ones((1, 3, 8, 8), dtype=np.float32)
+
+    def stylize():
+        with pool.session('mosaic') as session:
+            return run_session(session, tensor)
+
+    np.testing.assert_allclose(stylize(), tensor)
+    assert pool.apply(roll_out(v2)) == ['mosaic']
+    np.testing.assert_allclose(stylize(), tensor * 2)
+    assert pool.apply(roll_out(v1)) == ['mosaic']
+    np.testing.assert_allclose(stylize(), tensor)
+
+
+def test_multi_variants_share_the_multi_style_entry(tmp_path, scale_model):
+    network = scale_model('network.onnx', 1.0)
+    manifest_path = str(tmp_path / 'models.json')
+    for style in ('mosaic', 'candy'):
+        register_model(manifest_path, style, 'multi', network, name=style.title())
+
+    manifest = load_manifest(manifest_path)
+    pool = SessionPool([], manifest=manifest)
+    entry = manifest.models['mosaic.multi']
+    assert pool.model_path('candy.multi') == entry.path
+    assert pool.revision('candy.multi') == f"candy.multi@{entry.sha256[:16]}"
+
+
+def test_multi_variants_name_one_network(tmp_path, scale_model):
+    manifest_path = str(tmp_path / 'models.json')
+    register_model(manifest_path, 'mosaic', 'multi', scale_model('a.onnx', 1.0), name='Mosaic')
+    register_model(manifest_path, 'candy', 'multi', scale_model('b.onnx', 2.0), name='Candy')
+    manifest = load_manifest(manifest_path)
+    assert manifest.models['mosaic.multi'].path == manifest.models['candy.multi'].path
+
+    with open(manifest_path) as f:
+        document = json.load(f)
+    document['models'][0]['path'] = 'a.onnx'
+    with open(manifest_path, 'w') as f:
+        json.dump(document, f)
+    with pytest.raises(ValueError):
+        load_manifest(manifest_path)
+
+
+class TestModelRegistry:
+    @pytest.fixture
+    def setup(self, tmp_path, scale_model):
+        """A registry serving mosaic from v1.onnx, with a pool following it."""
+        self.manifest_path = str(tmp_path / 'models.json')
+        self.v1 = scale_model('v1.onnx', 1.0)
+        self.v2 = scale_model('v2.onnx', 2.0)
+        self.publish(self.v1)
+        self.registry = ModelRegistry(self.manifest_path)
+        self.pool = SessionPool(['mosaic'], manifest=self.registry.current)
+        self.registry.subscribe(self.pool.apply)
+
+    def publish(self, onnx_file):
+        register_model(self.manifest_path, 'mosaic', 'fp32', onnx_file)
+        self.bump_mtime()
+
+    def bump_mtime(self):
+        # Each change gets a distinct modification time, however coarse the file system's clock
+        self.mtime = getattr(self, 'mtime', time.time()) + 10
+        os.utime(self.manifest_path, (self.mtime, self.mtime))
+
+    def output(self):
+        tensor = np.ones((1, 3, 4, 4), dtype=np.float32)
+        with self.pool.session('mosaic') as session:
+            return run_session(session, tensor)[0, 0, 0, 0]
+
+    def test_refresh_applies_a_changed_manifest_and_rolls_back(self, setup):
+        assert not self.registry.refresh()
+        assert self.output() == 1
+
+        self.publish(self.v2)
+        assert self.registry.refresh()
+        assert self.output() == 2
+
+        self.publish(self.v1)
+        assert self.registry.refresh()
+        assert self.output() == 1
+
+    def test_broken_manifest_keeps_the_current_models(self, setup):
+        current = self.registry.current
+        with open(self.manifest_path, 'w') as f:
+            f.write('{"styles": [')
+        self.bump_mtime()
+
+        assert not self.registry.refresh()
+        assert self.registry.current is current
+        assert self.output() == 1
+
+    def test_checksum_mismatch_keeps_the_current_models(self, setup):
+        self.publish(self.v2)
+        shutil.copy(self.v1, self.v2)   # Changed after it was registered
+        os.utime(self.manifest_path, (self.mtime + 1, self.mtime + 1))
+
+        assert not self.registry.refresh()
+        assert self.output() == 1
+
+    def test_failed_manifest_is_not_verified_again_until_it_changes(self, setup, monkeypatch):
+        self.publish(self.v2)
+        shutil.copy(self.v1, self.v2)
+        digests = []
+        monkeypatch.setattr(registry, 'file_digest', lambda *paths: digests.append(paths) or '')
+
+        for _ in range(5):
+            assert not self.registry.refresh()
+        assert len(digests) == 1
+
+        self.bump_mtime()
+        self.registry.refresh()
+        assert len(digests) == 2
+
+
+@pytest.mark.parametrize('saved, served, expected', [
+    (None, 'all', 'all'), ('extended', 'all', 'all'), ('all', 'all', 'disable'), ('all', 'extended', 'disable'),
+])
+def test_pre_optimized_models_are_only_optimized_above_their_saved_level(saved, served, expected):
+    assert load_time_level(saved, served) == expected
+
+
+def test_manifest_records_the_saved_optimization_level(tmp_path, scale_model):
+    manifest_path = str(tmp_path / 'models.json')
+    register_model(manifest_path, 'mosaic', 'fp32', scale_model('mosaic.onnx', 1.0), optimized='all')
+    assert load_manifest(manifest_path).models['mosaic'].optimized == 'all'
+
+    with open(manifest_path) as f:
+        document = json.load(f)
+    document['models'][0]['optimized'] = True   # Written before the level was recorded
+    with open(manifest_path, 'w') as f:
+        json.dump(document, f)
+    assert load_manifest(manifest_path).models['mosaic'].optimized == 'extended'
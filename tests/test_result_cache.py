@@ -0,0 +1,45 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+from neural_style.result_cache import ResultCache, cache_key, data_digest, image_digest
+
+PARAMS = {'image_size': 512, 'sharpen': True, 'contrast': 1.2}
+
+
+def test_cache_key_ignores_parameter_order():
+    reordered = dict(reversed(list(PARAMS.items())))
+    assert cache_key('abc', 'mosaic', PARAMS) == cache_key('abc', 'mosaic', reordered)
+
+
+def test_cache_key_changes_with_image_style_params_and_model_revision():
+    key = cache_key('abc', 'mosaic', PARAMS)
+    assert len(key) == 32
+    assert cache_key('abd', 'mosaic', PARAMS) != key
+    assert cache_key('abc', 'candy', PARAMS) != key
+    assert cache_key('abc', 'mosaic', dict(PARAMS, contrast=1.0)) != key
+    assert cache_key('abc', 'mosaic@0123456789abcdef', PARAMS) != key
+
+
+def test_image_digest_follows_pixels_not_encoding():
+    pixels = np.random.default_rng(0).integers(0, 256, (8, 8, 3), dtype=np.uint8)
+    encoded = []
+    for fmt in ('PNG', 'BMP'):
+        buf = io.BytesIO()
+        Image.fromarray(pixels).save(buf, fmt)
+        encoded.append(buf.getvalue())
+    decoded = [Image.open(io.BytesIO(data)).convert('RGB') for data in encoded]
+    assert image_digest(decoded[0]) == image_digest(decoded[1])
+    assert data_digest(encoded[0]) != data_digest(encoded[1])
+
+
+def test_put_then_get_round_trips(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    key = cache_key('abc', 'mosaic', PARAMS)
+    assert cache.get(key, ['jpg']) is None
+
+    filenames = cache.put(key, {'jpg': b'jpeg bytes', 'png': b'png bytes'})
+    assert cache.get(key, ['jpg', 'png']) == filenames
+    assert cache.read(filenames['png']) == b'png bytes'
+    assert (tmp_path / filenames['jpg']).read_bytes() == b'jpeg bytes'
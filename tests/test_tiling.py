@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from neural_style.tiling import feather_weights, stylize_tiled, tile_origins
+
+
+@pytest.mark.parametrize('length, tile_size, overlap', [(100, 32, 8), (257, 64, 16), (64, 64, 16), (65, 64, 32)])
+def test_tiles_cover_the_length_with_the_overlap(length, tile_size, overlap):
+    origins = tile_origins(length, tile_size, overlap)
+    assert origins[0] == 0
+    assert origins[-1] + tile_size == max(length, tile_size)
+    assert all(b - a <= tile_size - overlap for a, b in zip(origins, origins[1:]))
+
+
+def test_overlap_must_be_smaller_than_the_tile():
+    with pytest.raises(ValueError):
+        tile_origins(100, 32, 32)
+
+
+def test_feather_weights_ramp_up_from_every_edge():
+    weights = feather_weights(16, 4)
+    assert weights.shape == (16, 16)
+    assert weights.min() > 0
+    assert weights[4:12, 4:12].min() == 1
+    np.testing.assert_allclose(weights, weights.T)
+    np.testing.assert_allclose(weights, weights[::-1, ::-1])
+    assert np.all(np.diff(weights[8, :5]) > 0)
+
+
+@pytest.mark.parametrize('height, width', [(100, 70), (20, 30)])
+def test_blending_identical_tiles_reproduces_the_image(height, width):
+    rng = np.random.default_rng(0)
+    content = rng.uniform(0, 255, (1, 3, height, width)).astype(np.float32)
+    batches = []
+
+    def run_model(batch):
+        batches.append(len(batch))
+        return batch
+
+    output = stylize_tiled(content, run_model, tile_size=32, overlap=8, batch_size=3)
+    assert output.shape == content.shape
+    np.testing.assert_allclose(output, content, rtol=1e-5)
+    assert max(batches) <= 3
+
+
+def test_seams_blend_between_disagreeing_tiles():
+    # Every tile comes back as a flat value: the blend must move smoothly between them
+    def run_model(batch):
+        return np.stack([np.full_like(tile, 100.0 * i) for i, tile in enumerate(batch)])
+
+    output = stylize_tiled(np.zeros((1, 3, 32, 56), dtype=np.float32), run_model, tile_size=32, overlap=8,
+                           batch_size=2)
+    row = output[0, 0, 16]
+    assert row[0] == pytest.approx(0) and row[-1] == pytest.approx(100)
+    assert np.all(np.diff(row) > -1e-3) and np.all(np.diff(row) < 50)
@@ -0,0 +1,15 @@
+import os
+import time
+
+from neural_style.upload_store import UploadStore
+
+
+def test_watch_expires_uploads_without_new_saves(tmp_path):
+    store = UploadStore(str(tmp_path), ttl=0.2, sweep_interval=0.05)
+    path = os.path.join(str(tmp_path), store.save('0' * 32, 'jpg', b'data'))
+    store.watch()
+
+    deadline = time.time() + 5
+    while os.path.exists(path) and time.time() < deadline:
+        time.sleep(0.05)
+    assert not os.path.exists(path)
@@ -0,0 +1,262 @@
+import argparse
+import contextlib
+import hashlib
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from convert_all_styles import convert_model
+from distill import ImageFiles, style_of
+from neural_style.transformer_net import TransformerNet
+from neural_style.utils import gram_matrix, normalize_batch
+
+STAGES = ('data', 'forward', 'backward')
+
+
+def cache_key(*parts):
+    return hashlib.sha1(':'.join(str(part) for part in parts).encode()).hexdigest()[:16]
+
+
+class CachedImageFiles(ImageFiles):
+    """ImageFiles that keeps every decoded, resized and cropped image as a .npy
+    file under `cache_dir`, so later epochs and runs skip JPEG decoding.
+
+    Items are 3xHxW uint8 tensors; the training loop converts them to float on
+    the device, which keeps the worker -> main process copies small.
+    """
+
+    def __init__(self, root, size, limit=None, cache_dir=None):
+        super(CachedImageFiles, self).__init__(root, size, limit)
+        self.size = size
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __getitem__(self, index):
+        path = self.paths[index]
+        if not self.cache_dir:
+            return self.transform(Image.open(path).convert('RGB'))
+        cached = os.path.join(self.cache_dir,
+                              f"{cache_key(os.path.abspath(path), os.path.getmtime(path), self.size)}.npy")
+        try:
+            return torch.from_numpy(np.load(cached))
+        except (OSError, ValueError):
+            pixels = self.transform(Image.open(path).convert('RGB'))
+            # Workers may decode the same image at once: write through a temporary file
+            temporary = f"{cached}.{os.getpid()}.tmp"
+            with open(temporary, 'wb') as f:
+                np.save(f, pixels.numpy())
+            os.replace(temporary, cached)
+            return pixels
+
+
+def style_grams(vgg, style_image, size, device, cache_dir=None, weights_id=None):
+    """Gram matrices (1xCxC, one per VGG layer) of the style image at `size`,
+    computed once and cached under `cache_dir`."""
+    cached = None
+    if cache_dir:
+        key = cache_key(os.path.abspath(style_image), os.path.getmtime(style_image), size, weights_id)
+        cached = os.path.join(cache_dir, f"grams-{key}.pt")
+        if os.path.exists(cached):
+            print(f"💾 Style Gram matrices loaded from {cached}")
+            return [gram.to(device) for gram in torch.load(cached, map_location='cpu')]
+
+    image = Image.open(style_image).convert('RGB')
+    if size:
+        image = image.resize((size, size), Image.LANCZOS)
+    style = torch.from_numpy(np.array(image)).permute(2, 0, 1).unsqueeze(0).float().to(device)
+    with torch.no_grad():
+        grams = [gram_matrix(features.float()) for features in vgg(normalize_batch(style))]
+    if cached:
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save([gram.cpu() for gram in grams], cached)
+        print(f"💾 Style Gram matrices cached as {cached}")
+    return grams
+
+
+def autocast(device, enabled):
+    """Mixed precision where it is available: float16 on CUDA, bfloat16 on CPU."""
+    if not enabled:
+        return contextlib.nullcontext()
+    dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    return torch.autocast(device.type, dtype=dtype)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def save_checkpoint(path, model, model_kwargs, optimizer=None, step=None):
+    """Saves in the format convert_all_styles.load_model reads; training state
+    (optimizer, step) is added for --resume."""
+    checkpoint = {'state_dict': model.state_dict(), 'model_kwargs': model_kwargs}
+    if optimizer is not None:
+        checkpoint.update(optimizer=optimizer.state_dict(), step=step)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    torch.save(checkpoint, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+
+def report_throughput(stage_seconds, images, elapsed):
+    """Images/s of every stage on its own (data wait, forward, backward) and overall."""
+    rates = ', '.join(f"{stage} {images / seconds:.1f}" for stage, seconds in stage_seconds.items() if seconds)
+    return f"{images / elapsed:.1f} images/s ({rates} images/s per stage)"
+
+
+def train(args):
+    """Trains a TransformerNet on one style image and saves its checkpoint.
+
+    The usual perceptual loss: relu2_2 features of the output against those of
+    the content image, and the Gram matrices of four VGG-16 layers against the
+    style image's, which are computed once (and cached across runs).
+    """
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+
+    from neural_style.vgg import Vgg16
+    vgg = Vgg16(args.vgg_weights).to(device, memory_format=memory_format).eval()
+    grams = style_grams(vgg, args.style_image, args.style_size, device, args.cache_dir,
+                        args.vgg_weights or 'imagenet')
+
+    dataset = CachedImageFiles(args.dataset, args.image_size, args.limit,
+                               None if args.no_image_cache else os.path.join(args.cache_dir, 'images'))
+    if not len(dataset):
+        print(f"❌ No images found under {args.dataset}")
+        return None
+    loader_kwargs = {'prefetch_factor': args.prefetch, 'persistent_workers': True} if args.workers else {}
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                         num_workers=args.workers, pin_memory=device.type == 'cuda',
+                                         drop_last=len(dataset) >= args.batch_size, **loader_kwargs)
+
+    model_kwargs = {'width_mult': args.width_mult, 'num_residual': args.num_residual, 'depthwise': args.depthwise}
+    checkpoint = torch.load(args.resume, map_location=device) if args.resume else None
+    if checkpoint and checkpoint['model_kwargs'] != model_kwargs:
+        # The weights only fit the architecture they were trained with
+        print(f"⚠️ Using the model options of {args.resume}: {checkpoint['model_kwargs']}")
+        model_kwargs = checkpoint['model_kwargs']
+    model = TransformerNet(**model_kwargs).to(device, memory_format=memory_format)
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    scaler = torch.amp.GradScaler(device.type, enabled=args.amp and device.type == 'cuda')
+    step = 0
+    if checkpoint:
+        model.load_state_dict(checkpoint['state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        step = checkpoint['step']
+        print(f"⏩ Resumed from {args.resume} at step {step}")
+
+    print(f"📚 Training {style_of(args.style_image)} on {len(dataset)} images at {args.image_size}px for "
+          f"{args.epochs} epochs on {device} (channels_last: {args.channels_last}, mixed precision: {args.amp})")
+    steps_per_epoch = len(loader)
+    stage_seconds = dict.fromkeys(STAGES, 0.0)
+    images = 0
+    started = time.perf_counter()
+    model.train()
+    for epoch in range(step // steps_per_epoch, args.epochs):
+        batches = iter(loader)
+        for _ in range(steps_per_epoch - step % steps_per_epoch):
+            stage_start = time.perf_counter()
+            batch = next(batches).to(device, non_blocking=True).float().contiguous(memory_format=memory_format)
+            synchronize(device)
+            now = time.perf_counter()
+            stage_seconds['data'] += now - stage_start
+            stage_start = now
+
+            with autocast(device, args.amp):
+                stylized = model(batch)
+                # normalize_batch divides in place; the content features come from the batch itself
+                features_y = vgg(normalize_batch(stylized.float()))
+                with torch.no_grad():
+                    features_x = vgg(normalize_batch(batch))
+            content_loss = args.content_weight * torch.nn.functional.mse_loss(
+                features_y.relu2_2.float(), features_x.relu2_2.float())
+            style_loss = 0.0
+            for features, gram_s in zip(features_y, grams):
+                gram_y = gram_matrix(features.float())
+                style_loss = style_loss + torch.nn.functional.mse_loss(gram_y, gram_s.expand_as(gram_y))
+            style_loss = args.style_weight * style_loss
+            loss = content_loss + style_loss
+            synchronize(device)
+            now = time.perf_counter()
+            stage_seconds['forward'] += now - stage_start
+            stage_start = now
+
+            optimizer.zero_grad(set_to_none=True)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            synchronize(device)
+            stage_seconds['backward'] += time.perf_counter() - stage_start
+
+            step += 1
+            images += batch.shape[0]
+            if step % args.log_interval == 0:
+                print(f"  epoch {epoch + 1} step {step}: loss {loss.item():.4g} (content {content_loss.item():.4g}, "
+                      f"style {style_loss.item():.4g}), "
+                      f"{report_throughput(stage_seconds, images, time.perf_counter() - started)}")
+            if args.checkpoint_interval and step % args.checkpoint_interval == 0:
+                path = os.path.join(args.checkpoint_dir, f"{style_of(args.output)}.step{step}.pth")
+                save_checkpoint(path, model, model_kwargs, optimizer, step)
+                print(f"💾 Checkpoint saved as {path}")
+
+    if images:
+        print(f"⏱️ {images} images in {time.perf_counter() - started:.1f} s: "
+              f"{report_throughput(stage_seconds, images, time.perf_counter() - started)}")
+    model.eval()
+    save_checkpoint(args.output, model.to('cpu', memory_format=torch.contiguous_format), model_kwargs)
+    print(f"✅ Style model saved as {args.output}")
+    return args.output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train a style model for a new style image")
+    parser.add_argument('--style-image', required=True, help="the style to learn, e.g. styles/starry.jpg")
+    parser.add_argument('--dataset', required=True, help="directory of content photos (searched recursively)")
+    parser.add_argument('--output', help="checkpoint to write (default: <style image name>.pth)")
+    parser.add_argument('--image-size', type=int, default=256, help="training crop size")
+    parser.add_argument('--style-size', type=int, help="resize the style image to this square size first")
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--limit', type=int, help="use at most this many images")
+    parser.add_argument('--content-weight', type=float, default=1e5, help="relu2_2 feature loss weight")
+    parser.add_argument('--style-weight', type=float, default=1e10, help="Gram matrix loss weight")
+    parser.add_argument('--width-mult', type=float, default=1.0, help="scale of every channel count")
+    parser.add_argument('--num-residual', type=int, default=5, help="residual blocks")
+    parser.add_argument('--depthwise', action='store_true', help="use depthwise-separable convolutions")
+    parser.add_argument('--device', help="torch device (default: cuda when available, else cpu)")
+    parser.add_argument('--channels-last', action='store_true', help="train in channels-last memory format")
+    parser.add_argument('--amp', action='store_true', help="mixed precision (float16 on CUDA, bfloat16 on CPU)")
+    parser.add_argument('--workers', type=int, default=4, help="data loading processes")
+    parser.add_argument('--prefetch', type=int, default=4, help="batches each loader process prepares ahead")
+    parser.add_argument('--cache-dir', default='train_cache',
+                        help="where decoded training images and style Gram matrices are cached")
+    parser.add_argument('--no-image-cache', action='store_true', help="decode the training images every epoch")
+    parser.add_argument('--vgg-weights', help="local torchvision vgg16 state dict instead of the download")
+    parser.add_argument('--checkpoint-dir', default='checkpoints')
+    parser.add_argument('--checkpoint-interval', type=int, default=1000, help="steps between checkpoints (0: none)")
+    parser.add_argument('--resume', help="continue from a checkpoint written by --checkpoint-interval "
+                                         "(with its --width-mult, --num-residual and --depthwise)")
+    parser.add_argument('--log-interval', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--export', action='store_true',
+                        help="also export the model as .onnx through convert_all_styles.convert_model")
+    parser.add_argument('--dynamic-shape', action='store_true', help="export with dynamic batch, height and width")
+    parser.add_argument('--uint8-io', action='store_true', help="export with uint8 image input and output")
+    parser.add_argument('--optimize', nargs='?', const='extended', choices=['basic', 'extended', 'all'],
+                        help="export onnxruntime's optimized graph")
+    args = parser.parse_args()
+
+    args.output = args.output or f"{style_of(args.style_image)}.pth"
+    checkpoint = train(args)
+    if checkpoint and args.export:
+        convert_model(checkpoint, f"{os.path.splitext(checkpoint)[0]}.onnx", dynamic_shape=args.dynamic_shape,
+                      uint8_io=args.uint8_io, optimize=args.optimize)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,146 +1,802 @@
+import io
 import os
 import json
-import torch
-from torchvision import transforms
-from PIL import Image, ImageFilter, ImageEnhance
-import onnxruntime as ort
+import logging
+import math
+import time
 import numpy as np
-from flask import Flask, request, render_template, redirect, url_for, flash, send_from_directory
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, nullcontext
+from flask import Flask, Request, Response, g, request, render_template, redirect, url_for, flash, send_from_directory
+from neural_style import metrics, pipeline
+from neural_style.admission import AdmissionController, Overloaded, estimate_bytes
+from neural_style.batching import BatchScheduler
+from neural_style.encoding import OutputEncoder
+from neural_style.incremental import IncrementalStylizer, check_patch_size
+from neural_style.jobs import FINISHED_STATES, JobManager, QueueFull
+from neural_style.registry import MANIFEST_FILE, ModelRegistry
+from neural_style.result_cache import ResultCache, cache_key, data_digest
+from neural_style.session_pool import MODEL_VARIANTS, SessionPool, model_name
+from neural_style.streaming import StreamRegistry, StreamSession, TooManyStreams
+from neural_style.upload_store import UploadStore
+
+class InMemoryRequest(Request):
+    """Keeps uploaded files in memory instead of spooling large ones to a temp file."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key_here'
+app.request_class = InMemoryRequest
 
 # Configuration
 UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'outputs'
+JOB_FOLDER = 'jobs'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# Uploads are decoded from memory, so cap their size
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 32)) * 1024 * 1024
+
+# Originals are only written to UPLOAD_FOLDER when the request sets 'keep_original'
+# (or KEEP_UPLOADS=1), and are deleted after UPLOAD_RETENTION_HOURS or beyond UPLOAD_RETENTION_MB
+KEEP_UPLOADS = os.environ.get('KEEP_UPLOADS', '0') == '1'
+UPLOAD_RETENTION_HOURS = int(os.environ.get('UPLOAD_RETENTION_HOURS', 24))
+UPLOAD_RETENTION_MB = int(os.environ.get('UPLOAD_RETENTION_MB', 512))
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
 
-# Available styles
-STYLES = {
-    'mosaic': 'Mosaic',
-    'rain_princess': 'Rain Princess',
-    'candy': 'Candy'
+# Available styles and their model files come from the MODEL_MANIFEST registry (see
+# convert_all_styles.py --register); without one, the built-in styles' <style>.onnx files.
+# Each worker polls it every MANIFEST_POLL_SECONDS and hot-swaps changed models (0 disables)
+MODEL_MANIFEST = os.environ.get('MODEL_MANIFEST', MANIFEST_FILE)
+MANIFEST_POLL_SECONDS = float(os.environ.get('MANIFEST_POLL_SECONDS', 2))
+model_registry = ModelRegistry(MODEL_MANIFEST)
+
+# ONNX Runtime session pool (one per gunicorn worker)
+SESSIONS_PER_STYLE = int(os.environ.get('SESSIONS_PER_STYLE', 1))
+ORT_INTRA_OP_THREADS = int(os.environ.get('ORT_INTRA_OP_THREADS', 0))
+ORT_INTER_OP_THREADS = int(os.environ.get('ORT_INTER_OP_THREADS', 0))
+ORT_OPTIMIZATION_LEVEL = os.environ.get('ORT_OPTIMIZATION_LEVEL', 'all')
+MODEL_CACHE_FOLDER = os.environ.get('MODEL_CACHE_FOLDER', 'model_cache')
+# Read every model at startup (in the gunicorn master, see gunicorn.conf.py) and warm its
+# sessions in each worker before it takes traffic
+PRELOAD_MODELS = os.environ.get('PRELOAD_MODELS', '1') == '1'
+
+# Model variant served by default (see quantize_models.py); 'variant' form field overrides it
+MODEL_VARIANT = os.environ.get('MODEL_VARIANT', 'fp32')
+
+# Micro-batching of concurrent requests for the same style (1 = disabled)
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 1))
+BATCH_WINDOW_MS = float(os.environ.get('BATCH_WINDOW_MS', 10))
+
+# Background job workers (per gunicorn worker)
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+MAX_PENDING_JOBS = int(os.environ.get('MAX_PENDING_JOBS', 8))
+
+# Inference size: 'square' squashes to 1024x1024, 'aspect' keeps the aspect ratio
+# within MAX_PIXELS (needs models exported with --dynamic-shape)
+RESIZE_MODE = os.environ.get('RESIZE_MODE', 'square')
+MAX_PIXELS = int(os.environ.get('MAX_PIXELS', pipeline.MAX_PIXELS))
+
+# Tiled inference at the upload's own resolution (per request via the 'tiled' form field)
+TILED_INFERENCE = os.environ.get('TILED_INFERENCE', '0') == '1'
+TILE_SIZE = int(os.environ.get('TILE_SIZE', pipeline.IMAGE_SIZE))
+TILE_OVERLAP = int(os.environ.get('TILE_OVERLAP', 64))
+
+# Run the fused sharpen/contrast pass at inference resolution, before upscaling
+# (cheaper on large uploads, slightly softer result)
+ENHANCE_BEFORE_UPSCALE = os.environ.get('ENHANCE_BEFORE_UPSCALE', '0') == '1'
+
+# Multi-style requests (/upload/styles): style models run concurrently on this many threads,
+# by default one per core up to 4 (each session already spreads over the cores, and styles added
+# by a manifest reload share the same pool). Previews (/upload/styles and progressive /jobs) run
+# at PREVIEW_SIZE x PREVIEW_SIZE pixels on dynamic-shape models; /jobs also uses a
+# <style>.preview.onnx graph for fixed-shape ones
+STYLE_THREADS = max(1, int(os.environ.get('STYLE_THREADS', min(4, os.cpu_count() or 1))))
+PREVIEW_SIZE = int(os.environ.get('PREVIEW_SIZE', 384))
+
+# Webcam streaming: frames run at most STREAM_SIZE x STREAM_SIZE pixels (aspect kept on
+# dynamic-shape models) and come back as JPEG; needs a threaded server (see Procfile)
+STREAM_SIZE = int(os.environ.get('STREAM_SIZE', 384))
+STREAM_JPEG_QUALITY = int(os.environ.get('STREAM_JPEG_QUALITY', 75))
+MAX_STREAMS = int(os.environ.get('MAX_STREAMS', 4))
+STREAM_IDLE_SECONDS = int(os.environ.get('STREAM_IDLE_SECONDS', 30))
+# Incremental streaming (dynamic-shape models only): only STREAM_TILE_SIZE cells whose mean
+# change exceeds STREAM_CHANGE_THRESHOLD are restylized, with STREAM_TILE_HALO pixels of context
+STREAM_INCREMENTAL = os.environ.get('STREAM_INCREMENTAL', '0') == '1'
+STREAM_TILE_SIZE = int(os.environ.get('STREAM_TILE_SIZE', 64))
+STREAM_TILE_HALO = int(os.environ.get('STREAM_TILE_HALO', 32))
+STREAM_CHANGE_THRESHOLD = float(os.environ.get('STREAM_CHANGE_THRESHOLD', 2.0))
+check_patch_size(STREAM_TILE_SIZE, STREAM_TILE_HALO)   # Fail at startup, not on every new stream
+
+# Admission control: stylizations in a web worker and its /jobs reserve their estimated peak
+# memory from MEMORY_BUDGET_MB; others wait (at most ADMISSION_QUEUE of them, for ADMISSION_TIMEOUT seconds)
+# or get a 429. Unset: half the machine's memory, split across WEB_CONCURRENCY workers; 0 disables
+try:
+    PHYSICAL_MEMORY_MB = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+except (AttributeError, ValueError, OSError):
+    PHYSICAL_MEMORY_MB = 0
+MEMORY_BUDGET_MB = int(os.environ.get('MEMORY_BUDGET_MB',
+                                      PHYSICAL_MEMORY_MB // 2 // int(os.environ.get('WEB_CONCURRENCY', 1))))
+ADMISSION_QUEUE = int(os.environ.get('ADMISSION_QUEUE', 8))
+ADMISSION_TIMEOUT = float(os.environ.get('ADMISSION_TIMEOUT', 10))
+
+# While DEGRADE_QUEUE_DEPTH or more requests wait for memory, dynamic-shape models run at half
+# the pixels per DEGRADE_QUEUE_DEPTH waiting, never below MIN_INFERENCE_SIZE (0 disables)
+DEGRADE_QUEUE_DEPTH = int(os.environ.get('DEGRADE_QUEUE_DEPTH', 2))
+MIN_INFERENCE_SIZE = int(os.environ.get('MIN_INFERENCE_SIZE', 512))
+
+# Square sizes dynamic-shape models are warmed at (fixed-shape models warm at their own size)
+WARMUP_SIZES = [int(size) for size in os.environ.get(
+    'WARMUP_SIZES', f"{pipeline.IMAGE_SIZE},{PREVIEW_SIZE},{STREAM_SIZE}").split(',') if size]
+
+# Result cache: in-memory LRU over content-addressed files in OUTPUT_FOLDER
+RESULT_CACHE_CONFIG = {
+    'folder': OUTPUT_FOLDER,
+    'memory_bytes': int(os.environ.get('RESULT_CACHE_MEMORY_MB', 64)) * 1024 * 1024,
+    'disk_bytes': int(os.environ.get('RESULT_CACHE_DISK_MB', 1024)) * 1024 * 1024,
+    'max_age': int(os.environ.get('RESULT_CACHE_MAX_AGE_HOURS', 168)) * 3600
+}
+
+# Results are stored once as PNG and encoded to the other formats (and JPEG qualities, as
+# output_<key>.q<N>.jpg) on first download, on ENCODE_THREADS threads
+ENCODE_THREADS = int(os.environ.get('ENCODE_THREADS', 2))
+ENCODE_OPTIONS = {
+    'jpg': {
+        'quality': int(os.environ.get('JPEG_QUALITY', 75)),
+        'progressive': os.environ.get('JPEG_PROGRESSIVE', '0') == '1',
+        'optimize': os.environ.get('JPEG_OPTIMIZE', '0') == '1'
+    },
+    'webp': {'quality': int(os.environ.get('WEBP_QUALITY', 80))}
 }
+PREVIEW_FORMATS = {'jpg': 'JPEG'}
+
+# Per-step progress prints; errors are always logged. Off saves stdout writes on the hot path
+VERBOSE_LOGGING = os.environ.get('VERBOSE_LOGGING', '1') == '1'
+# The neural_style modules log through `logging`; a no-op if the server configured it already
+logging.basicConfig(level=logging.INFO if VERBOSE_LOGGING else logging.WARNING,
+                    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+# With ALLOW_PROFILING=1, /upload requests with 'profile' set run on a fresh profiling
+# session and write an onnxruntime trace (chrome://tracing JSON) to PROFILE_FOLDER
+ALLOW_PROFILING = os.environ.get('ALLOW_PROFILING', '0') == '1'
+PROFILE_FOLDER = os.environ.get('PROFILE_FOLDER', 'profiles')
 
 # Create directories if they don't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-# Preprocess and postprocess functions
-preprocess = transforms.Compose([
-    transforms.ToTensor(),
-    transforms.Lambda(lambda x: x.mul(255))
-])
+SESSION_POOL_CONFIG = {
+    'sessions_per_style': SESSIONS_PER_STYLE,
+    'cache_dir': MODEL_CACHE_FOLDER or None,
+    'intra_op_threads': ORT_INTRA_OP_THREADS,
+    'inter_op_threads': ORT_INTER_OP_THREADS,
+    'optimization_level': ORT_OPTIMIZATION_LEVEL
+}
+
+def preload_keys(styles, previews=False):
+    """The configured variant of every style, plus the fp32 models it falls back to
+    (and the preview graphs)."""
+    keys = [model_name(style, MODEL_VARIANT) for style in styles] + list(styles)
+    if previews:
+        keys += [f"{style}.preview" for style in styles]
+    return list(dict.fromkeys(keys))
+
+session_pool = SessionPool(preload_keys(model_registry.styles), manifest=model_registry.current,
+                           **SESSION_POOL_CONFIG)
+
+def log(message):
+    if VERBOSE_LOGGING:
+        print(message)
 
-postprocess = transforms.Compose([
-    transforms.Lambda(lambda x: x.mul(1.0 / 255)),
-    transforms.ToPILImage()
-])
+readiness = {'ready': not PRELOAD_MODELS, 'models': [], 'warmup_seconds': None}
+if PRELOAD_MODELS:
+    # Only reads files, so this is safe before gunicorn forks the workers
+    readiness['models'] = session_pool.load_models(preload_keys(model_registry.styles, previews=True))
+    log(f"Loaded models: {readiness['models']}")
+batch_scheduler = BatchScheduler(session_pool, window_ms=BATCH_WINDOW_MS, max_batch=MAX_BATCH_SIZE)
+result_cache = ResultCache(**RESULT_CACHE_CONFIG)
+output_encoder = OutputEncoder(result_cache, max_workers=ENCODE_THREADS, options=ENCODE_OPTIONS)
+upload_store = UploadStore(UPLOAD_FOLDER, ttl=UPLOAD_RETENTION_HOURS * 3600,
+                           max_bytes=UPLOAD_RETENTION_MB * 1024 * 1024)
+
+job_manager = JobManager(
+    JOB_FOLDER,
+    max_workers=JOB_WORKERS,
+    max_pending=MAX_PENDING_JOBS,
+    initializer=pipeline.init_worker,
+    initargs=(list(model_registry.styles), SESSION_POOL_CONFIG, RESULT_CACHE_CONFIG, MODEL_MANIFEST)
+)
+
+style_executor = ThreadPoolExecutor(max_workers=STYLE_THREADS, thread_name_prefix='style')
+admission = AdmissionController(MEMORY_BUDGET_MB * 1024 * 1024, max_queue=ADMISSION_QUEUE,
+                                timeout=ADMISSION_TIMEOUT, degrade_depth=DEGRADE_QUEUE_DEPTH,
+                                min_scale=0) if MEMORY_BUDGET_MB > 0 else None
+streams = StreamRegistry(max_streams=MAX_STREAMS, idle_timeout=STREAM_IDLE_SECONDS)
+
+# Read when /metrics is scraped
+metrics.REGISTRY.register(metrics.Gauge(
+    'nst_jobs_pending', 'Background jobs queued or running in this worker', function=lambda: job_manager.pending))
+metrics.REGISTRY.register(metrics.Gauge(
+    'nst_open_streams', 'Open live streams in this worker', function=lambda: len(streams)))
+if admission is not None:
+    metrics.REGISTRY.register(metrics.Gauge(
+        'nst_admission_queue_depth', 'Requests waiting for memory', function=lambda: admission.queue_depth))
+    metrics.REGISTRY.register(metrics.Gauge(
+        'nst_admission_bytes', 'Estimated memory of the admitted requests', function=lambda: admission.in_use))
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or 'unmatched'
+    metrics.REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=endpoint)
+    return response
+
+def report_error(where, e):
+    """Logs an error and counts it by type."""
+    metrics.ERRORS.inc(where=where, type=type(e).__name__)
+    logger.error("Error in %s: %s", where, e)
+
+def warm_up():
+    """Builds and warms the sessions of every loaded model, then reports the worker ready.
+
+    Call it in each serving process after any fork (gunicorn's post_worker_init does).
+    """
+    start = time.perf_counter()
+    sizes = [(size, size) for size in WARMUP_SIZES]
+    for model in readiness['models']:
+        try:
+            session_pool.warmup(model, sizes)
+        except Exception as e:
+            report_error('warmup', e)
+    readiness['warmup_seconds'] = round(time.perf_counter() - start, 2)
+    readiness['ready'] = True
+    log(f"Worker {os.getpid()} warmed {len(readiness['models'])} models in {readiness['warmup_seconds']}s")
+    # Threads, so started here: they would not survive gunicorn's fork
+    if MANIFEST_POLL_SECONDS > 0:
+        model_registry.watch(MANIFEST_POLL_SECONDS)
+    upload_store.watch()
+
+def reload_models(manifest):
+    """Registry callback: swaps the models that changed, then loads and warms
+    those of new styles. Requests in flight finish on the old sessions."""
+    swapped = session_pool.apply(manifest)
+    session_pool.styles = preload_keys(manifest.styles)
+    added = []
+    if PRELOAD_MODELS:
+        loaded = session_pool.load_models(preload_keys(manifest.styles, previews=True))
+        added = [model for model in loaded if model not in readiness['models']]
+        for model in added:
+            try:
+                session_pool.warmup(model, [(size, size) for size in WARMUP_SIZES])
+            except Exception as e:
+                report_error('warmup', e)
+        readiness['models'] = loaded
+    log(f"Worker {os.getpid()} reloaded {manifest.path}: swapped {swapped}, added {added}")
+
+model_registry.subscribe(reload_models)
+
+@app.route('/ready')
+def ready():
+    """200 once this worker's models are warm, 503 before."""
+    body = json.dumps(dict(readiness, pid=os.getpid()))
+    return (body, 200) if readiness['ready'] else (body, 503)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """This worker's metrics in the Prometheus text format (job worker spans included)."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 @app.route('/')
 def index():
-    return render_template('desx.html', styles=STYLES)
+    return render_template('desx.html', styles=model_registry.styles)
+
+def validate_file():
+    """Checks the uploaded file; returns (file, error_response)."""
+    if 'file' not in request.files:
+        log("No file in request")
+        return None, (json.dumps({'error': 'No file uploaded'}), 400)
+
+    file = request.files['file']
+    if file.filename == '':
+        log("No file selected")
+        return None, (json.dumps({'error': 'No file selected'}), 400)
+
+    if not file or not allowed_file(file.filename):
+        log(f"Invalid file: {file.filename}")
+        return None, (json.dumps({'error': 'Invalid file format. Please upload a PNG or JPG image.'}), 400)
+
+    return file, None
+
+def validate_upload():
+    """Checks the uploaded file and style; returns (file, style, error_response)."""
+    file, error = validate_file()
+    if error:
+        return None, None, error
+
+    # Get selected style
+    style = request.form.get('style')
+    log(f"Style selected: {style}")
+    if style not in model_registry.styles:
+        log(f"Invalid style: {style}")
+        return None, None, (json.dumps({'error': 'Invalid style selected'}), 400)
+
+    return file, style, None
+
+def request_model(style):
+    """Session pool key of the model variant this request runs, falling back to fp32."""
+    variant = request.form.get('variant', MODEL_VARIANT)
+    if variant not in MODEL_VARIANTS:
+        variant = MODEL_VARIANT
+    model = model_name(style, variant)
+    if variant != 'fp32' and not session_pool.has_model(model):
+        log(f"Model variant not available: {model}, using fp32")
+        model = style
+    return model
+
+def request_params(*models):
+    """Processing parameters for this request, starting from the pipeline defaults."""
+    params = dict(pipeline.DEFAULT_PARAMS, max_pixels=MAX_PIXELS, tile_size=TILE_SIZE, tile_overlap=TILE_OVERLAP,
+                  enhance_before_upscale=ENHANCE_BEFORE_UPSCALE)
+    tiled = request.form.get('tiled')
+    params['tiled'] = TILED_INFERENCE if tiled is None else tiled.lower() in ('1', 'true', 'on')
+
+    resize_mode = request.form.get('resize_mode', RESIZE_MODE)
+    if resize_mode not in pipeline.RESIZE_MODES:
+        resize_mode = RESIZE_MODE
+    fixed = [model for model in models if not session_pool.has_dynamic_shape(model)]
+    if resize_mode == 'aspect' and fixed:
+        log(f"Model {fixed[0]} has a fixed input shape, using square resize")
+        resize_mode = 'square'
+    params['resize_mode'] = resize_mode
+    return params
+
+def read_upload(file):
+    """Reads the upload into memory and hashes it; keeps the original only if asked.
+
+    Returns (data, input_filename, digest): input_filename is None unless the
+    original was stored, and cache_key(digest, ...) addresses the result cache.
+    """
+    data = file.read()
+    digest = data_digest(data)
+
+    input_filename = None
+    keep = request.form.get('keep_original')
+    if KEEP_UPLOADS if keep is None else keep.lower() in ('1', 'true', 'on'):
+        # Named by content so concurrent uploads never collide
+        input_filename = upload_store.save(digest, file.filename.rsplit('.', 1)[1].lower(), data)
+    return data, input_filename, digest
+
+def request_flag(name, default=False):
+    value = request.form.get(name)
+    return default if value is None else value.lower() in ('1', 'true', 'on')
+
+def profiled_run(model, profiles):
+    """run_model that profiles every onnxruntime run and appends the trace file names to `profiles`."""
+    def run(tensor):
+        output, path = session_pool.run_profiled(model, tensor, PROFILE_FOLDER)
+        profiles.append(os.path.basename(path))
+        return output
+    return run
+
+def degrade(params, *models):
+    """Lowers the inference resolution in `params` while requests queue for memory;
+    returns True if it did. Fixed-shape models always run at their own size."""
+    if admission is None or not all(session_pool.has_dynamic_shape(model) for model in models):
+        return False
+    scale = admission.resolution_scale()
+    if scale >= 1.0:
+        return False
+    image_size = int(params['image_size'] * math.sqrt(scale)) // 4 * 4
+    image_size = min(params['image_size'], max(MIN_INFERENCE_SIZE, image_size))
+    max_pixels = min(params['max_pixels'], max(MIN_INFERENCE_SIZE ** 2, int(params['max_pixels'] * scale)))
+    if (image_size, max_pixels) == (params['image_size'], params['max_pixels']) and not params['tiled']:
+        return False
+    params.update(image_size=image_size, max_pixels=max_pixels, tiled=False)
+    metrics.ADMISSIONS.inc(result='degraded')
+    log(f"Under load, running at {image_size}px / {max_pixels} pixels")
+    return True
+
+def admitted(data, models, params, preview=False):
+    """Reserves the estimated peak memory of stylizing `data` with `models` for the
+    duration of a with block; raises Overloaded when there is no room in time."""
+    if admission is None:
+        return nullcontext()
+    original_size, decoded_size = pipeline.probe_upload(io.BytesIO(data), **params)
+    tile_pixels = None
+    if params['tiled']:
+        target = decoded_size
+        tile_pixels = params['tile_size'] ** 2 * 4
+    else:
+        target = pipeline.inference_size(decoded_size, params['resize_mode'], params['image_size'],
+                                         params['max_pixels'])
+    nbytes = estimate_bytes(decoded_size, target, models, target if preview else original_size,
+                            upload_bytes=len(data), tile_pixels=tile_pixels)
+    return admission.admit(nbytes)
+
+def overloaded_response(e):
+    log(f"Not admitted: {str(e)}")
+    return json.dumps({'error': 'Server is busy, please retry shortly'}), 429, {'Retry-After': '2'}
+
+def result_response(input_filename, outputs, style):
+    return {
+        'success': True,
+        'input_image': input_filename,
+        'output_jpg': outputs['jpg'],
+        'output_png': outputs['png'],
+        'style_name': model_registry.styles.get(style, style)
+    }
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
     try:
-        print("Upload route called")
-        if 'file' not in request.files:
-            print("No file in request")
-            return json.dumps({'error': 'No file uploaded'}), 400
-
-        file = request.files['file']
-        if file.filename == '':
-            print("No file selected")
-            return json.dumps({'error': 'No file selected'}), 400
-
-        if not file or not allowed_file(file.filename):
-            print(f"Invalid file: {file.filename}")
-            return json.dumps({'error': 'Invalid file format. Please upload a PNG or JPG image.'}), 400
-
-        # Get selected style
-        style = request.form.get('style')
-        print(f"Style selected: {style}")
-        if style not in STYLES:
-            print(f"Invalid style: {style}")
-            return json.dumps({'error': 'Invalid style selected'}), 400
-
-        # Save the uploaded file
-        filename = file.filename
-        input_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(input_path)
-        print(f"File saved: {input_path}")
-
-        # Process the image
-        # Load the content image
-        img = Image.open(input_path).convert("RGB")
-        original_size = img.size
-        img = img.resize((1024, 1024), Image.LANCZOS)
-        content_tensor = preprocess(img).unsqueeze(0).cpu().numpy()
-        print(f"Image preprocessed: {content_tensor.shape}")
-
-        # Load the ONNX model
-        model_path = f"{style}.onnx"
-        print(f"Loading model: {model_path}")
-        ort_session = ort.InferenceSession(model_path)
-
-        # Get the input name from the model
-        input_name = ort_session.get_inputs()[0].name
-        print(f"Model input name: {input_name}")
-
-        # Run style transfer
-        print("Running style transfer")
-        stylized = ort_session.run(None, {input_name: content_tensor})[0]
-        print(f"Style transfer completed: {stylized.shape}")
-
-        # Convert to image
-        output_tensor = torch.from_numpy(stylized.squeeze())
-        output_image = postprocess(output_tensor)
-
-        # Resize to original size
-        output_image = output_image.resize(original_size, Image.LANCZOS)
-
-        # Apply sharpening and contrast enhancement
-        sharp_img = output_image.filter(ImageFilter.SHARPEN)
-        enhancer = ImageEnhance.Contrast(sharp_img)
-        final_img = enhancer.enhance(1.2)
-
-        # Save the output image as both JPG and PNG
-        output_filename_jpg = f"output_{filename.rsplit('.', 1)[0]}.jpg"
-        output_filename_png = f"output_{filename.rsplit('.', 1)[0]}.png"
-        output_path_jpg = os.path.join(app.config['OUTPUT_FOLDER'], output_filename_jpg)
-        output_path_png = os.path.join(app.config['OUTPUT_FOLDER'], output_filename_png)
-        final_img.save(output_path_jpg, 'JPEG')
-        final_img.save(output_path_png, 'PNG')
-        print(f"Output saved: {output_path_jpg}, {output_path_png}")
+        log("Upload route called")
+        file, style, error = validate_upload()
+        if error:
+            return error
+
+        model = request_model(style)
+        params = request_params(model)
+        data, input_filename, digest = read_upload(file)
+        key = cache_key(digest, session_pool.revision(model), params)
+        if input_filename:
+            log(f"File saved: {input_filename}")
+
+        # Serve repeat requests straight from the result cache (profiled requests always run)
+        profile = ALLOW_PROFILING and request_flag('profile')
+        cached = None if profile else pipeline.cached_result(result_cache, key)
+        if cached:
+            log(f"Result cache hit: {key}")
+            return json.dumps(result_response(input_filename, cached, style))
+
+        # Under load, a lower-resolution result (which may itself be cached) beats a long wait
+        degraded = degrade(params, model)
+        if degraded:
+            key = cache_key(digest, session_pool.revision(model), params)
+            cached = None if profile else pipeline.cached_result(result_cache, key)
+            if cached:
+                return json.dumps(dict(result_response(input_filename, cached, style), degraded=True))
+
+        # Process the image; style transfer is batched with concurrent requests for the same style
+        log(f"Running style transfer: {model} (tiled={params['tiled']})")
+        profiles = []
+        run_model = profiled_run(model, profiles) if profile else lambda tensor: batch_scheduler.run(model, tensor)
+        with admitted(data, [model], params), metrics.labels(style=model):
+            img, original_size = pipeline.decode_upload(io.BytesIO(data), **params)
+            final_img = pipeline.stylize_image(img, run_model, output_size=original_size,
+                                               uint8_io=session_pool.takes_uint8(model), **params)
+            log("Style transfer completed")
+
+            # Store the result once; JPG and PNG are encoded when first downloaded
+            outputs = pipeline.store_result(result_cache, key, final_img)
+        log(f"Output saved: {outputs['jpg']}, {outputs['png']}")
 
         # Return JSON response with image paths
+        response = result_response(input_filename, outputs, style)
+        if degraded:
+            response['degraded'] = True
+        if profile:
+            response['profiles'] = profiles
+        return json.dumps(response)
+
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        report_error('upload', e)
+        return json.dumps({'error': f'Error processing image: {str(e)}'}), 500
+
+def request_styles():
+    """Styles named in the 'styles' form field (repeated or comma-separated); all by default."""
+    names = [name for value in request.form.getlist('styles') for name in value.split(',') if name]
+    return names or list(model_registry.styles)
+
+@app.route('/upload/styles', methods=['POST'])
+def upload_styles():
+    """Stylizes one upload with several styles in a single pass.
+
+    The image is decoded, resized and converted once; every style then runs on
+    the same input, concurrently. With 'preview' set, results come back at
+    PREVIEW_SIZE as JPEG only.
+    """
+    try:
+        file, error = validate_file()
+        if error:
+            return error
+        styles = request_styles()
+        unknown = [style for style in styles if style not in model_registry.styles]
+        if unknown:
+            return json.dumps({'error': f'Invalid style selected: {", ".join(unknown)}'}), 400
+
+        models = {style: request_model(style) for style in styles}
+        missing = [style for style, model in models.items() if not session_pool.has_model(model)]
+        for style in missing:
+            log(f"Model not found for style: {style}")
+            del models[style]
+        if not models:
+            return json.dumps({'error': 'No model available for the selected styles'}), 404
+
+        params = request_params(*models.values())
+        preview = request_flag('preview')
+        if preview and not all(session_pool.has_dynamic_shape(model) for model in models.values()):
+            log("Preview needs dynamic-shape models, running at full size")
+            preview = False
+        if preview:
+            params.update(image_size=PREVIEW_SIZE, max_pixels=PREVIEW_SIZE * PREVIEW_SIZE, tiled=False)
+        degraded = not preview and degrade(params, *models.values())
+
+        data, input_filename, digest = read_upload(file)
+        keys = {style: cache_key(digest, session_pool.revision(model), dict(params, preview=True) if preview else params)
+                for style, model in models.items()}
+        outputs = {}
+        for style, key in keys.items():
+            cached = result_cache.get(key, PREVIEW_FORMATS) if preview else pipeline.cached_result(result_cache, key)
+            if cached:
+                outputs[style] = cached
+        to_run = {style: models[style] for style in models if style not in outputs}
+
+        if to_run:
+            log(f"Running style transfer: {', '.join(to_run.values())} (preview={preview})")
+            run_models = {style: (lambda tensor, model=model: batch_scheduler.run(model, tensor))
+                          for style, model in to_run.items()}
+            with admitted(data, list(to_run.values()), params, preview):
+                img, original_size = pipeline.decode_upload(io.BytesIO(data), **params)
+                uint8_io = all(session_pool.takes_uint8(model) for model in to_run.values())
+                images = pipeline.stylize_many(img, run_models, style_executor, preview=preview,
+                                               output_size=original_size, uint8_io=uint8_io, **params)
+                if preview:
+                    # Small JPEGs the page shows right away: encode them now
+                    encoded = style_executor.map(
+                        lambda style: pipeline.encode_outputs(images[style], PREVIEW_FORMATS), list(images))
+                    for style, preview_files in zip(list(images), encoded):
+                        outputs[style] = result_cache.put(keys[style], preview_files)
+                else:
+                    for style, final_img in images.items():
+                        outputs[style] = pipeline.store_result(result_cache, keys[style], final_img)
+            log("Style transfer completed")
+
         return json.dumps({
             'success': True,
-            'input_image': filename,
-            'output_jpg': output_filename_jpg,
-            'output_png': output_filename_png,
-            'style_name': STYLES[style]
+            'input_image': input_filename,
+            'preview': preview,
+            'degraded': degraded,
+            'results': {style: {
+                'output_jpg': result['jpg'],
+                'output_png': result.get('png'),
+                'style_name': model_registry.styles.get(style, style)
+            } for style, result in outputs.items()},
+            'missing_styles': missing
         })
 
+    except Overloaded as e:
+        return overloaded_response(e)
     except Exception as e:
-        print(f"Error in upload: {str(e)}")
+        report_error('multi-style upload', e)
         return json.dumps({'error': f'Error processing image: {str(e)}'}), 500
 
+def preview_model(style, model):
+    """(model, image_size) to run a quick preview with: the model itself at PREVIEW_SIZE
+    when it has a dynamic shape, else a small <style>.preview graph if one was exported."""
+    if session_pool.has_dynamic_shape(model):
+        return model, PREVIEW_SIZE
+    small = f"{style}.preview"
+    if session_pool.has_model(small):
+        return small, session_pool.image_shape(small)[0]
+    return None, None
+
+def render_preview(data, digest, style, model, params):
+    """Stylizes a low-resolution preview in the request thread; returns its JPEG name or None."""
+    model, size = preview_model(style, model)
+    if model is None:
+        return None
+    params = dict(params, image_size=size, max_pixels=size * size, tiled=False)
+    if not session_pool.has_dynamic_shape(model):
+        params['resize_mode'] = 'square'
+    key = cache_key(digest, session_pool.revision(model), dict(params, preview=True))
+    cached = result_cache.get(key, PREVIEW_FORMATS)
+    if cached:
+        return cached['jpg']
+    with admitted(data, [model], params, preview=True), metrics.labels(style=model):
+        img, _ = pipeline.decode_upload(io.BytesIO(data), **params)
+        images = pipeline.stylize_many(img, {style: lambda tensor: batch_scheduler.run(model, tensor)},
+                                       preview=True, uint8_io=session_pool.takes_uint8(model), **params)
+    return result_cache.put(key, pipeline.encode_outputs(images[style], PREVIEW_FORMATS))['jpg']
+
+def job_response(job):
+    """Adds the style name and success flag the frontend expects to a job status."""
+    if job.get('status') == 'done':
+        job = dict(job, success=True, **job['result'])
+        job['style_name'] = model_registry.styles.get(job['result'].get('style'), '')
+    return job
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    try:
+        file, style, error = validate_upload()
+        if error:
+            return error
+
+        model = request_model(style)
+        params = request_params(model)
+        data, input_filename, digest = read_upload(file)
+        key = cache_key(digest, session_pool.revision(model), params)
+        cached = pipeline.cached_result(result_cache, key)
+        if cached:
+            job_id = job_manager.complete({
+                'style': style,
+                'input_image': input_filename,
+                'output_jpg': cached['jpg'],
+                'output_png': cached['png']
+            })
+        else:
+            # The job's estimated peak memory stays reserved until its worker process is done
+            reservation = ExitStack()
+            reservation.enter_context(admitted(data, [model], params))
+            try:
+                job_id = job_manager.submit(pipeline.stylize_job, data, input_filename, style, model, key, params,
+                                            on_finished=reservation.close)
+            except Exception:
+                reservation.close()
+                raise
+        log(f"Job queued: {job_id} ({style})")
+        response = {
+            'job_id': job_id,
+            'status': 'done' if cached else 'queued',
+            'input_image': input_filename,
+            'status_url': url_for('job_status', job_id=job_id),
+            'events_url': url_for('job_events', job_id=job_id)
+        }
+
+        # Progressive mode: a low-res result now, while the job renders the full one
+        if not cached and request_flag('progressive'):
+            try:
+                preview = render_preview(data, digest, style, model, params)
+            except Overloaded as e:
+                log(f"No memory for a preview: {str(e)}")
+                preview = None
+            except Exception as e:
+                report_error('preview', e)
+                preview = None
+            if preview:
+                response['preview_jpg'] = preview
+        return json.dumps(response), 202
+
+    except Overloaded as e:
+        return overloaded_response(e)
+    except QueueFull as e:
+        metrics.ERRORS.inc(where='jobs', type=type(e).__name__)
+        log(f"Job queue full: {str(e)}")
+        return json.dumps({'error': 'Server is busy, please retry shortly'}), 429, {'Retry-After': '2'}
+    except Exception as e:
+        report_error('jobs', e)
+        return json.dumps({'error': f'Error processing image: {str(e)}'}), 500
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_manager.status(job_id)
+    if job is None:
+        return json.dumps({'error': 'Unknown job'}), 404
+    return json.dumps(job_response(job))
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    if job_manager.status(job_id) is None:
+        return json.dumps({'error': 'Unknown job'}), 404
+
+    def stream():
+        last_status = None
+        while True:
+            job = job_manager.status(job_id)
+            if job is None:
+                return
+            if job['status'] != last_status:
+                last_status = job['status']
+                yield f"data: {json.dumps(job_response(job))}\n\n"
+            if last_status in FINISHED_STATES:
+                return
+            time.sleep(0.25)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+def stream_target_size(model):
+    """Maps a frame size to the size it is stylized at on this model."""
+    if session_pool.has_dynamic_shape(model):
+        return lambda size: pipeline.fit_to_budget(size, STREAM_SIZE * STREAM_SIZE)
+    height, width = session_pool.image_shape(model)
+    return lambda size: (width, height)
+
+def stream_urls(stream_id):
+    return {
+        'stream_id': stream_id,
+        'frames_url': url_for('stream_frame', stream_id=stream_id),
+        'video_url': url_for('stream_video', stream_id=stream_id),
+        'stats_url': url_for('stream_stats', stream_id=stream_id)
+    }
+
+@app.route('/streams', methods=['POST'])
+def open_stream():
+    style = request.form.get('style')
+    if style not in model_registry.styles:
+        return json.dumps({'error': 'Invalid style selected'}), 400
+    model = request_model(style)
+    if not session_pool.has_model(model):
+        return json.dumps({'error': f'Model not found for style: {style}'}), 404
+
+    try:
+        target_size = stream_target_size(model)
+        run_model = lambda tensor: batch_scheduler.run(model, tensor)
+        uint8_io = session_pool.takes_uint8(model)
+        incremental = request_flag('incremental', STREAM_INCREMENTAL) and session_pool.has_dynamic_shape(model)
+        stream_id, _ = streams.open(lambda: StreamSession(
+            run_model, target_size, quality=STREAM_JPEG_QUALITY, uint8_io=uint8_io,
+            incremental=IncrementalStylizer(run_model, STREAM_TILE_SIZE, STREAM_TILE_HALO, STREAM_CHANGE_THRESHOLD,
+                                            uint8_io=uint8_io) if incremental else None))
+    except TooManyStreams as e:
+        metrics.ERRORS.inc(where='streams', type=type(e).__name__)
+        log(f"Stream limit reached: {str(e)}")
+        return json.dumps({'error': 'Too many live streams, please retry shortly'}), 429, {'Retry-After': '5'}
+    log(f"Stream opened: {stream_id} ({model})")
+    return json.dumps(stream_urls(stream_id)), 201
+
+@app.route('/streams/<stream_id>/frames', methods=['POST'])
+def stream_frame(stream_id):
+    """Takes one JPEG frame (raw body or 'frame' file field); answers with the stream stats."""
+    session = streams.get(stream_id)
+    if session is None:
+        return json.dumps({'error': 'Unknown stream'}), 404
+    frame = request.files.get('frame')
+    data = frame.read() if frame else request.get_data()
+    if not data:
+        return json.dumps({'error': 'No frame sent'}), 400
+    session.push(data)
+    return json.dumps(session.stats()), 202
+
+@app.route('/streams/<stream_id>/video')
+def stream_video(stream_id):
+    """Stylized frames as an MJPEG stream (multipart/x-mixed-replace), usable as an <img> src."""
+    session = streams.get(stream_id)
+    if session is None:
+        return json.dumps({'error': 'Unknown stream'}), 404
+
+    def generate():
+        for jpeg in session.frames(timeout=STREAM_IDLE_SECONDS):
+            yield (b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: " + str(len(jpeg)).encode()
+                   + b"\r\n\r\n" + jpeg + b"\r\n")
+
+    return Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame',
+                    headers={'Cache-Control': 'no-cache'})
+
+@app.route('/streams/<stream_id>', methods=['GET', 'DELETE'])
+def stream_stats(stream_id):
+    session = streams.get(stream_id)
+    if session is None:
+        return json.dumps({'error': 'Unknown stream'}), 404
+    stats = session.stats()
+    if request.method == 'DELETE':
+        streams.close(stream_id)
+        log(f"Stream closed: {stream_id} ({stats['frames_out']} frames, {stats['fps']} fps)")
+    return json.dumps(dict(stats, **stream_urls(stream_id)))
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
 @app.route('/outputs/<filename>')
 def output_file(filename):
+    """Serves a result, encoding it from its canonical artifact on first request."""
+    output_encoder.path(filename)
     return send_from_directory(app.config['OUTPUT_FOLDER'], filename)
 
 if __name__ == '__main__':
+    warm_up()
     port = int(os.environ.get('PORT', 5000))
     app.run(debug=False, host='0.0.0.0', port=port)
\ No newline at end of file